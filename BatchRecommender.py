@@ -0,0 +1,123 @@
+import gc
+import multiprocessing
+import numpy as np
+from TrainsetArrays import TrainsetArrays
+
+# (recommender, user chunks) inherited by the forked workers of recommendInner()
+_shared = None
+
+
+class BatchRecommender:
+    """
+    Top-N recommendations for many listeners, computed in inner-ID space.
+
+    Gives the same lists as building each listener's anti-test set, running algorithm.test() and
+    sorting the predictions: cells the algorithm cannot predict get the trainset's global mean,
+    estimates are clipped to the rating scale, and ties keep the inner item order (the order of the
+    anti-test set, which the stable sort preserves). Only the final top-N are mapped back to raw IDs.
+
+    The algorithm must be fitted and provide estimateBlock(users, items).
+
+    With processes > 1 the listener blocks are spread over forked worker processes. The fitted
+    model (neighbor index, RBM predictions, rating arrays) is not copied or pickled: the workers
+    read the parent's pages, shared copy-on-write, so memory does not grow with the worker count.
+    """
+
+    def __init__(self, algorithm, trainset, k=10, blockSize=64, processes=1):
+        self.algorithm = algorithm
+        self.trainset = trainset
+        self.k = k
+        self.blockSize = blockSize
+        self.processes = processes
+        self.ratingArrays = TrainsetArrays(trainset)
+
+    def recommend(self, userIds):
+        """
+        Returns:
+            list: (raw user ID, [raw music IDs]) per known listener, in the order of userIds.
+        """
+        (users, known) = self._innerUsers(userIds)
+        topN = self.recommendInner(users)
+        return [(userId, [self.trainset.to_raw_iid(int(i)) for i in items])
+                for (userId, items) in zip(known, topN)]
+
+    def recommendInner(self, users):
+        """Top-N inner item IDs of each of the given inner user IDs."""
+        return [items for (items, _) in self.recommendInnerScored(users)]
+
+    def recommendInnerScored(self, users):
+        """(top-N inner item IDs, their scores) of each of the given inner user IDs."""
+        users = np.asarray(users, dtype=np.int64)
+        chunks = [users[start:start + self.blockSize] for start in range(0, len(users), self.blockSize)]
+        if self.processes > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            return self._recommendInParallel(chunks)
+
+        topN = []
+        for chunk in chunks:
+            topN.extend(self._recommendChunk(chunk))
+        return topN
+
+    def _recommendChunk(self, users):
+        topN = []
+        for row in self.scoreBlock(users):
+            items = self.topItems(row)
+            topN.append((items, row[items]))
+        return topN
+
+    def _recommendInParallel(self, chunks):
+        global _shared
+        # Build lazy caches (e.g. the transposed neighbor index) before forking, so that the
+        # workers share them instead of each building its own copy
+        self.scoreBlock(chunks[0][:1])
+
+        _shared = (self, chunks)
+        # Keep the collector from touching, hence copying, the inherited objects (Python 3.7+)
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        try:
+            with multiprocessing.get_context('fork').Pool(self.processes) as pool:
+                # map() returns the chunks in order, whichever worker finishes first
+                results = pool.map(_recommendSharedChunk, range(len(chunks)), chunksize=1)
+        finally:
+            _shared = None
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+        return [topN for chunk in results for topN in chunk]
+
+    def scoreBlock(self, users, items=None):
+        """Prediction scores of every item (or of items), -inf for the items each user already rated."""
+        scores = self.algorithm.estimateBlock(users, items)
+        scores[np.isnan(scores)] = self.trainset.global_mean
+        (lowerBound, higherBound) = self.trainset.rating_scale
+        scores = np.maximum(lowerBound, np.minimum(higherBound, scores))
+        rated = self.ratingArrays.ratedMask(users)
+        scores[rated if items is None else rated[:, items]] = -np.inf
+        return scores
+
+    def topItems(self, scores):
+        available = int(np.isfinite(scores).sum())
+        k = min(self.k, available)
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Everything at or above the k-th largest score may be kept; the item order settles ties
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= threshold)
+        order = np.lexsort((candidates, -scores[candidates]))[:k]
+        return candidates[order]
+
+    def _innerUsers(self, userIds):
+        users = []
+        known = []
+        for userId in userIds:
+            try:
+                users.append(self.trainset.to_inner_uid(userId))
+            except ValueError:
+                print("Skipping unknown user ", userId)
+                continue
+            known.append(userId)
+        return np.asarray(users, dtype=np.int64), known
+
+
+def _recommendSharedChunk(index):
+    (recommender, chunks) = _shared
+    return recommender._recommendChunk(chunks[index])
@@ -0,0 +1,254 @@
+"""
+Benchmarks on synthetic data (see SyntheticData), no database needed.
+
+Every configuration runs in its own child process, so that the wall time includes the imports
+(TensorFlow's in particular) and the peak RSS of one configuration does not leak into the next.
+
+    python Benchmark.py rbm --users 1000 --items 2000 --epochs 5
+    python Benchmark.py rbm-warm --users 1000 --items 2000 --epochs 40 --warm-epochs 10
+    python Benchmark.py als --users 1000 --items 2000 --epochs 20 --models als,numpy
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from surprise.model_selection import LeaveOneOut
+from SyntheticData import makeCatalog, makeRatings
+from RBMCheckpoint import RBMCheckpoint
+from MusicCatalog import MusicCatalog
+from BatchRecommender import BatchRecommender
+from RecommenderMetrics import RecommenderMetrics
+
+
+def trainingMatrix(numUsers, numItems, seed=0, ratingValues=10):
+    """Sparse users x (items * ratingValues) one-hot matrix built like RBMAlgorithm.buildTrainingMatrix."""
+    (listenerIDs, musicIDs, scores) = makeRatings(numUsers, numItems, seed=seed)
+    quantiles = np.linspace(0, 1, ratingValues + 1)[1:-1]
+    thresholds = pd.Series(scores).quantile(quantiles).tolist()
+    levels = np.searchsorted(thresholds, scores)
+
+    columns = (musicIDs - 1) * ratingValues + levels
+    return sparse.csr_matrix((np.ones(len(columns), dtype=np.float32), (listenerIDs - 1, columns)),
+                             shape=(numUsers, numItems * ratingValues))
+
+
+def levelMatrix(users, items, levels, numUsers, numItems, ratingValues=10):
+    columns = items * ratingValues + levels
+    return sparse.csr_matrix((np.ones(len(columns), dtype=np.float32), (users, columns)),
+                             shape=(numUsers, numItems * ratingValues))
+
+
+def heldOutError(rbm, X, users, items, levels, ratingValues=10, batchSize=100):
+    """Mean absolute error between the expected level of held-out ratings and their true level."""
+    errors = []
+    for start in range(0, X.shape[0], batchSize):
+        selected = (users >= start) & (users < start + batchSize)
+        recs = rbm.GetReconstructions(X[start:start + batchSize]).reshape(-1, X.shape[1] // ratingValues, ratingValues)
+        probabilities = np.exp(recs[users[selected] - start, items[selected]])
+        expected = (probabilities * np.arange(ratingValues)).sum(axis=1) / probabilities.sum(axis=1)
+        errors.append(np.abs(expected - levels[selected]))
+    return float(np.concatenate(errors).mean())
+
+
+def benchmarkWarmStart(backend, numUsers, numItems, epochs, warmEpochs, hiddenDim, batchSize):
+    """
+    Nightly run simulation: yesterday's catalog has 90% of the users and songs; today's adds the
+    rest. Cold start trains today's data for all epochs, warm start resumes from yesterday's
+    checkpoint for warmEpochs, and a cold start with only warmEpochs shows what the checkpoint
+    brings. All are scored on the same held-out ratings.
+    """
+    if backend == "numpy":
+        from NumpyRBM import NumpyRBM as RBMClass
+    else:
+        from RBM import RBM as RBMClass
+
+    (listenerIDs, musicIDs, scores) = makeRatings(numUsers, numItems, seed=0)
+    (users, items) = (listenerIDs - 1, musicIDs - 1)
+    thresholds = pd.Series(scores).quantile(np.linspace(0, 1, 11)[1:-1]).tolist()
+    levels = np.searchsorted(thresholds, scores)
+    heldOut = np.random.RandomState(1).rand(len(scores)) < 0.05
+    train = ~heldOut
+    X = levelMatrix(users[train], items[train], levels[train], numUsers, numItems)
+
+    def trainRBM(matrix, epochs, initialParameters=None):
+        rbm = RBMClass(matrix.shape[1], hiddenDimensions=hiddenDim, batchSize=batchSize, epochs=epochs)
+        started = time.time()
+        rbm.Train(matrix, initialParameters)
+        return rbm, time.time() - started
+
+    (cold, coldSeconds) = trainRBM(X, epochs)
+    (short, shortSeconds) = trainRBM(X, warmEpochs)
+
+    # Yesterday: the first 90% of the users and songs, with today's item numbering kept as raw IDs
+    (oldUsers, oldItems) = (int(numUsers * 0.9), int(numItems * 0.9))
+    old = train & (users < oldUsers) & (items < oldItems)
+    (yesterday, _) = trainRBM(levelMatrix(users[old], items[old], levels[old], oldUsers, oldItems), epochs)
+    checkpoint = RBMCheckpoint(*yesterday.GetParameters(), thresholds, list(range(oldItems)))
+    (warm, warmSeconds) = trainRBM(X, warmEpochs, checkpoint.initialParameters(list(range(numItems)), hiddenDim))
+
+    return [
+        {'backend': backend, 'start': 'cold', 'epochs': epochs, 'trainSeconds': coldSeconds,
+         'heldOutMAE': heldOutError(cold, X, users[heldOut], items[heldOut], levels[heldOut])},
+        {'backend': backend, 'start': 'cold', 'epochs': warmEpochs, 'trainSeconds': shortSeconds,
+         'heldOutMAE': heldOutError(short, X, users[heldOut], items[heldOut], levels[heldOut])},
+        {'backend': backend, 'start': 'warm', 'epochs': warmEpochs, 'trainSeconds': warmSeconds,
+         'heldOutMAE': heldOutError(warm, X, users[heldOut], items[heldOut], levels[heldOut])}
+    ]
+
+
+def benchmarkRBM(backend, numUsers, numItems, epochs, hiddenDim, batchSize):
+    """Train an RBM and reconstruct every user; runs inside the child process."""
+    started = time.time()
+    if backend == "numpy":
+        from NumpyRBM import NumpyRBM as RBMClass
+    else:
+        from RBM import RBM as RBMClass
+    imported = time.time()
+
+    X = trainingMatrix(numUsers, numItems)
+    rbm = RBMClass(X.shape[1], hiddenDimensions=hiddenDim, batchSize=batchSize, epochs=epochs)
+    rbm.Train(X)
+    trained = time.time()
+
+    for start in range(0, numUsers, batchSize):
+        rbm.GetReconstructions(X[start:start + batchSize])
+    finished = time.time()
+
+    return {
+        'backend': backend,
+        'importSeconds': imported - started,
+        'trainSeconds': trained - imported,
+        'recommendSeconds': finished - trained,
+        'totalSeconds': finished - started
+    }
+
+
+def syntheticCatalog(numUsers, numItems, seed=0):
+    """A MusicCatalog of synthetic songs and ratings, standing in for the Postgres load."""
+    details = makeCatalog(numItems=numItems, seed=seed)
+    names = {musicID: "song " + str(musicID) for musicID in details}
+    return MusicCatalog(names, details, *makeRatings(numUsers, numItems, seed=seed))
+
+
+def leaveOneOutSplit(catalog):
+    """The catalog's ratings split like EvaluationData's LOOCV: one random rating per user left out."""
+    for (train, test) in LeaveOneOut(n_splits=1, random_state=1).split(catalog.ratingsDataset()):
+        return train, test
+
+
+def benchmarkALS(model, numUsers, numItems, epochs, hiddenDim, batchSize, factors, iterations, threads):
+    """
+    Fit one model ("als" or an RBM backend) on the leave-one-out training set, recommend 10 songs
+    to every user and count how many left-out songs are among them; runs inside the child process.
+    """
+    catalog = syntheticCatalog(numUsers, numItems)
+    (trainset, leftOut) = leaveOneOutSplit(catalog)
+    started = time.time()
+    if model == "als":
+        from ImplicitALSAlgorithm import ImplicitALSAlgorithm
+        algorithm = ImplicitALSAlgorithm(factors=factors, iterations=iterations, numThreads=threads or None)
+    else:
+        from RBMAlgorithm import RBMAlgorithm
+        algorithm = RBMAlgorithm(epochs=epochs, hiddenDim=hiddenDim, batchSize=batchSize, backend=model,
+                                 musicCatalog=catalog)
+    algorithm.fit(trainset)
+    trained = time.time()
+
+    userIds = sorted(set(userId for (userId, _, _) in leftOut))
+    topN = {userId: [(musicID, 0) for musicID in musicIDs]
+            for (userId, musicIDs) in BatchRecommender(algorithm, trainset, k=10).recommend(userIds)}
+    finished = time.time()
+
+    return {
+        'model': model,
+        'trainSeconds': trained - started,
+        'recommendSeconds': finished - trained,
+        'hitRate': RecommenderMetrics.HitRate(topN, leftOut)
+    }
+
+
+def runChild(arguments):
+    """Run this script with --child and the given arguments, return its result plus peak RSS."""
+    completed = subprocess.run([sys.executable, __file__, "--child"] + arguments,
+                               stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    # The result is the last line; everything before it is the benchmarked code's own output
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def printTable(results, columns):
+    print(" ".join("{:<18}".format(column) for column in columns))
+    for result in results:
+        print(" ".join("{:<18.2f}".format(result[column]) if isinstance(result[column], float)
+                       else "{:<18}".format(str(result[column])) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic data")
+    parser.add_argument("benchmark", choices=["rbm", "rbm-warm", "als"])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--warm-epochs", type=int, default=5)
+    parser.add_argument("--hidden", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--backends", default="numpy,tensorflow")
+    parser.add_argument("--models", default="als,numpy,tensorflow", help="als and/or RBM backends")
+    parser.add_argument("--factors", type=int, default=32)
+    parser.add_argument("--iterations", type=int, default=15)
+    parser.add_argument("--threads", type=int, default=0, help="ALS solver threads (0: default)")
+    parser.add_argument("--backend", help=argparse.SUPPRESS)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sizes = ["--users", str(args.users), "--items", str(args.items), "--epochs", str(args.epochs),
+             "--warm-epochs", str(args.warm_epochs), "--hidden", str(args.hidden), "--batch", str(args.batch),
+             "--factors", str(args.factors), "--iterations", str(args.iterations), "--threads", str(args.threads)]
+
+    if args.child:
+        if args.benchmark == "rbm":
+            result = benchmarkRBM(args.backend, args.users, args.items, args.epochs, args.hidden, args.batch)
+            # ru_maxrss is in kilobytes on Linux
+            result['peakRSSMB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        elif args.benchmark == "rbm-warm":
+            result = benchmarkWarmStart(args.backend, args.users, args.items, args.epochs, args.warm_epochs,
+                                        args.hidden, args.batch)
+        elif args.benchmark == "als":
+            result = benchmarkALS(args.backend, args.users, args.items, args.epochs, args.hidden, args.batch,
+                                  args.factors, args.iterations, args.threads)
+            result['peakRSSMB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        print(json.dumps(result))
+        return
+
+    if args.benchmark == "rbm":
+        results = []
+        for backend in args.backends.split(","):
+            try:
+                results.append(runChild(["rbm", "--backend", backend] + sizes))
+            except subprocess.CalledProcessError:
+                print("Backend ", backend, " failed, see the error above")
+        printTable(results, ['backend', 'importSeconds', 'trainSeconds', 'recommendSeconds', 'totalSeconds', 'peakRSSMB'])
+    elif args.benchmark == "rbm-warm":
+        results = []
+        for backend in args.backends.split(","):
+            try:
+                results.extend(runChild(["rbm-warm", "--backend", backend] + sizes))
+            except subprocess.CalledProcessError:
+                print("Backend ", backend, " failed, see the error above")
+        printTable(results, ['backend', 'start', 'epochs', 'trainSeconds', 'heldOutMAE'])
+    elif args.benchmark == "als":
+        results = []
+        for model in args.models.split(","):
+            try:
+                results.append(runChild(["als", "--backend", model] + sizes))
+            except subprocess.CalledProcessError:
+                print("Model ", model, " failed, see the error above")
+        printTable(results, ['model', 'trainSeconds', 'recommendSeconds', 'hitRate', 'peakRSSMB'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+On-disk columnar snapshot of a MusicCatalog, so that runs and local experiments can start
+without Postgres:
+
+    snapshot.json                   format version, sizes, the values of the scalar attributes and
+                                    the ratings watermark (see MusicRecommendation.refreshSnapshot)
+    ratings.<column>.npy            listener_id, music_id, score (NaN when the score is NULL)
+    musics.id.npy                   music IDs, sorted
+    musics.name.offsets/values.npy  UTF-8 names, name i is values[offsets[i]:offsets[i + 1]]
+    musics.name.null.npy            True where the name is NULL
+    musics.<scalar>.npy             codes into the value list stored in snapshot.json (nationality...)
+    musics.<list>.offsets/values.npy  the genre, artist, category and period ID lists, flattened
+
+loadSnapshot() memory-maps the arrays, so loading is near-instant; a song's details dict is only
+built when it is looked up.
+
+The snapshot path is a symlink to a versioned sibling directory (.<name>.v-<random>), swapped
+atomically when a new snapshot is saved (see publishVersion).
+"""
+import glob
+import json
+import os
+import shutil
+import tempfile
+from collections.abc import Mapping
+from types import MappingProxyType
+import numpy as np
+from ContentSimilarity import SET_ATTRIBUTES, VALUE_ATTRIBUTES
+from MusicCatalog import MusicCatalog
+from TrainsetArrays import rowPositions
+
+# Version of the snapshot layout, checked by loadSnapshot
+FORMAT = 1
+
+RATING_COLUMNS = ('listener_id', 'music_id', 'score')
+SCALAR_KEYS = [key for (_, key) in VALUE_ATTRIBUTES]
+LIST_KEYS = [key for (_, key) in SET_ATTRIBUTES]
+
+
+def saveSnapshot(catalog, directory):
+    """
+    Write catalog to directory (replacing any previous snapshot there). The files are written to a
+    new version directory first and published with publishVersion, so a reader never opens half a
+    snapshot.
+    """
+    tempPath = newVersion(directory)
+
+    def save(name, array):
+        np.save(os.path.join(tempPath, name + '.npy'), array)
+
+    for (column, array) in zip(RATING_COLUMNS, (catalog.listenerIDs, catalog.musicIDs, catalog.scores)):
+        save('ratings.' + column, np.asarray(array))
+
+    musicIDs = sorted(catalog.musicID_to_details.keys() | catalog.musicID_to_name.keys())
+    save('musics.id', np.array(musicIDs, dtype=np.int64))
+    names = [catalog.musicID_to_name.get(musicID) for musicID in musicIDs]
+    save('musics.name.null', np.array([name is None for name in names], dtype=bool))
+    (offsets, values) = _flatten([(name or "").encode('utf-8') for name in names], np.uint8)
+    save('musics.name.offsets', offsets)
+    save('musics.name.values', values)
+
+    details = [catalog.musicID_to_details.get(musicID, {}) for musicID in musicIDs]
+    scalarValues = {}
+    for key in SCALAR_KEYS:
+        codes = {}
+        save('musics.' + key, np.array([codes.setdefault(entry.get(key), len(codes)) for entry in details],
+                                        dtype=np.int64))
+        scalarValues[key] = list(codes)
+    for key in LIST_KEYS:
+        (offsets, values) = _flatten([list(entry.get(key) or []) for entry in details], np.int64)
+        save('musics.' + key + '.offsets', offsets)
+        save('musics.' + key + '.values', values)
+
+    with open(os.path.join(tempPath, 'snapshot.json'), 'w') as f:
+        json.dump({'format': FORMAT, 'numRatings': len(catalog.scores), 'numMusics': len(musicIDs),
+                   'scalarValues': scalarValues, 'watermark': catalog.watermark}, f)
+
+    publishVersion(tempPath, directory)
+
+
+def newVersion(directory):
+    """A new, empty version directory next to directory, to be published with publishVersion."""
+    (parent, name) = os.path.split(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix="." + name + ".v-", dir=parent)
+
+
+def publishVersion(version, directory):
+    """
+    Make directory a symlink to the version directory, replacing its previous target with a single
+    os.replace: readers see either the old or the new version, never a missing or partial one.
+    The version it replaced is kept, for readers that resolved the link just before the swap;
+    older versions (and those left behind by interrupted writes) are deleted.
+    """
+    directory = os.path.abspath(directory)
+    (parent, name) = os.path.split(directory)
+    previous = os.path.realpath(directory) if os.path.islink(directory) else None
+    if os.path.isdir(directory) and previous is None:
+        # Written before versions existed: moved aside first, so this one swap leaves a short gap
+        previous = tempfile.mkdtemp(prefix="." + name + ".v-", dir=parent)
+        os.rmdir(previous)
+        os.rename(directory, previous)
+    link = version + ".link"
+    os.symlink(os.path.basename(version), link)
+    os.replace(link, directory)
+
+    for path in glob.glob(os.path.join(parent, "." + glob.escape(name) + ".v-*")):
+        if path not in (version, previous) and os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def loadSnapshot(directory, mmap=True):
+    """
+    Open a snapshot written by saveSnapshot() as a MusicCatalog. With mmap the arrays are read-only
+    views of the page cache, shared by every process that opens the same files.
+
+    Raises:
+        ValueError: the snapshot was written in another format version.
+    """
+    with open(os.path.join(directory, 'snapshot.json')) as f:
+        meta = json.load(f)
+    if meta['format'] != FORMAT:
+        raise ValueError("Catalog snapshot " + directory + " has format " + str(meta['format']) +
+                         ", expected " + str(FORMAT))
+
+    mode = 'r' if mmap else None
+
+    def load(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode)
+
+    musicIDs = load('musics.id')
+    names = _ColumnarNames(musicIDs, load('musics.name.offsets'), load('musics.name.values'), load('musics.name.null'))
+    details = _ColumnarDetails(musicIDs,
+                               {key: (load('musics.' + key), meta['scalarValues'][key]) for key in SCALAR_KEYS},
+                               {key: (load('musics.' + key + '.offsets'), load('musics.' + key + '.values'))
+                                for key in LIST_KEYS})
+    ratings = tuple(load('ratings.' + column) for column in RATING_COLUMNS)
+    return MusicCatalog.fromMappings(names, details, ratings, snapshotPath=directory,
+                                     watermark=meta.get('watermark'))
+
+
+def _flatten(lists, dtype):
+    """Offsets (len(lists) + 1) and concatenated values of a list of lists (or bytes)."""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(items) for items in lists])
+    values = np.zeros(int(offsets[-1]), dtype=dtype)
+    for (start, items) in zip(offsets[:-1], lists):
+        values[start:start + len(items)] = np.frombuffer(items, dtype=np.uint8) if isinstance(items, bytes) else items
+    return offsets, values
+
+
+class _ColumnarMapping(Mapping):
+    """Read-only mapping keyed by the sorted music IDs of a snapshot; values are built on access."""
+
+    def __init__(self, musicIDs):
+        self.musicIDs = musicIDs
+
+    def _row(self, musicID):
+        try:
+            row = int(np.searchsorted(self.musicIDs, musicID))
+        except TypeError:
+            raise KeyError(musicID)
+        if row >= len(self.musicIDs) or self.musicIDs[row] != musicID:
+            raise KeyError(musicID)
+        return row
+
+    def __iter__(self):
+        return iter(self.musicIDs.tolist())
+
+    def __len__(self):
+        return len(self.musicIDs)
+
+
+class _ColumnarNames(_ColumnarMapping):
+
+    def __init__(self, musicIDs, offsets, values, null):
+        super().__init__(musicIDs)
+        (self.offsets, self.values, self.null) = (offsets, values, null)
+
+    def __getitem__(self, musicID):
+        row = self._row(musicID)
+        if self.null[row]:
+            return None
+        return bytes(self.values[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+
+class _ColumnarDetails(_ColumnarMapping):
+
+    def __init__(self, musicIDs, scalars, lists):
+        super().__init__(musicIDs)
+        # {key: (codes, values)} and {key: (offsets, values)}
+        (self.scalars, self.lists) = (scalars, lists)
+
+    def __getitem__(self, musicID):
+        row = self._row(musicID)
+        details = {key: values[codes[row]] for (key, (codes, values)) in self.scalars.items()}
+        for (key, (offsets, values)) in self.lists.items():
+            details[key] = tuple(values[offsets[row]:offsets[row + 1]].tolist())
+        return MappingProxyType(details)
+
+    # Column access for code that reads one attribute of many songs (ContentSimilarity), without
+    # building a details dict per song
+
+    def rows(self, musicIDs):
+        """Row of each of musicIDs in the snapshot, -1 for the IDs it does not have."""
+        musicIDs = np.asarray(musicIDs, dtype=np.int64)
+        if len(self.musicIDs) == 0:
+            return np.full(len(musicIDs), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.musicIDs, musicIDs), len(self.musicIDs) - 1)
+        return np.where(self.musicIDs[rows] == musicIDs, rows, -1)
+
+    def scalarColumn(self, key, rows):
+        """Value of the scalar attribute key (nationality...) of each row, as a list."""
+        (codes, values) = self.scalars[key]
+        lookup = np.empty(len(values), dtype=object)
+        lookup[:] = values
+        return lookup[np.asarray(codes)[rows]].tolist()
+
+    def listColumn(self, key, rows):
+        """The lists of attribute key (genre_ids...) of the rows, CSR-style: (indptr, values)."""
+        (offsets, values) = self.lists[key]
+        (positions, counts) = rowPositions(np.asarray(offsets), rows)
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        return indptr, np.asarray(values)[positions]
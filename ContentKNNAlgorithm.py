@@ -2,38 +2,179 @@ from surprise import AlgoBase
 from surprise import PredictionImpossible
 import numpy as np
 import heapq
+import os
+import shutil
+import tempfile
+from scipy import sparse
+from ContentSimilarity import ContentSimilarity, ATTRIBUTE_WEIGHTS, catalogFingerprint
+from NeighborIndex import NeighborIndex
+from TrainsetArrays import TrainsetArrays, matchIDs, rowPositions
 
 class ContentKNNAlgorithm(AlgoBase):
 
-    def __init__(self, k=40, sim_options={}, musicRecommendation=None):
+    # Version of the on-disk neighbor index layout, part of the cache fingerprint
+    CACHE_FORMAT = 1
+
+    def __init__(self, k=40, sim_options={}, musicRecommendation=None, numNeighbors=200, cacheDir=None,
+                 maxCacheEntries=4, maxPostingLength=None, weights=None, storeComponents=False, lsh=None):
         super().__init__()
         self.k = k
+        # MusicCatalog (or MusicRecommendation after loadMusicData): only musicID_to_details is used
         self.musicRecommendation = musicRecommendation
+        # Number of most similar items kept per item (None keeps every positive similarity)
+        self.numNeighbors = numNeighbors
+        # Genres, artists... shared by more songs than this are not used to find candidate neighbors
+        # (None keeps the result exact)
+        self.maxPostingLength = maxPostingLength
+        # Directory of memory-mapped neighbor indexes keyed by catalog fingerprint (None disables it)
+        self.cacheDir = cacheDir
+        self.maxCacheEntries = maxCacheEntries
+        # Attribute weights, see ContentSimilarity.ATTRIBUTE_WEIGHTS
+        self.weights = dict(ATTRIBUTE_WEIGHTS if weights is None else weights)
+        # Keep the weight-independent similarity components so that reweight() is cheap
+        self.storeComponents = storeComponents
+        # Opt-in approximate candidates for very large catalogs, e.g. MinHashLSH(numBands=16, rowsPerBand=4)
+        # (see MinHashLSH.recallReport to pick the settings)
+        self.lsh = lsh
+        self.engine = None
 
     def fit(self, trainset):
         super().fit(trainset)
 
-        # Compute item similarity matrix based on music attributes
-        print("Computing content-based similarity matrix...")
+        # Compute the top-M neighbors of every item based on music attributes
+        print("Computing content-based neighbor index...")
+
+        self.musicIDs = [self.trainset.to_raw_iid(iid) for iid in range(self.trainset.n_items)]
+        self.ratingArrays = TrainsetArrays(trainset)
+        self.engine = None
+        if not self._loadCachedNeighbors():
+            self.engine = self._buildEngine(self.storeComponents)
+            self._buildNeighbors()
+
+        print("...done.")
+        return self
+
+    def reweight(self, weights):
+        """
+        Đổi trọng số các thuộc tính và dựng lại chỉ mục láng giềng từ các thành phần tương đồng
+        đã lưu (giao của từng thuộc tính), không phải tính lại độ tương đồng từ đầu.
+        Lần gọi đầu tiên sẽ tính các thành phần nếu fit() chưa lưu chúng (storeComponents=False).
+
+        Args:
+            weights (dict): Trọng số mới, cùng khóa với ATTRIBUTE_WEIGHTS.
+        """
+        self.weights = dict(weights)
+        print("Reweighting content-based neighbor index...")
+        if not self._loadCachedNeighbors():
+            if self.engine is None or self.engine.components is None:
+                self.engine = self._buildEngine(storeComponents=True)
+            self.engine.setWeights(self.weights)
+            self._buildNeighbors()
+        print("...done.")
+        return self
 
-        self.similarities = np.zeros((self.trainset.n_items, self.trainset.n_items))
+    def updateItems(self, trainset, changedMusicIDs):
+        """
+        Cập nhật chỉ mục láng giềng sau khi thêm, xóa hoặc sửa thuộc tính một số bài hát,
+        thay vì tính lại toàn bộ như fit(). Kết quả giống hệt một lần fit() đầy đủ.
 
-        for thisRating in range(self.trainset.n_items):
-            if thisRating % 100 == 0:
-                print(thisRating, " of ", self.trainset.n_items)
+        Args:
+            trainset: Trainset mới; thứ tự inner ID của bài hát có thể khác lần fit trước.
+            changedMusicIDs (set): Các music ID đã thay đổi trong musicRecommendation.musicID_to_details
+                (xem ContentSimilarity.changedMusicIDs). Bài hát mới vào hoặc rời khỏi trainset
+                được tự động coi là đã thay đổi.
+        """
+        oldMusicIDs = self.musicIDs
+        AlgoBase.fit(self, trainset)
 
-            for otherRating in range(thisRating + 1, self.trainset.n_items):
-                thisMusicID = self.trainset.to_raw_iid(thisRating)
-                otherMusicID = self.trainset.to_raw_iid(otherRating)
+        print("Updating content-based neighbor index...")
+        self.musicIDs = [self.trainset.to_raw_iid(iid) for iid in range(self.trainset.n_items)]
+        self.ratingArrays = TrainsetArrays(trainset)
+        # The stored components describe the old catalog; reweight() recomputes them when needed
+        self.engine = self._buildEngine(storeComponents=False)
+        self.neighbors = self.neighbors.update(oldMusicIDs, changedMusicIDs, self.engine, self.numNeighbors)
 
-                # Calculate similarity based on custom attributes
-                similarity = self.computeSimilarity(thisMusicID, otherMusicID)
-                self.similarities[thisRating, otherRating] = similarity
-                self.similarities[otherRating, thisRating] = similarity
+        cachePath = self._cachePath("content", self.numNeighbors)
+        if cachePath and not os.path.isdir(cachePath):
+            self._saveToCache(cachePath, self.neighbors.save)
+            self.neighbors = NeighborIndex.load(cachePath)
 
         print("...done.")
         return self
 
+    def _buildEngine(self, storeComponents):
+        details = self.musicRecommendation.musicID_to_details
+        if not storeComponents:
+            return self._newEngine(details)
+
+        componentsPath = self._cachePath("components")
+        if componentsPath and os.path.isdir(componentsPath):
+            print("Reusing cached similarity components ", componentsPath)
+            os.utime(componentsPath)
+            return ContentSimilarity.loadComponents(componentsPath, self.weights)
+
+        engine = self._newEngine(details).storeComponents()
+        if componentsPath:
+            self._saveToCache(componentsPath, engine.saveComponents)
+            engine = ContentSimilarity.loadComponents(componentsPath, self.weights)
+        return engine
+
+    def _newEngine(self, details):
+        engine = ContentSimilarity(details, self.musicIDs, self.weights, self.maxPostingLength)
+        if self.lsh is not None:
+            engine.useLSH(self.lsh)
+        return engine
+
+    def _loadCachedNeighbors(self):
+        cachePath = self._cachePath("content", self.numNeighbors)
+        if not (cachePath and os.path.isdir(cachePath)):
+            return False
+        print("Reusing cached neighbor index ", cachePath)
+        os.utime(cachePath)
+        self.neighbors = NeighborIndex.load(cachePath)
+        return True
+
+    def _buildNeighbors(self):
+        self.neighbors = NeighborIndex.build(self.engine, self.numNeighbors)
+        print("Neighbor index size: ", self.neighbors.nbytes(), " bytes")
+
+        cachePath = self._cachePath("content", self.numNeighbors)
+        if cachePath:
+            self._saveToCache(cachePath, self.neighbors.save)
+            self.neighbors = NeighborIndex.load(cachePath)
+
+    def _cachePath(self, kind, *extra):
+        """Cache entry for the current item order and catalog; the neighbor index also depends on the weights."""
+        if not self.cacheDir:
+            return None
+        weights = sorted(self.weights.items()) if kind == "content" else None
+        fingerprint = catalogFingerprint(self.musicRecommendation.musicID_to_details, self.musicIDs, self.CACHE_FORMAT,
+                                         kind, weights, self.maxPostingLength, repr(self.lsh), *extra)
+        return os.path.join(self.cacheDir, kind + "-" + fingerprint)
+
+    def _saveToCache(self, cachePath, save):
+        """
+        Ghi một mục cache bằng hàm save(thư mục). Ghi vào thư mục tạm rồi đổi tên,
+        để các tiến trình khác không bao giờ đọc phải bản ghi dở.
+        """
+        os.makedirs(self.cacheDir, exist_ok=True)
+        kind = os.path.basename(cachePath).split("-")[0]
+        tempPath = tempfile.mkdtemp(prefix="." + kind + "-", dir=self.cacheDir)
+        save(tempPath)
+        try:
+            os.rename(tempPath, cachePath)
+        except OSError:
+            # Another worker stored the same fingerprint first
+            shutil.rmtree(tempPath, ignore_errors=True)
+
+        # Keep only the most recent entries of this kind
+        entries = [os.path.join(self.cacheDir, name) for name in os.listdir(self.cacheDir)
+                   if name.startswith(kind + "-")]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for stale in entries[self.maxCacheEntries:]:
+            if stale != cachePath:
+                shutil.rmtree(stale, ignore_errors=True)
+
     def computeSimilarity(self, music_id1, music_id2):
         """
         Tính toán độ tương đồng giữa hai bài hát dựa trên các thuộc tính của chúng.
@@ -55,15 +196,8 @@ class ContentKNNAlgorithm(AlgoBase):
         if not details1 or not details2:
             return 0.0 # Trả về 0 nếu một trong hai bài hát không có thông tin
 
-        # --- Định nghĩa trọng số cho từng thuộc tính (tổng bằng 1.0) ---
-        weights = {
-            'genres': 0.4,
-            'artists': 0.3,
-            'categories': 0.1,
-            'periods': 0.1,
-            'nationality': 0.05,
-            'contributor': 0.05
-        }
+        # Trọng số cho từng thuộc tính (tổng bằng 1.0), dùng chung với ContentSimilarity
+        weights = self.weights
 
         total_similarity = 0.0
 
@@ -121,11 +255,13 @@ class ContentKNNAlgorithm(AlgoBase):
         if not (self.trainset.knows_user(u) and self.trainset.knows_item(i)):
             raise PredictionImpossible('User and/or item is unknown.')
 
-        # Build up similarity scores between this item and everything the user rated
-        neighbors = []
-        for rating in self.trainset.ur[u]:
-            similarity = self.similarities[i, rating[0]]
-            neighbors.append((similarity, rating[1]))
+        # Build up similarity scores between this item and everything the user rated.
+        # Items outside the neighbor index of i have no positive similarity and never count.
+        userRatings = self.trainset.ur[u]
+        ratedItems = np.fromiter((j for (j, _) in userRatings), dtype=np.int64, count=len(userRatings))
+        similarities = self.neighbors.lookup(i, ratedItems).tolist()
+        neighbors = [(similarity, rating[1]) for (similarity, rating) in zip(similarities, userRatings)
+                     if similarity > 0]
 
         # Extract the top-K most-similar ratings
         k_neighbors = heapq.nlargest(self.k, neighbors, key=lambda t: t[0])
@@ -143,3 +279,146 @@ class ContentKNNAlgorithm(AlgoBase):
         predictedRating = weightedSum / simTotal
 
         return predictedRating
+
+    def estimateBlock(self, users, items=None):
+        """
+        Dự đoán cho cả một khối người dùng x bài hát (inner ID) trong một lần, cho kết quả giống hệt
+        estimate() từng cặp. Ô nào estimate() sẽ ném PredictionImpossible thì có giá trị NaN.
+
+        Với mỗi người dùng chỉ đọc các cột của chỉ mục láng giềng ứng với bài hát họ đã nghe,
+        chọn top-k theo từng bài hát và cộng dồn theo đúng thứ tự của heapq.nlargest.
+
+        Args:
+            users (array): Inner ID của các người dùng.
+            items (array): Inner ID của các bài hát (mặc định: tất cả).
+
+        Returns:
+            np.ndarray: Ma trận float64 len(users) x len(items).
+        """
+        users = np.asarray(users, dtype=np.int64)
+        n_items = self.trainset.n_items
+        items = np.arange(n_items) if items is None else np.asarray(items, dtype=np.int64)
+        estimates = np.full((len(users), len(items)), np.nan)
+
+        knownItems = (items >= 0) & (items < n_items)
+        (blockItems, inverse) = np.unique(items[knownItems], return_inverse=True)
+        blockColumn = np.full(n_items, -1, dtype=np.int64)
+        blockColumn[blockItems] = np.arange(len(blockItems))
+
+        # Row j of the transposed index lists the items that have j among their neighbors
+        values = self._estimateTargets(users, self._neighborColumns(), blockColumn, len(blockItems))
+        estimates[:, knownItems] = values[:, inverse]
+        return estimates
+
+    def _estimateTargets(self, users, columns, blockColumn, numTargets):
+        """
+        Phần chung của estimateBlock(): columns là chỉ mục láng giềng đã chuyển vị (hàng j liệt kê các
+        bài hát nhận j làm láng giềng), blockColumn[i] là cột kết quả của bài hát i (-1 nếu bỏ qua).
+        """
+        estimates = np.full((len(users), numTargets), np.nan)
+        for (row, u) in enumerate(users):
+            if not self.trainset.knows_user(int(u)):
+                continue
+            ratedItems = self.ratingArrays.userItems(u)
+            ratings = self.ratingArrays.userRatings(u)
+            # Read the columns of the rated items straight from the CSR arrays, keeping only the requested targets
+            (entries, counts) = rowPositions(columns.indptr, ratedItems)
+            positions = np.repeat(np.arange(len(ratedItems)), counts)
+            targets = blockColumn[columns.indices[entries]]
+            requested = targets >= 0
+            (positions, targets) = (positions[requested], targets[requested])
+            similarities = columns.data[entries[requested]].astype(np.float64)
+
+            # Per target item: largest similarities first, ties in trainset.ur order like heapq.nlargest
+            order = np.lexsort((positions, -similarities, targets))
+            (positions, targets, similarities) = (positions[order], targets[order], similarities[order])
+            starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]]) if len(targets) else np.zeros(0, dtype=np.int64)
+            rank = np.arange(len(targets)) - np.repeat(starts, np.diff(np.r_[starts, len(targets)]))
+            kept = rank < self.k
+
+            # bincount adds the weights one by one in array order, like the loop in estimate()
+            simTotal = np.bincount(targets[kept], weights=similarities[kept], minlength=numTargets)
+            weightedSum = np.bincount(targets[kept], weights=similarities[kept] * ratings[positions[kept]],
+                                      minlength=numTargets)
+            np.divide(weightedSum, simTotal, out=estimates[row], where=simTotal != 0)
+
+        return estimates
+
+    def _neighborColumns(self):
+        if getattr(self, '_columnsOf', None) is not self.neighbors:
+            self._columns = self.neighbors.toCSR().T.tocsr()
+            self._columns.sort_indices()
+            self._columnsOf = self.neighbors
+        return self._columns
+
+    def scoreState(self):
+        """Chỉ mục láng giềng theo music ID gốc, để lần chạy sau biết hàng nào đã đổi (xem IncrementalRecommender)."""
+        (indptr, neighborIDs, similarities) = self._rawNeighborRows()
+        return {'musicIDs': np.asarray(self.musicIDs, dtype=np.int64), 'indptr': indptr,
+                'neighborIDs': neighborIDs, 'similarities': similarities}
+
+    def changedItems(self, state, users):
+        """
+        Điểm của người dùng u cho bài hát i chỉ phụ thuộc vào rating của u và hàng láng giềng của i,
+        nên khi rating của u không đổi, điểm (u, i) chỉ đổi nếu u đã nghe một láng giềng có mặt hay độ
+        tương đồng khác nhau giữa hàng mới của i và hàng cũ trong state (xem scoreState()).
+
+        Returns:
+            tuple: (indptr, items) kiểu CSR, items[indptr[r]:indptr[r + 1]] là inner ID các bài hát
+                (đã có trong state) mà điểm của users[r] có thể đã đổi.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        musicIDs = np.asarray(self.musicIDs, dtype=np.int64)
+        (indptr, neighborIDs, similarities) = self._rawNeighborRows()
+        (oldIndptr, oldNeighborIDs, oldSimilarities) = (state['indptr'], state['neighborIDs'], state['similarities'])
+        oldRows = matchIDs(state['musicIDs'], musicIDs)
+        common = np.flatnonzero(oldRows >= 0)
+
+        # Hàng khác độ dài chắc chắn đã đổi; các hàng cùng độ dài được so sánh từng phần tử
+        sameLength = np.diff(indptr)[common] == np.diff(oldIndptr)[oldRows[common]]
+        candidates = common[sameLength]
+        (positions, counts) = rowPositions(indptr, candidates)
+        (oldPositions, _) = rowPositions(oldIndptr, oldRows[candidates])
+        differs = ((neighborIDs[positions] != oldNeighborIDs[oldPositions]) |
+                   (similarities[positions] != oldSimilarities[oldPositions]))
+        rowDiffers = np.bincount(np.repeat(np.arange(len(candidates)), counts), weights=differs,
+                                 minlength=len(candidates)) > 0
+        changed = np.concatenate([common[~sameLength], candidates[rowDiffers]])
+
+        # Các phần tử (hàng, láng giềng, độ tương đồng) của hàng mới và hàng cũ của các bài hát đã đổi
+        (positions, counts) = rowPositions(indptr, changed)
+        (oldPositions, oldCounts) = rowPositions(oldIndptr, oldRows[changed])
+        rows = np.concatenate([np.repeat(changed, counts), np.repeat(changed, oldCounts)])
+        neighbors = np.concatenate([neighborIDs[positions], oldNeighborIDs[oldPositions]])
+        values = np.concatenate([similarities[positions], oldSimilarities[oldPositions]])
+        # Một phần tử giống hệt nhau ở cả hai hàng xuất hiện đúng hai lần liên tiếp sau khi sắp xếp
+        order = np.lexsort((values, neighbors, rows))
+        (rows, neighbors, values) = (rows[order], neighbors[order], values[order])
+        same = (rows[1:] == rows[:-1]) & (neighbors[1:] == neighbors[:-1]) & (values[1:] == values[:-1])
+        unchanged = np.zeros(len(rows), dtype=bool)
+        unchanged[1:] |= same
+        unchanged[:-1] |= same
+        (rows, neighbors) = (rows[~unchanged], matchIDs(musicIDs, neighbors[~unchanged]))
+        # Láng giềng đã rời trainset thì không ai còn rating của nó
+        (rows, neighbors) = (rows[neighbors >= 0], neighbors[neighbors >= 0])
+
+        n_items = self.trainset.n_items
+        differing = sparse.csr_matrix((np.ones(len(rows)), (neighbors, rows)), shape=(n_items, n_items))
+        (ratedPositions, ratedCounts) = rowPositions(self.ratingArrays.indptr, users)
+        rated = sparse.csr_matrix((np.ones(len(ratedPositions)), self.ratingArrays.items[ratedPositions],
+                                   np.r_[0, np.cumsum(ratedCounts)]), shape=(len(users), n_items))
+        touched = (rated @ differing).tocsr()
+        touched.sort_indices()
+        return touched.indptr.astype(np.int64), touched.indices.astype(np.int64)
+
+    def scoreDrift(self, state, users):
+        """Ngoài các ô của changedItems(), điểm của người dùng có rating không đổi giữ nguyên."""
+        return np.zeros(len(users))
+
+    def _rawNeighborRows(self):
+        """Các hàng láng giềng theo music ID gốc, mỗi hàng sắp theo ID gốc để không phụ thuộc cách đánh inner ID."""
+        musicIDs = np.asarray(self.musicIDs, dtype=np.int64)
+        indptr = np.asarray(self.neighbors.indptr, dtype=np.int64)
+        neighborIDs = musicIDs[self.neighbors.indices]
+        order = np.lexsort((neighborIDs, np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))))
+        return indptr, neighborIDs[order], np.asarray(self.neighbors.data)[order]
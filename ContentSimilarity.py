@@ -0,0 +1,560 @@
+import hashlib
+import itertools
+import json
+import os
+import zlib
+import numpy as np
+from scipy import sparse
+from NeighborIndex import rankOf, selectTopNeighbors
+
+# Attribute weights of the content similarity (sum to 1.0). The order is the order in which
+# ContentKNNAlgorithm.computeSimilarity accumulates the terms, which keeps both paths bit-identical.
+ATTRIBUTE_WEIGHTS = {
+    'genres': 0.4,
+    'artists': 0.3,
+    'categories': 0.1,
+    'periods': 0.1,
+    'nationality': 0.05,
+    'contributor': 0.05
+}
+
+# Multi-valued attributes, compared with the Jaccard index
+SET_ATTRIBUTES = [('genres', 'genre_ids'), ('artists', 'artist_ids'),
+                  ('categories', 'category_ids'), ('periods', 'period_ids')]
+
+# Single-valued attributes, compared with an exact match
+VALUE_ATTRIBUTES = [('nationality', 'nationality'), ('contributor', 'contributor_id')]
+
+
+class ContentSimilarity:
+    """
+    Matrix form of ContentKNNAlgorithm.computeSimilarity.
+
+    Every attribute is encoded once as a sparse one-hot item x attribute-value matrix, so the
+    intersections of all pairs come from a single sparse product and the unions from the
+    per-item value counts (|A u B| = |A| + |B| - |A n B|).
+
+    The transposed matrices double as an inverted index (attribute value -> items), which
+    neighborRows() uses to score only the pairs that share something.
+
+    The weights only enter the final linear combination. storeComponents() keeps the
+    per-attribute intersection sizes of every candidate pair, after which setWeights() plus a new
+    neighbor index cost no sparse product at all.
+
+    useLSH() swaps the inverted index for MinHash/LSH candidates (see MinHashLSH), which bounds
+    the work per item on very large catalogs at the cost of missing a few true neighbors.
+    """
+
+    # Version of the saveComponents() layout
+    COMPONENTS_FORMAT = 1
+
+    def __init__(self, musicID_to_details, musicIDs, weights=None, maxPostingLength=None):
+        self.musicIDs = list(musicIDs)
+        self.n_items = len(self.musicIDs)
+        self.weights = dict(ATTRIBUTE_WEIGHTS if weights is None else weights)
+        # Multi-valued attribute values shared by more items than this do not generate candidates
+        self.maxPostingLength = maxPostingLength
+
+        self.incidence = {}
+        self.valueHashes = {}
+        # repr() of the value of every column, see cappedValues()
+        self.valueKeys = {}
+        for (name, key) in SET_ATTRIBUTES:
+            (self.incidence[name], self.valueHashes[name], self.valueKeys[name]) = \
+                self._encode(musicID_to_details, key, multiValued=True)
+        for (name, key) in VALUE_ATTRIBUTES:
+            (self.incidence[name], self.valueHashes[name], self.valueKeys[name]) = \
+                self._encode(musicID_to_details, key, multiValued=False)
+
+        self.components = None
+        self._setup()
+
+    def _setup(self):
+        self.lshCandidates = None
+        self.tieRank = rankOf(self.musicIDs)
+        self.counts = {}
+        for (name, _) in SET_ATTRIBUTES:
+            self.counts[name] = np.asarray(self.incidence[name].sum(axis=1), dtype=np.float64).ravel()
+        self._buildInvertedIndex()
+
+    def setWeights(self, weights):
+        self.weights = dict(weights)
+
+    def useLSH(self, lsh):
+        """
+        Take the candidate pairs from MinHash/LSH banding instead of the inverted index. Candidates
+        still get their exact similarity; the pairs LSH misses only keep their single-valued terms.
+        """
+        self.lshCandidates = lsh.candidates(self)
+        return self
+
+    def storeComponents(self, blockSize=256):
+        """
+        Compute once the candidate pairs of every item and their intersection size for each
+        multi-valued attribute, stored CSR-style with the smallest unsigned type that fits.
+        The single-valued matches need no storage: they come from one code per item.
+        """
+        indptr = np.zeros(self.n_items + 1, dtype=np.int64)
+        indices = []
+        intersections = []
+        for start in range(0, self.n_items, blockSize):
+            rows = np.arange(start, min(start + blockSize, self.n_items))
+            (_, pairCols, offsets, blockIntersections) = self._candidatePairs(rows)
+            indptr[rows + 1] = indptr[start] + offsets[1:]
+            indices.append(pairCols.astype(np.int32))
+            intersections.append(np.stack([blockIntersections[name] for (name, _) in SET_ATTRIBUTES], axis=1))
+
+        largest = max([int(self.counts[name].max()) if self.n_items else 0 for (name, _) in SET_ATTRIBUTES])
+        dtype = np.min_scalar_type(largest) if largest > 0 else np.uint8
+        self.components = {
+            'indptr': indptr,
+            'indices': np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+            'intersections': (np.concatenate(intersections) if intersections
+                              else np.zeros((0, len(SET_ATTRIBUTES)))).astype(dtype)
+        }
+        return self
+
+    def saveComponents(self, directory):
+        """
+        Lưu các thành phần tương đồng (không phụ thuộc trọng số) ra thư mục, dạng .npy có thể mmap.
+        """
+        os.makedirs(directory, exist_ok=True)
+        arrays = dict(self.components)
+        arrays['musicIDs'] = np.asarray(self.musicIDs)
+        for (name, _) in SET_ATTRIBUTES + VALUE_ATTRIBUTES:
+            arrays[name + '.indptr'] = self.incidence[name].indptr
+            arrays[name + '.indices'] = self.incidence[name].indices
+        for (name, array) in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+        with open(os.path.join(directory, 'components.json'), 'w') as f:
+            json.dump({'format': self.COMPONENTS_FORMAT, 'maxPostingLength': self.maxPostingLength,
+                       'shapes': {name: list(self.incidence[name].shape)
+                                  for (name, _) in SET_ATTRIBUTES + VALUE_ATTRIBUTES}}, f)
+
+    @classmethod
+    def loadComponents(cls, directory, weights=None, mmap=True):
+        """
+        Mở lại các thành phần đã lưu bằng saveComponents() và áp dụng bộ trọng số mới (mặc định
+        ATTRIBUTE_WEIGHTS) mà không cần dữ liệu catalog hay tính lại tích ma trận thưa.
+        """
+        mode = 'r' if mmap else None
+
+        def load(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode)
+
+        with open(os.path.join(directory, 'components.json')) as f:
+            meta = json.load(f)
+        engine = cls.__new__(cls)
+        engine.musicIDs = load('musicIDs').tolist()
+        engine.n_items = len(engine.musicIDs)
+        engine.weights = dict(ATTRIBUTE_WEIGHTS if weights is None else weights)
+        engine.maxPostingLength = meta['maxPostingLength']
+        engine.incidence = {}
+        engine.valueHashes = None
+        engine.valueKeys = None
+        for (name, _) in SET_ATTRIBUTES + VALUE_ATTRIBUTES:
+            (indptr, indices) = (np.asarray(load(name + '.indptr')), np.asarray(load(name + '.indices')))
+            engine.incidence[name] = sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                                                       shape=tuple(meta['shapes'][name]))
+        engine.components = {name: load(name) for name in ('indptr', 'indices', 'intersections')}
+        engine._setup()
+        return engine
+
+    def _buildInvertedIndex(self):
+        """
+        Posting lists used to find the items worth scoring against a given item.
+
+        Multi-valued attributes generate candidate pairs through the item x value matrices, minus the
+        values whose posting list is longer than maxPostingLength.
+
+        Single-valued attributes (nationality, contributor) are special-cased: a dominant nationality
+        alone would make most pairs candidates. Items sharing exactly the same combination of these
+        values all get the same similarity with an item that shares nothing else with them, so each
+        combination keeps its items sorted by tie rank and only the first numNeighbors of a list can
+        ever make it into a row.
+        """
+        self.uncapped = {}
+        self.capped = {}
+        self.tooLong = {}
+        for (name, _) in SET_ATTRIBUTES:
+            incidence = self.incidence[name]
+            self.uncapped[name] = incidence
+            self.capped[name] = None
+            self.tooLong[name] = np.zeros(incidence.shape[1], dtype=bool)
+            if self.maxPostingLength is not None:
+                postingLengths = np.asarray(incidence.sum(axis=0)).ravel()
+                tooLong = postingLengths > self.maxPostingLength
+                self.tooLong[name] = tooLong
+                if tooLong.any():
+                    self.uncapped[name] = incidence[:, np.flatnonzero(~tooLong)]
+                    self.capped[name] = incidence[:, np.flatnonzero(tooLong)]
+        self.candidateIncidence = sparse.hstack([self.uncapped[name] for (name, _) in SET_ATTRIBUTES], format='csr')
+
+        self.codes = {}
+        for (name, _) in VALUE_ATTRIBUTES:
+            incidence = self.incidence[name]
+            code = np.full(self.n_items, -1, dtype=np.int64)
+            code[np.diff(incidence.indptr) > 0] = incidence.indices
+            self.codes[name] = code
+
+        # For every combination of single-valued attributes: the [start, end) slice of each item's list
+        self.postings = []
+        for size in range(1, len(VALUE_ATTRIBUTES) + 1):
+            for subset in itertools.combinations([name for (name, _) in VALUE_ATTRIBUTES], size):
+                key = np.zeros(self.n_items, dtype=np.int64)
+                valid = np.ones(self.n_items, dtype=bool)
+                for name in subset:
+                    key = key * self.incidence[name].shape[1] + self.codes[name]
+                    valid &= self.codes[name] >= 0
+                items = np.flatnonzero(valid)
+                items = items[np.lexsort((self.tieRank[items], key[items]))]
+                (keys, starts, counts) = np.unique(key[items], return_index=True, return_counts=True)
+                start = np.zeros(self.n_items, dtype=np.int64)
+                end = np.zeros(self.n_items, dtype=np.int64)
+                position = np.searchsorted(keys, key[items])
+                start[items] = starts[position]
+                end[items] = starts[position] + counts[position]
+                self.postings.append((items, start, end))
+
+    def cappedValues(self):
+        """
+        The multi-valued attribute values whose posting list is over maxPostingLength, as a set of
+        (attribute, repr(value)). None when the values are unknown (engine from loadComponents()).
+        """
+        if self.maxPostingLength is None:
+            return set()
+        if self.valueKeys is None:
+            return None
+        return {(name, self.valueKeys[name][column])
+                for (name, _) in SET_ATTRIBUTES for column in np.flatnonzero(self.tooLong[name])}
+
+    def valueHolders(self, values):
+        """Rows of the items that have any of the given (attribute, repr(value)) pairs."""
+        holders = np.zeros(self.n_items, dtype=bool)
+        for (name, _) in SET_ATTRIBUTES:
+            columns = [column for (column, key) in enumerate(self.valueKeys[name]) if (name, key) in values]
+            if columns:
+                holders |= np.asarray(self.incidence[name][:, columns].sum(axis=1)).ravel() > 0
+        return np.flatnonzero(holders)
+
+    def _encode(self, musicID_to_details, key, multiValued):
+        """One-hot item x value matrix, plus a stable hash and the repr() of each value (column)."""
+        (rows, values) = attributeEntries(musicID_to_details, self.musicIDs, key, multiValued)
+        codes = {}
+        cols = [codes.setdefault(value, len(codes)) for value in values]
+
+        data = np.ones(len(rows), dtype=np.float64)
+        hashes = np.zeros(max(len(codes), 1), dtype=np.int64)
+        for (value, code) in codes.items():
+            hashes[code] = zlib.crc32(repr(value).encode('utf-8'))
+        return (sparse.csr_matrix((data, (rows, cols)), shape=(self.n_items, max(len(codes), 1))), hashes,
+                [repr(value) for value in codes])
+
+    def computeRows(self, rows):
+        """
+        Similarity of the given item rows against every item, as a dense float64 block.
+        The diagonal (an item against itself) is left at 0, like the scalar fill loop.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        total = np.zeros((len(rows), self.n_items))
+
+        for (name, _) in SET_ATTRIBUTES:
+            incidence = self.incidence[name]
+            intersection = (incidence[rows] @ incidence.T).toarray()
+            union = self.counts[name][rows][:, None] + self.counts[name][None, :] - intersection
+            jaccard = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+            total += self.weights[name] * jaccard
+
+        for (name, _) in VALUE_ATTRIBUTES:
+            incidence = self.incidence[name]
+            match = (incidence[rows] @ incidence.T).toarray()
+            total += self.weights[name] * match
+
+        total[np.arange(len(rows)), rows] = 0.0
+        return total
+
+    def neighborRows(self, rows, numNeighbors):
+        """
+        Top numNeighbors neighbors (by similarity, then tie rank) of each of the given rows, scoring
+        only candidates from the inverted index plus the head of each single-valued posting list.
+        Without a posting cap the result equals a top-M selection over the full similarity rows.
+
+        Returns:
+            list: (indices, similarities) per row, as returned by selectTopNeighbors.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        (pairRows, pairCols, offsets, intersections) = self._candidatePairs(rows)
+        pairSimilarities = self._score(pairRows, pairCols, intersections)
+
+        isCandidate = np.zeros(self.n_items, dtype=bool)
+        backgroundRows = []
+        backgroundCols = []
+        for (local, row) in enumerate(rows):
+            candidates = pairCols[offsets[local]:offsets[local + 1]]
+            isCandidate[candidates] = True
+            isCandidate[row] = True
+            extra = []
+            for (items, start, end) in self.postings:
+                posting = items[start[row]:end[row]]
+                if numNeighbors is not None:
+                    posting = posting[:numNeighbors + len(candidates) + 1]
+                posting = posting[~isCandidate[posting]]
+                extra.append(posting if numNeighbors is None else posting[:numNeighbors])
+            isCandidate[candidates] = False
+            isCandidate[row] = False
+            extra = np.unique(np.concatenate(extra)) if extra else np.zeros(0, dtype=np.int64)
+            backgroundRows.append(np.full(len(extra), local, dtype=np.int64))
+            backgroundCols.append(extra)
+        backgroundRows = np.concatenate(backgroundRows)
+        backgroundCols = np.concatenate(backgroundCols)
+        backgroundSimilarities = self._score(rows[backgroundRows], backgroundCols, None)
+        backgroundOffsets = np.searchsorted(backgroundRows, np.arange(len(rows) + 1))
+
+        result = []
+        for local in range(len(rows)):
+            (start, end) = (offsets[local], offsets[local + 1])
+            (bgStart, bgEnd) = (backgroundOffsets[local], backgroundOffsets[local + 1])
+            indices = np.concatenate([pairCols[start:end], backgroundCols[bgStart:bgEnd]])
+            similarities = np.concatenate([pairSimilarities[start:end], backgroundSimilarities[bgStart:bgEnd]])
+            result.append(selectTopNeighbors(indices, similarities, numNeighbors, self.tieRank))
+        return result
+
+    def _candidatePairs(self, rows):
+        """
+        Pairs (row, item) sharing at least one uncapped multi-valued attribute value, grouped by row,
+        with their per-attribute intersection sizes.
+
+        The intersections come straight from the per-attribute sparse products: every product entry
+        is a candidate pair, found in the sorted candidate list by its (row, item) key.
+
+        Returns:
+            (pairRows, pairCols, offsets, intersections): pairs of rows[local] are at
+            offsets[local]:offsets[local + 1]; intersections maps attribute name -> sizes.
+        """
+        if self.components is not None:
+            return self._storedCandidatePairs(rows)
+        if self.lshCandidates is not None:
+            return self._lshCandidatePairs(rows)
+
+        structure = (self.candidateIncidence[rows] @ self.candidateIncidence.T).tocsr()
+        structure.sort_indices()
+        counts = np.diff(structure.indptr)
+        localRows = np.repeat(np.arange(len(rows), dtype=np.int64), counts)
+        pairCols = structure.indices.astype(np.int64)
+        keep = rows[localRows] != pairCols
+        (localRows, pairCols) = (localRows[keep], pairCols[keep])
+        pairRows = rows[localRows]
+        pairKeys = localRows * self.n_items + pairCols
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(localRows, minlength=len(rows)))
+
+        intersections = {}
+        for (name, _) in SET_ATTRIBUTES:
+            product = (self.uncapped[name][rows] @ self.uncapped[name].T).tocoo()
+            keys = product.row.astype(np.int64) * self.n_items + product.col
+            positions = np.minimum(np.searchsorted(pairKeys, keys), max(len(pairKeys) - 1, 0))
+            found = pairKeys[positions] == keys if len(pairKeys) else np.zeros(len(keys), dtype=bool)
+            intersection = np.zeros(len(pairKeys))
+            intersection[positions[found]] = product.data[found]
+            if self.capped[name] is not None:
+                capped = self.capped[name]
+                intersection += np.asarray(capped[pairRows].multiply(capped[pairCols]).sum(axis=1)).ravel()
+            intersections[name] = intersection
+        return pairRows, pairCols, offsets, intersections
+
+    def _storedCandidatePairs(self, rows):
+        """_candidatePairs() read from the arrays of storeComponents()."""
+        indptr = self.components['indptr']
+        starts = indptr[rows]
+        counts = indptr[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        positions = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        pairRows = np.repeat(rows, counts)
+        pairCols = self.components['indices'][positions].astype(np.int64)
+        stored = self.components['intersections'][positions]
+        intersections = {}
+        for (column, (name, _)) in enumerate(SET_ATTRIBUTES):
+            intersections[name] = stored[:, column].astype(np.float64)
+        return pairRows, pairCols, offsets, intersections
+
+    def _lshCandidatePairs(self, rows):
+        """_candidatePairs() for the pairs found by useLSH()."""
+        structure = self.lshCandidates[rows]
+        counts = np.diff(structure.indptr)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        pairRows = np.repeat(rows, counts)
+        pairCols = structure.indices.astype(np.int64)
+        return pairRows, pairCols, offsets, self._intersections(pairRows, pairCols)
+
+    def effectiveRows(self, rows):
+        """
+        Dense rows of the similarity that neighborRows() ranks by: exact for candidate pairs,
+        single-valued attributes only for pairs that share nothing but capped values (or that
+        LSH did not pair up). Equal to computeRows() when maxPostingLength is None and LSH is off.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        total = np.zeros((len(rows), self.n_items))
+        for (name, _) in VALUE_ATTRIBUTES:
+            code = self.codes[name]
+            match = (code[rows][:, None] == code[None, :]) & (code[None, :] >= 0)
+            total += self.weights[name] * match
+
+        (pairRows, pairCols, offsets, intersections) = self._candidatePairs(rows)
+        localRows = np.repeat(np.arange(len(rows)), np.diff(offsets))
+        total[localRows, pairCols] = self._score(pairRows, pairCols, intersections)
+        total[np.arange(len(rows)), rows] = 0.0
+        return total
+
+    def effectivePairs(self, rows, cols):
+        """Pairwise version of effectiveRows()."""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        if self.lshCandidates is not None:
+            shared = np.asarray(self.lshCandidates[rows, cols]).ravel() if len(rows) else np.zeros(0, dtype=bool)
+        else:
+            shared = np.asarray(self.candidateIncidence[rows].multiply(self.candidateIncidence[cols]).sum(axis=1)).ravel() > 0
+        total = self._score(rows, cols, None)
+        total[shared] = self.computePairs(rows[shared], cols[shared])
+        return total
+
+    def computePairs(self, rows, cols):
+        """Similarity of the pairs (rows[p], cols[p]), with the same arithmetic as computeRows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        return self._score(rows, cols, self._intersections(rows, cols))
+
+    def _intersections(self, rows, cols):
+        intersections = {}
+        for (name, _) in SET_ATTRIBUTES:
+            incidence = self.incidence[name]
+            intersections[name] = np.asarray(incidence[rows].multiply(incidence[cols]).sum(axis=1)).ravel()
+        return intersections
+
+    def _score(self, rows, cols, intersections):
+        """
+        Weighted sum of the attribute terms of the pairs (rows[p], cols[p]), accumulated in the
+        order of computeSimilarity. intersections=None means the pairs share no multi-valued value:
+        every Jaccard term is 0 and leaves the sum unchanged, so only the exact matches are added.
+        """
+        total = np.zeros(len(rows))
+        if intersections is not None:
+            for (name, _) in SET_ATTRIBUTES:
+                intersection = intersections[name]
+                union = self.counts[name][rows] + self.counts[name][cols] - intersection
+                jaccard = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+                total += self.weights[name] * jaccard
+
+        for (name, _) in VALUE_ATTRIBUTES:
+            code = self.codes[name]
+            match = (code[rows] == code[cols]) & (code[rows] >= 0)
+            total += self.weights[name] * match
+
+        total[rows == cols] = 0.0
+        return total
+
+    def computeMatrix(self, blockSize=512):
+        """Full n_items x n_items similarity matrix, built block by block."""
+        similarities = np.zeros((self.n_items, self.n_items))
+        for start in range(0, self.n_items, blockSize):
+            rows = np.arange(start, min(start + blockSize, self.n_items))
+            similarities[rows] = self.computeRows(rows)
+        return similarities
+
+
+def catalogFingerprint(musicID_to_details, musicIDs, *extra):
+    """
+    Hash of everything the content similarity depends on: the item order, the attributes of every
+    item and any extra settings (weights, number of neighbors...). Equal fingerprints mean the
+    stored similarity structure can be reused as is.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(extra).encode('utf-8'))
+    musicIDs = list(musicIDs)
+    if hasattr(musicID_to_details, 'listColumn'):
+        records = _columnRecords(musicID_to_details, musicIDs)
+    else:
+        records = []
+        for musicID in musicIDs:
+            details = musicID_to_details.get(musicID, {})
+            records.append((musicID, details.get('nationality'), details.get('contributor_id'),
+                            [sorted(set(details.get(key, []) or [])) for (_, key) in SET_ATTRIBUTES]
+                            if details else None))
+    for record in records:
+        digest.update(repr(record).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def attributeEntries(musicID_to_details, musicIDs, key, multiValued):
+    """
+    The (position in musicIDs, value) pairs of attribute key, as two lists: each multi-valued value
+    once per song in sorted order, single values only when truthy (falsy values never match, exactly
+    like computeSimilarity). Columnar details (see CatalogSnapshot) are read a column at a time.
+    """
+    if hasattr(musicID_to_details, 'listColumn'):
+        rows = musicID_to_details.rows(musicIDs)
+        present = np.flatnonzero(rows >= 0)
+        if not multiValued:
+            values = musicID_to_details.scalarColumn(key, rows[present])
+            kept = [(row, value) for (row, value) in zip(present.tolist(), values) if value]
+            return [row for (row, _) in kept], [value for (_, value) in kept]
+        (indptr, values) = musicID_to_details.listColumn(key, rows[present])
+        entryRows = np.repeat(present, np.diff(indptr))
+        order = np.lexsort((values, entryRows))
+        (entryRows, values) = (entryRows[order], values[order])
+        unique = np.ones(len(values), dtype=bool)
+        unique[1:] = (entryRows[1:] != entryRows[:-1]) | (values[1:] != values[:-1])
+        return entryRows[unique].tolist(), values[unique].tolist()
+
+    rows = []
+    entries = []
+    for row, musicID in enumerate(musicIDs):
+        details = musicID_to_details.get(musicID, {})
+        if not details:
+            continue
+        if multiValued:
+            values = sorted(set(details.get(key, []) or []))
+        else:
+            value = details.get(key)
+            values = [value] if value else []
+        rows.extend([row] * len(values))
+        entries.extend(values)
+    return rows, entries
+
+
+def _columnRecords(musicID_to_details, musicIDs):
+    """The per-song records hashed by catalogFingerprint, read from columnar details."""
+    rows = musicID_to_details.rows(musicIDs)
+    present = rows >= 0
+    scalars = [iter(musicID_to_details.scalarColumn(key, rows[present])) for (_, key) in VALUE_ATTRIBUTES]
+    lists = []
+    for (_, key) in SET_ATTRIBUTES:
+        (entryRows, values) = attributeEntries(musicID_to_details, musicIDs, key, True)
+        bounds = np.searchsorted(entryRows, np.arange(len(musicIDs) + 1)).tolist()
+        lists.append([values[start:end] for (start, end) in zip(bounds[:-1], bounds[1:])])
+    for (position, musicID) in enumerate(musicIDs):
+        if present[position]:
+            yield (musicID,) + tuple(next(column) for column in scalars) + \
+                  ([column[position] for column in lists],)
+        else:
+            yield (musicID, None, None, None)
+
+
+def changedMusicIDs(oldDetails, newDetails):
+    """
+    Các bài hát được thêm, bị xóa hoặc bị sửa thuộc tính giữa hai lần tải musicID_to_details.
+
+    Args:
+        oldDetails (dict): musicID_to_details của lần tải trước.
+        newDetails (dict): musicID_to_details của lần tải hiện tại.
+
+    Returns:
+        set: Các music ID cần tính lại độ tương đồng.
+    """
+    changed = set(oldDetails.keys()) ^ set(newDetails.keys())
+    for musicID in set(oldDetails.keys()) & set(newDetails.keys()):
+        if oldDetails[musicID] != newDetails[musicID]:
+            changed.add(musicID)
+    return changed
+
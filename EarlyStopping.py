@@ -0,0 +1,81 @@
+import time
+import numpy as np
+from scipy import sparse
+
+
+class EarlyStopping:
+    """
+    Stops RBM training once the reconstruction error of a few held-out users stops improving.
+
+    A small random sample of users is left out of the training batches. Every `interval` epochs
+    their rows are reconstructed and the error is the mean absolute difference between the
+    expected rating level (softmax over the levels of each rated song) and the actual level.
+    Training stops when the error improved by less than `tolerance` since the previous check.
+    The RBM then trains once on the held-out users, so the final model has seen every user.
+
+    With fewer than `minSampleSize` users to hold out (a tenth of the users at most), the error
+    would be too noisy to act on, so early stopping is disabled and every epoch runs.
+    """
+
+    def __init__(self, X, tolerance=0.001, interval=2, sampleSize=200, ratingValues=10, seed=0, batchSize=50,
+                 minSampleSize=20):
+        self.tolerance = tolerance
+        self.interval = interval
+        self.ratingValues = ratingValues
+        self.batchSize = batchSize
+
+        numUsers = X.shape[0]
+        # Keep most users for training, even on tiny data sets
+        sampleSize = min(sampleSize, numUsers // 10)
+        self.enabled = sampleSize >= minSampleSize
+        if not self.enabled:
+            print("Early stopping disabled: ", numUsers, " users leave fewer than ", minSampleSize,
+                  " to hold out for validation")
+            sampleSize = 0
+        validationRows = np.random.RandomState(seed).choice(numUsers, size=sampleSize, replace=False)
+        self.validationRows = np.sort(validationRows)
+        isValidation = np.zeros(numUsers, dtype=bool)
+        isValidation[self.validationRows] = True
+        self.trainingRows = np.flatnonzero(~isValidation)
+        self.validationX = sparse.csr_matrix(X[self.validationRows])
+
+        self.history = []
+        self.started = time.time()
+        self.epochsRun = 0
+
+    def error(self, rbm):
+        """Mean absolute level error of the validation users' ratings."""
+        errors = []
+        for start in range(0, len(self.validationRows), self.batchSize):
+            batch = self.validationX[start:start + self.batchSize]
+            recs = np.reshape(rbm.GetReconstructions(batch), [batch.shape[0], -1, self.ratingValues])
+            batch = batch.tocoo()
+            (items, levels) = (batch.col // self.ratingValues, batch.col % self.ratingValues)
+            probabilities = np.exp(recs[batch.row, items])
+            expected = (probabilities * np.arange(self.ratingValues)).sum(axis=1) / probabilities.sum(axis=1)
+            errors.append(np.abs(expected - levels))
+        errors = np.concatenate(errors) if errors else np.zeros(0)
+        return float(errors.mean()) if len(errors) else 0.0
+
+    def check(self, rbm, epoch):
+        """Called after each epoch (counted from 0); True when training should stop."""
+        self.epochsRun = epoch + 1
+        if not self.enabled or self.epochsRun % self.interval:
+            return False
+        error = self.error(rbm)
+        print("Validation error after epoch ", epoch, ": ", error)
+        self.history.append((self.epochsRun, error))
+        if len(self.history) < 2:
+            return False
+        return self.history[-2][1] - error < self.tolerance
+
+    def report(self, maxEpochs):
+        """Print and return (epochs run, estimated seconds saved against running all maxEpochs)."""
+        elapsed = time.time() - self.started
+        saved = elapsed / max(self.epochsRun, 1) * (maxEpochs - self.epochsRun)
+        if self.epochsRun < maxEpochs:
+            print("Early stopping: trained ", self.epochsRun, " of ", maxEpochs, " epochs, saved about ",
+                  round(saved, 1), "s")
+        else:
+            print("Early stopping: ran all ", maxEpochs, " epochs")
+        return self.epochsRun, saved
@@ -4,36 +4,49 @@ from surprise import KNNBaseline
 
 class EvaluationData:
     
-    def __init__(self, data, popularityRankings):
+    def __init__(self, data, popularityRankings, servingOnly=False):
         
         self.rankings = popularityRankings
+        self.data = data
+        # servingOnly: only the full training set and per-user anti-test sets are available,
+        # as needed to compute recommendations; the evaluation sets are never built
+        self.servingOnly = servingOnly
         
         #Build a full training set for evaluating overall properties
         self.fullTrainSet = data.build_full_trainset()
-        self.fullAntiTestSet = self.fullTrainSet.build_anti_testset()
         
-        #Build a 75/25 train/test split for measuring accuracy
-        self.trainSet, self.testSet = train_test_split(data, test_size=.25, random_state=1)
+        # Everything else is built on first use and kept, see _cached
+        self.cache = {}
         
+    def _cached(self, name, build):
+        if self.servingOnly:
+            raise RuntimeError("EvaluationData was built with servingOnly=True, " + name + " is not available")
+        if name not in self.cache:
+            self.cache[name] = build()
+        return self.cache[name]
+    
+    def _buildTrainTestSplit(self):
+        #Build a 75/25 train/test split for measuring accuracy
+        return train_test_split(self.data, test_size=.25, random_state=1)
+    
+    def _buildLOOCV(self):
         #Build a "leave one out" train/test split for evaluating top-N recommenders
-        #And build an anti-test-set for building predictions
         LOOCV = LeaveOneOut(n_splits=1, random_state=1)
-        for train, test in LOOCV.split(data):
-            self.LOOCVTrain = train
-            self.LOOCVTest = test
-            
-        self.LOOCVAntiTestSet = self.LOOCVTrain.build_anti_testset()
-        
+        for train, test in LOOCV.split(self.data):
+            return train, test
+    
+    def _buildSimilarities(self):
         #Compute similarty matrix between items so we can measure diversity
         sim_options = {'name': 'cosine', 'user_based': False}
-        self.simsAlgo = KNNBaseline(sim_options=sim_options)
-        self.simsAlgo.fit(self.fullTrainSet)
+        simsAlgo = KNNBaseline(sim_options=sim_options)
+        simsAlgo.fit(self.fullTrainSet)
+        return simsAlgo
             
     def GetFullTrainSet(self):
         return self.fullTrainSet
     
     def GetFullAntiTestSet(self):
-        return self.fullAntiTestSet
+        return self._cached('fullAntiTestSet', self.fullTrainSet.build_anti_testset)
     
     def GetAntiTestSetForUser(self, testSubject):
 
@@ -48,22 +61,23 @@ class EvaluationData:
         return anti_testset
 
     def GetTrainSet(self):
-        return self.trainSet
+        return self._cached('trainTestSplit', self._buildTrainTestSplit)[0]
     
     def GetTestSet(self):
-        return self.testSet
+        return self._cached('trainTestSplit', self._buildTrainTestSplit)[1]
     
     def GetLOOCVTrainSet(self):
-        return self.LOOCVTrain
+        return self._cached('LOOCV', self._buildLOOCV)[0]
     
     def GetLOOCVTestSet(self):
-        return self.LOOCVTest
+        return self._cached('LOOCV', self._buildLOOCV)[1]
     
     def GetLOOCVAntiTestSet(self):
-        return self.LOOCVAntiTestSet
+        #And build an anti-test-set for building predictions
+        return self._cached('LOOCVAntiTestSet', lambda: self.GetLOOCVTrainSet().build_anti_testset())
     
     def GetSimilarities(self):
-        return self.simsAlgo
+        return self._cached('simsAlgo', self._buildSimilarities)
     
     def GetPopularityRankings(self):
         return self.rankings
\ No newline at end of file
@@ -1,12 +1,15 @@
 from EvaluationData import EvaluationData
 from EvaluatedAlgorithm import EvaluatedAlgorithm
+from BatchRecommender import BatchRecommender
+from IncrementalRecommender import IncrementalRecommender
 
 class Evaluator:
     
     algorithms = []
     
-    def __init__(self, dataset, rankings):
-        ed = EvaluationData(dataset, rankings)
+    def __init__(self, dataset, rankings, servingOnly=False):
+        # servingOnly skips the evaluation sets, for jobs that only compute recommendations
+        ed = EvaluationData(dataset, rankings, servingOnly)
         self.dataset = ed
         
     def AddAlgorithm(self, algorithm, name):
@@ -82,7 +85,7 @@ class Evaluator:
 
             
                 
-    def RecommendForEachUser(self, musicData, userIds, k=10):
+    def RecommendForEachUser(self, musicData, userIds, k=10, processes=1):
 
         recommendForEveryUser = []
         
@@ -93,6 +96,15 @@ class Evaluator:
         trainSet = self.dataset.GetFullTrainSet()
         algo.GetAlgorithm().fit(trainSet)
 
+        if hasattr(algo.GetAlgorithm(), 'estimateBlock'):
+            # Same lists as the loop below, scored in blocks without per-user anti-test sets
+            print("Computing recommendations for ", len(userIds), " users...")
+            recommender = BatchRecommender(algo.GetAlgorithm(), trainSet, k, processes=processes)
+            for (testSubject, music_ids) in recommender.recommend(userIds):
+                print("Music top n for user ", testSubject, ": ", music_ids)
+                recommendForEveryUser.append((testSubject, music_ids))
+            return recommendForEveryUser
+
         for testSubject in userIds:
         
             print("Computing recommendations for user ", testSubject)
@@ -125,6 +137,33 @@ class Evaluator:
             recommendForEveryUser.append((testSubject, music_ids))
 
         return recommendForEveryUser
+
+    def RecommendForChangedUsers(self, musicData, userIds, stateDir, k=10, processes=1, tolerance=0.0):
+        # Only the listeners whose lists may have changed since the run that left stateDir are
+        # recomputed; the lists that differ are written to Redis, the others just have their Redis
+        # entry's TTL refreshed. With tolerance 0 the lists are those a full run gives, ties
+        # included; see IncrementalRecommender for what a larger tolerance allows
+        algo = self.algorithms[0]
+        if not hasattr(algo.GetAlgorithm(), 'estimateBlock'):
+            recommendForEveryUser = self.RecommendForEachUser(musicData, userIds, k, processes)
+            musicData.saveAllRecommendationsToRedis(recommendForEveryUser)
+            return recommendForEveryUser
+
+        print("\nUsing recommender ", algo.GetName())
+        print("\nBuilding recommendation model...")
+        trainSet = self.dataset.GetFullTrainSet()
+        algo.GetAlgorithm().fit(trainSet)
+
+        incremental = IncrementalRecommender(algo.GetAlgorithm(), trainSet, stateDir, k, processes, tolerance)
+        (changed, unchanged) = incremental.recommend(userIds)
+        for (testSubject, music_ids) in changed:
+            print("Music top n for user ", testSubject, ": ", music_ids)
+
+        musicData.saveAllRecommendationsToRedis(changed)
+        musicData.refreshRecommendationsInRedis(unchanged)
+        # Saved last, so the state only ever describes lists that are in Redis
+        incremental.saveState()
+        return changed
     
             
             
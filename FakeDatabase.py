@@ -0,0 +1,198 @@
+import re
+import threading
+import time
+from SyntheticData import makeCatalog, makeRatings
+
+
+class PoolError(Exception):
+    """Như psycopg2.pool.PoolError: pool đã cho mượn hết maxConnections kết nối."""
+
+
+class FakeCursor:
+    """
+    Cursor giả trả kết quả của FakeDatabase.run, với fetchone/fetchmany/fetchall như psycopg2.
+    Cursor có tên (cursor phía server) chỉ được execute một lần, giống psycopg2.
+    """
+
+    def __init__(self, database, name=None):
+        self.database = database
+        self.name = name
+        self.itersize = 2000
+        self.arraysize = 1
+        self.rows = []
+        self.position = 0
+        self.executed = False
+
+    def execute(self, query, params=None):
+        if self.name is not None and self.executed:
+            raise RuntimeError("can't call .execute() on named cursors more than once")
+        self.executed = True
+        self.rows = self.database.run(query, params)
+        self.position = 0
+        self.database.queries.append((self.name, query))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        if self.database.fetchLatency:
+            # Thời gian một lượt đi về với server; sleep nhả GIL như khi chờ socket thật
+            time.sleep(self.database.fetchLatency)
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        self.database.largestFetch = max(self.database.largestFetch, len(rows))
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows) - self.position)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def close(self):
+        self.rows = []
+
+
+class FakeConnection:
+
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self, name=None):
+        return FakeCursor(self.database, name)
+
+    def commit(self): pass
+    def rollback(self): pass
+    def close(self): pass
+
+
+class FakeDatabase:
+    """
+    Thay thế DatabaseConnection (get_connection/release_connection) bằng dữ liệu trong bộ nhớ để chạy
+    và kiểm tra phần tải dữ liệu của MusicRecommendation mà không cần Postgres:
+
+        musicData = MusicRecommendation(FakeDatabase.fromSynthetic(numUsers=1000, numItems=2000))
+
+    Chỉ hiểu đúng các truy vấn mà MusicRecommendation dùng; truy vấn khác gây NotImplementedError.
+    Cột watermark của bảng điểm tên là updated_at (một bộ đếm tăng mỗi lần setRating).
+    """
+
+    def __init__(self, ratings, musics, fetchLatency=0.0, maxConnections=10):
+        """
+        Args:
+            ratings (list): Các dòng (listener_id, music_id, score) của listener_music_recommend_score.
+            musics (list): Các dòng kết quả của truy vấn catalog (id, name, nationality, uploaded_by_id,
+                artist_ids, category_ids, genre_ids, period_ids), mảng rỗng là None như ARRAY_AGG.
+            fetchLatency (float): Số giây chờ mỗi lần fetch, để thấy được lợi ích của việc đọc song song.
+            maxConnections (int): Số kết nối tối đa cho mượn cùng lúc, như maxconn của
+                DatabaseConnection (MAX_CONNECTIONS); vượt quá thì get_connection ném PoolError.
+        """
+        self.ratings = list(ratings)
+        # Cột watermark của bảng điểm: mỗi lần setRating tăng clock và gán cho dòng được ghi
+        self.clock = 1
+        self.updatedAt = [self.clock] * len(self.ratings)
+        self.musics = list(musics)
+        self.fetchLatency = fetchLatency
+        self.maxConnections = maxConnections
+        self.lock = threading.Lock()
+        # Ghi lại các truy vấn (tên cursor, câu lệnh) và khối lớn nhất từng được đọc, để kiểm tra
+        self.queries = []
+        self.largestFetch = 0
+        self.openConnections = 0
+        self.maxOpenConnections = 0
+
+    @classmethod
+    def fromSynthetic(cls, numUsers=200, numItems=500, ratingsPerUser=30, seed=0, fetchLatency=0.0, maxConnections=10):
+        """Cơ sở dữ liệu giả chứa catalog và điểm nghe nhạc sinh bởi SyntheticData."""
+        (listenerIDs, musicIDs, scores) = makeRatings(numUsers, numItems, ratingsPerUser, seed)
+        ratings = list(zip(listenerIDs.tolist(), musicIDs.tolist(), scores.tolist()))
+        musics = [(musicID, "song " + str(musicID), details['nationality'], details['contributor_id'],
+                   details['artist_ids'] or None, details['category_ids'] or None,
+                   details['genre_ids'] or None, details['period_ids'] or None)
+                  for (musicID, details) in makeCatalog(numItems=numItems, seed=seed).items()]
+        return cls(ratings, musics, fetchLatency, maxConnections)
+
+    def setRating(self, listenerID, musicID, score):
+        """Thêm hoặc sửa điểm của (listenerID, musicID), như một lần ghi của ứng dụng."""
+        self.clock += 1
+        for (row, (rowListenerID, rowMusicID, _)) in enumerate(self.ratings):
+            if (rowListenerID, rowMusicID) == (listenerID, musicID):
+                self.ratings[row] = (listenerID, musicID, score)
+                self.updatedAt[row] = self.clock
+                return
+        self.ratings.append((listenerID, musicID, score))
+        self.updatedAt.append(self.clock)
+
+    def deleteRating(self, listenerID, musicID):
+        kept = [(row, version) for (row, version) in zip(self.ratings, self.updatedAt) if row[:2] != (listenerID, musicID)]
+        self.ratings = [row for (row, _) in kept]
+        self.updatedAt = [version for (_, version) in kept]
+
+    def get_connection(self):
+        # Thread-safe như ThreadedConnectionPool
+        with self.lock:
+            if self.openConnections >= self.maxConnections:
+                raise PoolError("connection pool exhausted")
+            self.openConnections += 1
+            self.maxOpenConnections = max(self.maxOpenConnections, self.openConnections)
+        return FakeConnection(self)
+
+    def release_connection(self, connection):
+        with self.lock:
+            self.openConnections -= 1
+
+    def close_all_connections(self):
+        with self.lock:
+            self.openConnections = 0
+
+    def run(self, query, params=None):
+        query = " ".join(query.split()).lower()
+        # Điều kiện khoảng khóa [start, stop) của các lần đọc song song (readPartitions)
+        ratingRange = r"( where listener_id >= %s and listener_id < %s)?$"
+        # Thống kê của Postgres chỉ là ước tính: ở đây lệch 10% so với số dòng thật
+        if re.match(r"select reltuples from pg_class where relname = 'listener_music_recommend_score'$", query):
+            return [(float(len(self.ratings) * 9 // 10),)]
+        if re.match(r"select listener_id, music_id, score from listener_music_recommend_score" + ratingRange, query):
+            return self._ratingsIn(params)
+        if re.match(r"select max\(updated_at\) from listener_music_recommend_score$", query):
+            return [(max(self.updatedAt) if self.updatedAt else None,)]
+        # Các dòng thay đổi giữa hai watermark, số dòng của từng người nghe đến watermark mới, và các khóa
+        # còn lại của một số người nghe (refreshSnapshot)
+        if re.match(r"select listener_id, music_id, score from listener_music_recommend_score "
+                    r"where updated_at > %s and updated_at <= %s$", query):
+            return [row for (row, version) in zip(self.ratings, self.updatedAt) if params[0] < version <= params[1]]
+        if re.match(r"select listener_id, count\(\*\) from listener_music_recommend_score "
+                    r"where updated_at <= %s group by listener_id$", query):
+            counts = {}
+            for ((listenerID, _, _), version) in zip(self.ratings, self.updatedAt):
+                if params[0] is not None and version <= params[0]:
+                    counts[listenerID] = counts.get(listenerID, 0) + 1
+            return sorted(counts.items())
+        if re.match(r"select listener_id, music_id from listener_music_recommend_score where listener_id = any\(%s\)$", query):
+            listenerIDs = set(params[0])
+            return [(listenerID, musicID) for (listenerID, musicID, _) in self.ratings if listenerID in listenerIDs]
+        if re.match(r"select min\(listener_id\), max\(listener_id\) from listener_music_recommend_score$", query):
+            listenerIDs = [listenerID for (listenerID, _, _) in self.ratings]
+            return [(min(listenerIDs), max(listenerIDs)) if listenerIDs else (None, None)]
+        if re.match(r"select music_id, score from listener_music_recommend_score where listener_id = %s$", query):
+            return [(musicID, score) for (listenerID, musicID, score) in self.ratings if listenerID == params[0]]
+        if re.match(r"select min\(id\), max\(id\) from mucis$", query):
+            musicIDs = [row[0] for row in self.musics]
+            return [(min(musicIDs), max(musicIDs)) if musicIDs else (None, None)]
+        if " from mucis m " in query:
+            if " where m.id >= %s and m.id < %s " in query:
+                return [row for row in self.musics if params[0] <= row[0] < params[1]]
+            return list(self.musics)
+        raise NotImplementedError("FakeDatabase does not know the query: " + query)
+
+    def _ratingsIn(self, keyRange):
+        if keyRange is None:
+            return list(self.ratings)
+        return [row for row in self.ratings if keyRange[0] <= row[0] < keyRange[1]]
@@ -1,5 +1,7 @@
 
 from surprise import AlgoBase
+from surprise import PredictionImpossible
+import numpy as np
 
 class HybridAlgorithm(AlgoBase):
 
@@ -21,10 +23,103 @@ class HybridAlgorithm(AlgoBase):
         sumScores = 0
         sumWeights = 0
         
+        # A component without a prediction is left out and the other weights renormalised
         for idx in range(len(self.algorithms)):
-            sumScores += self.algorithms[idx].estimate(u, i) * self.weights[idx]
+            try:
+                score = self._componentEstimate(self.algorithms[idx], u, i)
+            except PredictionImpossible:
+                continue
+            sumScores += score * self.weights[idx]
             sumWeights += self.weights[idx]
+
+        if sumWeights == 0:
+            raise PredictionImpossible('No component can predict this rating')
             
         return sumScores / sumWeights
 
+    def estimateBlock(self, users, items=None):
+        """
+        estimate() for a block of users x items (inner ids), one array operation per component.
+        NaN marks the cells no component can predict.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.arange(self.trainset.n_items) if items is None else np.asarray(items, dtype=np.int64)
+
+        sumScores = np.zeros((len(users), len(items)))
+        sumWeights = np.zeros((len(users), len(items)))
+        for idx in range(len(self.algorithms)):
+            scores = self._componentBlock(self.algorithms[idx], users, items)
+            valid = ~np.isnan(scores)
+            sumScores[valid] += scores[valid] * self.weights[idx]
+            sumWeights[valid] += self.weights[idx]
+
+        estimates = np.full((len(users), len(items)), np.nan)
+        np.divide(sumScores, sumWeights, out=estimates, where=sumWeights != 0)
+        return estimates
+
+    def scoreState(self):
+        """State of the components that have one (see IncrementalRecommender), keyed by position and class."""
+        state = {}
+        for (idx, algorithm) in enumerate(self.algorithms):
+            if hasattr(algorithm, 'scoreState'):
+                prefix = self._statePrefix(idx)
+                state.update({prefix + key: value for (key, value) in algorithm.scoreState().items()})
+        return state
+
+    def changedItems(self, state, users):
+        """
+        Per user, the items whose score moved by an unknown amount in some component (see
+        IncrementalRecommender), as CSR-style (indptr, items).
+        """
+        rows = [np.zeros(0, dtype=np.int64)]
+        items = [np.zeros(0, dtype=np.int64)]
+        for (idx, algorithm) in enumerate(self.algorithms):
+            componentState = self._componentState(state, idx)
+            if componentState and hasattr(algorithm, 'changedItems'):
+                (indptr, changed) = algorithm.changedItems(componentState, users)
+                rows.append(np.repeat(np.arange(len(users)), np.diff(indptr)))
+                items.append(changed)
+        # One sorted entry per (user, item), whichever components changed it
+        keys = np.unique(np.concatenate(rows) * self.trainset.n_items + np.concatenate(items))
+        indptr = np.searchsorted(keys, np.arange(len(users) + 1) * self.trainset.n_items)
+        return indptr, keys % self.trainset.n_items
+
+    def scoreDrift(self, state, users):
+        # A blended cell moves at most as much as the components that predict it, whatever the weights
+        drift = np.zeros(len(users))
+        for (idx, algorithm) in enumerate(self.algorithms):
+            componentState = self._componentState(state, idx)
+            if not (componentState and hasattr(algorithm, 'scoreDrift')):
+                return np.full(len(users), np.inf)
+            drift = np.maximum(drift, algorithm.scoreDrift(componentState, users))
+        return drift
+
+    def _componentState(self, state, idx):
+        prefix = self._statePrefix(idx)
+        return {key[len(prefix):]: value for (key, value) in state.items() if key.startswith(prefix)}
+
+    def _statePrefix(self, idx):
+        return str(idx) + '.' + type(self.algorithms[idx]).__name__ + '.'
+
+    @staticmethod
+    def _componentBlock(algorithm, users, items):
+        if hasattr(algorithm, 'estimateBlock'):
+            return np.asarray(algorithm.estimateBlock(users, items), dtype=np.float64)
+
+        # Plain surprise algorithms: one estimate() per cell
+        scores = np.full((len(users), len(items)), np.nan)
+        for (row, u) in enumerate(users):
+            for (column, i) in enumerate(items):
+                try:
+                    scores[row, column] = HybridAlgorithm._componentEstimate(algorithm, int(u), int(i))
+                except PredictionImpossible:
+                    pass
+        return scores
+
+    @staticmethod
+    def _componentEstimate(algorithm, u, i):
+        # Surprise's own algorithms may return (estimate, details)
+        score = algorithm.estimate(u, i)
+        return score[0] if isinstance(score, tuple) else score
+
     
\ No newline at end of file
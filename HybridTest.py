@@ -31,9 +31,9 @@ random.seed(0)
 evaluator = Evaluator(evaluationData, rankings)
 
 #Simple RBM
-SimpleRBM = RBMAlgorithm(epochs=40)
+SimpleRBM = RBMAlgorithm(epochs=40, musicCatalog=musicData.loadCatalog())
 #Content
-ContentKNN = ContentKNNAlgorithm(10, {}, musicData)
+ContentKNN = ContentKNNAlgorithm(10, {}, musicData.loadCatalog())
 
 #Combine them
 Hybrid = HybridAlgorithm([SimpleRBM, ContentKNN], [0.2, 0.8])
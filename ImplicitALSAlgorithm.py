@@ -0,0 +1,182 @@
+from surprise import AlgoBase
+from surprise import PredictionImpossible
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import sparse
+from TrainsetArrays import TrainsetArrays, matchIDs, rawItemIDs, rawUserIDs
+
+
+class ImplicitALSAlgorithm(AlgoBase):
+    """
+    Phân rã ma trận cho phản hồi ngầm (Hu, Koren & Volinsky), huấn luyện bằng bình phương tối
+    thiểu luân phiên (ALS). Mỗi bài hát đã nghe là sở thích 1 với độ tin cậy 1 + alpha * điểm;
+    bài chưa nghe là sở thích 0 với độ tin cậy 1. Mô hình chỉ gồm hai ma trận nhân tố
+    (người dùng x factors và bài hát x factors), nhỏ hơn nhiều so với các đơn vị hiển thị của RBM.
+
+    Mỗi nửa vòng lặp giải hệ tuyến tính của mọi dòng bằng vài bước gradient liên hợp (conjugate
+    gradient) bắt đầu từ nghiệm cũ, như thư viện implicit: chi phí O(số rating x factors) thay vì
+    O(số rating x factors^2) khi dựng ma trận factors x factors riêng cho từng dòng.
+    """
+
+    def __init__(self, factors=32, regularization=0.1, alpha=10.0, iterations=15, cgSteps=3, numThreads=None,
+                 chunkRatings=16384, seed=0):
+        AlgoBase.__init__(self)
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.cgSteps = cgSteps
+        # Số luồng giải mỗi nửa vòng lặp (None: mặc định của ThreadPoolExecutor)
+        self.numThreads = numThreads
+        # Số rating trong mỗi nhóm dòng được giải cùng lúc; bộ nhớ tạm của nhóm là chunkRatings x factors
+        self.chunkRatings = chunkRatings
+        self.seed = seed
+
+    def fit(self, trainset):
+        AlgoBase.fit(self, trainset)
+
+        print("Training implicit ALS...")
+        ratingArrays = TrainsetArrays(trainset)
+        # Lưu độ tin cậy - 1 = alpha * điểm, chỉ ở các ô đã có rating
+        userConfidence = sparse.csr_matrix((self.alpha * ratingArrays.ratings, ratingArrays.items, ratingArrays.indptr),
+                                           shape=(trainset.n_users, trainset.n_items))
+        itemConfidence = userConfidence.T.tocsr()
+
+        # Giá trị khởi tạo của mỗi dòng chỉ phụ thuộc vào ID gốc, không vào thứ tự các rating được đọc
+        self.userFactors = initialFactors(rawUserIDs(trainset), self.factors, self.seed, 0)
+        self.itemFactors = initialFactors(rawItemIDs(trainset), self.factors, self.seed, 1)
+        for iteration in range(self.iterations):
+            self.userFactors = self._solve(userConfidence, self.itemFactors, self.userFactors)
+            self.itemFactors = self._solve(itemConfidence, self.userFactors, self.itemFactors)
+            print("ALS iteration ", iteration)
+
+        print("...done.")
+        return self
+
+    def _solve(self, confidence, fixed, current):
+        """
+        Nhân tố mới của mọi dòng trong confidence khi giữ cố định phía còn lại (fixed): nghiệm gần
+        đúng của (F^T F + F^T (C_u - I) F + lambda I) x_u = F^T C_u p_u sau cgSteps bước gradient
+        liên hợp từ current, theo từng nhóm dòng trên nhiều luồng.
+        """
+        # F^T F dùng chung cho mọi dòng; phần riêng của mỗi dòng chỉ đến từ các rating của nó
+        gram = fixed.T @ fixed + self.regularization * np.eye(self.factors)
+        indptr = confidence.indptr
+        numRows = confidence.shape[0]
+        cuts = np.minimum(np.searchsorted(indptr, np.arange(self.chunkRatings, indptr[-1], self.chunkRatings)), numRows)
+        bounds = np.unique(np.r_[0, cuts, numRows])
+
+        def solveChunk(chunk):
+            (start, end) = chunk
+            rows = confidence[start:end]
+            ratedRows = np.repeat(np.arange(end - start), np.diff(rows.indptr))
+            ratedFactors = fixed[rows.indices]
+
+            def multiply(x):
+                # (F^T F + lambda I) x + F^T (C_u - I) F x cho mọi dòng, không dựng ma trận factors x factors nào
+                weights = rows.data * np.einsum('nf,nf->n', x[ratedRows], ratedFactors)
+                return x @ gram + sparse.csr_matrix((weights, rows.indices, rows.indptr), shape=rows.shape) @ fixed
+
+            x = current[start:end].copy()
+            rhs = sparse.csr_matrix((1.0 + rows.data, rows.indices, rows.indptr), shape=rows.shape) @ fixed
+            residual = rhs - multiply(x)
+            direction = residual.copy()
+            residualNorm = np.sum(residual * residual, axis=1)
+            for step in range(self.cgSteps):
+                product = multiply(direction)
+                curvature = np.sum(direction * product, axis=1)
+                # Dòng đã hội tụ (phần dư bằng 0) thì đứng yên
+                stepSize = np.divide(residualNorm, curvature, out=np.zeros_like(curvature), where=curvature > 0)
+                x += stepSize[:, None] * direction
+                residual -= stepSize[:, None] * product
+                newNorm = np.sum(residual * residual, axis=1)
+                direction = residual + np.divide(newNorm, residualNorm, out=np.zeros_like(newNorm),
+                                                 where=residualNorm > 0)[:, None] * direction
+                residualNorm = newNorm
+            return x
+
+        # Nhân ma trận thưa của scipy và BLAS nhả GIL, nên các luồng chạy song song thật sự
+        with ThreadPoolExecutor(self.numThreads) as pool:
+            solutions = list(pool.map(solveChunk, zip(bounds[:-1], bounds[1:])))
+        return np.concatenate(solutions) if solutions else np.zeros((0, self.factors))
+
+    def _toRatingScale(self, preferences):
+        # Sở thích dự đoán nằm quanh [0, 1]; kéo giãn ra thang rating để trộn được trong HybridAlgorithm
+        (lowerBound, higherBound) = self.trainset.rating_scale
+        return lowerBound + (higherBound - lowerBound) * np.clip(preferences, 0.0, 1.0)
+
+    def estimate(self, u, i):
+        if not (self.trainset.knows_user(u) and self.trainset.knows_item(i)):
+            raise PredictionImpossible('User and/or item is unknown.')
+
+        return float(self._toRatingScale(self.userFactors[u] @ self.itemFactors[i]))
+
+    def estimateBlock(self, users, items=None):
+        """
+        Dự đoán cho một khối người dùng x bài hát (inner ID) bằng một phép nhân hai ma trận nhân tố.
+        Ô nào estimate() sẽ ném PredictionImpossible thì có giá trị NaN.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.arange(self.trainset.n_items) if items is None else np.asarray(items, dtype=np.int64)
+        knownUsers = (users >= 0) & (users < self.trainset.n_users)
+        knownItems = (items >= 0) & (items < self.trainset.n_items)
+
+        estimates = np.full((len(users), len(items)), np.nan)
+        preferences = self.userFactors[users[knownUsers]] @ self.itemFactors[items[knownItems]].T
+        estimates[np.ix_(knownUsers, knownItems)] = self._toRatingScale(preferences)
+        return estimates
+
+    def scoreState(self):
+        """Nhân tố của lần huấn luyện này theo ID gốc, để lần chạy sau đo độ lệch (xem IncrementalRecommender)."""
+        return {'listenerIDs': rawUserIDs(self.trainset), 'musicIDs': rawItemIDs(self.trainset),
+                'userFactors': self.userFactors, 'itemFactors': self.itemFactors}
+
+    def scoreDrift(self, state, users):
+        """
+        Cận trên của |điểm mới - điểm cũ| theo từng người dùng, trên các bài hát có ở cả hai lần chạy,
+        chỉ từ chuẩn của các dòng nhân tố: |u'.v' - u.v| <= |u'| |v' - v| + |u' - u| |v|.
+        Chi phí O((số người dùng + số bài hát) x factors), không phải chấm điểm cả ma trận.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        oldUsers = matchIDs(state['listenerIDs'], rawUserIDs(self.trainset)[users])
+        oldItems = matchIDs(state['musicIDs'], rawItemIDs(self.trainset))
+        items = np.flatnonzero(oldItems >= 0)
+
+        drift = np.full(len(users), np.inf)
+        known = np.flatnonzero(oldUsers >= 0)
+        if len(items) == 0:
+            drift[known] = 0.0
+            return drift
+        oldItemFactors = state['itemFactors'][oldItems[items]]
+        itemChange = np.linalg.norm(self.itemFactors[items] - oldItemFactors, axis=1).max()
+        oldItemNorm = np.linalg.norm(oldItemFactors, axis=1).max()
+        newUserFactors = self.userFactors[users[known]]
+        userChange = np.linalg.norm(newUserFactors - state['userFactors'][oldUsers[known]], axis=1)
+        # Thang rating kéo giãn sở thích (xem _toRatingScale), phép cắt không làm độ lệch lớn thêm
+        (lowerBound, higherBound) = self.trainset.rating_scale
+        drift[known] = (higherBound - lowerBound) * (np.linalg.norm(newUserFactors, axis=1) * itemChange +
+                                                     userChange * oldItemNorm)
+        return drift
+
+
+def initialFactors(rawIDs, factors, seed, table):
+    """
+    Nhân tố khởi tạo ~ N(0, 0.01) của các dòng có ID gốc rawIDs: mỗi số là hàm băm của
+    (seed, table, ID gốc, cột), đổi sang phân phối chuẩn bằng Box-Muller. Cùng dữ liệu luôn cho cùng
+    nhân tố, dù rating đến theo thứ tự nào và dù có thêm hay bớt người dùng, bài hát khác.
+    """
+    keys = (np.asarray(rawIDs, dtype=np.int64).astype(np.uint64)[:, None] * np.uint64(factors) +
+            np.arange(factors, dtype=np.uint64)[None, :])
+    base = np.uint64((seed * 2 + table) & 0xFFFFFFFF) * np.uint64(0xD1B54A32D192ED03)
+    uniforms = []
+    for stream in (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F)):
+        with np.errstate(over='ignore'):
+            hashes = keys * stream + base
+            hashes ^= hashes >> np.uint64(30)
+            hashes *= np.uint64(0xBF58476D1CE4E5B9)
+            hashes ^= hashes >> np.uint64(27)
+            hashes *= np.uint64(0x94D049BB133111EB)
+            hashes ^= hashes >> np.uint64(31)
+        # 53 bit cao -> số thực trong (0, 1]
+        uniforms.append(((hashes >> np.uint64(11)).astype(np.float64) + 1.0) / 2.0 ** 53)
+    return 0.01 * np.sqrt(-2.0 * np.log(uniforms[0])) * np.cos(2.0 * np.pi * uniforms[1])
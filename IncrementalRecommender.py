@@ -0,0 +1,322 @@
+import json
+import os
+import numpy as np
+from BatchRecommender import BatchRecommender
+from CatalogSnapshot import newVersion, publishVersion
+from TrainsetArrays import matchIDs, rawItemIDs, rowPositions
+
+# Version of the on-disk state layout; a state in another version is ignored
+STATE_FORMAT = 3
+
+
+class IncrementalRecommender:
+    """
+    Top-N recommendations that only recompute the listeners whose lists may have changed since
+    the previous run, using the state that run left in stateDir.
+
+    For every listener the state keeps their best depth songs (the list plus the next places)
+    with their scores and how far each score may be from the current one (slack, 0 right after
+    it was computed), and a bound on the score of any other song they have not rated. Only a
+    listener whose ratings are unchanged (a fingerprint of their (music, score) rows) can keep
+    their previous list, and only when the new scores can neither push another song into it nor
+    reorder it:
+      - songs new to the trainset, and the songs whose score for the listener the model changed
+        by an unknown amount (the algorithm's changedItems(state, users), e.g. the neighbors of a
+        re-tagged song that they listened to, for the content model), are scored directly;
+      - any other song moved by at most the drift of the listener's scores, which widens the
+        slack of the tracked songs and raises the bound on the others;
+      - the list stays when the lowest score any song of it may have beats the highest score any
+        other song may have, and no two songs of it can swap places;
+      - when the stored scores settle which songs make the list but not their order, the tracked
+        songs are scored again and re-sorted, and their slack goes back to 0.
+    Every other listener is recomputed, so a listener costs at most a few direct scores on top of
+    what a full recompute costs them, and usually much less. Tracking more places than the list
+    leaves room for the small moves of a retrain.
+
+    Score drift comes from the algorithm's scoreState() / scoreDrift(state, users): an upper
+    bound, per listener, on how much any score of a song known to both runs, outside the cells of
+    changedItems(), moved. Algorithms without them drift by an unknown amount, so every listener
+    is recomputed.
+
+    With tolerance = 0 every list comes out as a full recompute gives it, ties included (broken by
+    trainset order, see BatchRecommender.topItems). With tolerance > 0 a list is also kept when a
+    song left out, or a song of the list one place lower, could beat a song of the list by less
+    than tolerance: the list may then differ from a full recompute, but only between songs whose
+    scores are within tolerance of each other.
+
+    saveState() stores the new state; call it once the lists have been saved, so that the state
+    never describes lists that were not written.
+    """
+
+    def __init__(self, algorithm, trainset, stateDir, k=10, processes=1, tolerance=0.0, blockSize=256, depth=None):
+        self.algorithm = algorithm
+        self.trainset = trainset
+        self.stateDir = stateDir
+        self.k = k
+        self.depth = max(k, 5 * k if depth is None else depth)
+        self.tolerance = tolerance
+        self.blockSize = blockSize
+        # One more place than the tracked songs, for the best song outside them
+        self.recommender = BatchRecommender(algorithm, trainset, self.depth + 1, processes=processes)
+        self.musicIDs = rawItemIDs(trainset)
+        self.newState = None
+
+    def recommend(self, userIds):
+        """
+        Returns:
+            tuple: (changed, unchanged) lists of (raw user ID, [raw music IDs]) for the known
+                listeners of userIds, in their order: the lists that are new or differ from the
+                previous run, and the lists the previous run already gave.
+        """
+        (users, known) = self.recommender._innerUsers(userIds)
+        listenerIDs = np.asarray(known, dtype=np.int64)
+        fingerprints = self._fingerprints(users)
+
+        state = {
+            'tracked': [None] * len(users),
+            'scores': [None] * len(users),
+            'slack': [None] * len(users),
+            'floors': np.full(len(users), -np.inf),
+        }
+        affected = np.ones(len(users), dtype=bool)
+        previous = self._loadState()
+        if previous is not None:
+            affected = self._keepPrevious(previous, users, listenerIDs, fingerprints, state)
+
+        print("Recomputing recommendations for ", int(affected.sum()), " of ", len(users), " users...")
+        for (row, (items, scores)) in zip(np.flatnonzero(affected), self.recommender.recommendInnerScored(users[affected])):
+            state['tracked'][row] = self.musicIDs[items[:self.depth]]
+            state['scores'][row] = scores[:self.depth]
+            state['slack'][row] = np.zeros(min(len(items), self.depth))
+            if len(items) > self.depth:
+                state['floors'][row] = scores[self.depth]
+
+        self.newState = (listenerIDs, fingerprints, state)
+        changed = affected.copy()
+        if previous is not None:
+            changed |= self._differsFromPrevious(previous, listenerIDs, state)
+        return ([(known[row], state['tracked'][row][:self.k].tolist()) for row in np.flatnonzero(changed)],
+                [(known[row], state['tracked'][row][:self.k].tolist()) for row in np.flatnonzero(~changed)])
+
+    def _keepPrevious(self, previous, users, listenerIDs, fingerprints, state):
+        """Fills state with the previous lists that are still valid; returns which users must be recomputed."""
+        (meta, arrays) = previous
+        affected = np.ones(len(users), dtype=bool)
+        if (meta['k'], meta['depth']) != (self.k, self.depth) or \
+                tuple(meta['ratingScale']) != tuple(self.trainset.rating_scale):
+            return affected
+        # A previous run without any listener: everyone is new
+        if len(arrays['users.id']) == 0:
+            return affected
+
+        oldRows = matchIDs(arrays['users.id'], listenerIDs)
+        candidates = np.flatnonzero((oldRows >= 0) & (fingerprints == arrays['users.fingerprint'][np.maximum(oldRows, 0)]))
+        if len(candidates) == 0:
+            return affected
+        oldRows = oldRows[candidates]
+
+        # Songs that are scored directly: new to the trainset for everyone, plus per listener the
+        # songs whose score moved by an unknown amount
+        newItems = np.flatnonzero(matchIDs(arrays['items.id'], self.musicIDs) < 0)
+        changedIndptr = np.zeros(len(candidates) + 1, dtype=np.int64)
+        changedItems = np.zeros(0, dtype=np.int64)
+        drift = np.full(len(candidates), np.inf)
+        modelState = {key[len('model.'):]: value for (key, value) in arrays.items() if key.startswith('model.')}
+        if hasattr(self.algorithm, 'scoreDrift') and modelState:
+            if hasattr(self.algorithm, 'changedItems'):
+                (changedIndptr, changedItems) = self.algorithm.changedItems(modelState, users[candidates])
+            drift = np.asarray(self.algorithm.scoreDrift(modelState, users[candidates]), dtype=np.float64)
+        # Any other song outside the tracked ones now scores at most the old bound plus the drift. Cells
+        # that no component predicts hold the global mean (see BatchRecommender.scoreBlock), which was
+        # within the old bound when it was left out, and moved with it
+        oldFloors = arrays['users.floor'][oldRows]
+        floors = np.where(np.isinf(drift), np.inf, oldFloors + drift)
+        meanChange = abs(self.trainset.global_mean - meta['globalMean'])
+        floors = np.maximum(floors, np.minimum(self.trainset.global_mean, oldFloors + meanChange))
+        moved = np.maximum(drift, meanChange)
+
+        # The tracked songs of every candidate, in the order they were saved (by score)
+        (positions, counts) = rowPositions(arrays['users.offsets'], oldRows)
+        owners = np.repeat(np.arange(len(candidates)), counts)
+        trackedItems = matchIDs(self.musicIDs, arrays['users.items'][positions])
+        trackedScores = np.asarray(arrays['users.scores'][positions])
+        # How far each stored score of a tracked song may now be from its current score
+        trackedSlack = arrays['users.slack'][positions] + moved[owners]
+        starts = np.r_[0, np.cumsum(counts)]
+        keep = floors < np.inf
+        # Tracked songs that are no longer in the trainset
+        keep[owners[trackedItems < 0]] = False
+
+        # Nothing moved and the trainset orders the songs as before (ties fall the same way): the
+        # lists and bounds of the previous run still hold as they are
+        sameItems = np.array_equal(arrays['items.id'], self.musicIDs)
+        unmoved = keep & (moved == 0) & (np.diff(changedIndptr) == 0) & (len(newItems) == 0) & sameItems
+
+        # Lists that cannot stay whatever the direct scores: another song may reach their lowest possible
+        # score (see _settlesMembership). Tracked songs scored directly may move anywhere, so their lists wait
+        listed = np.arange(len(positions)) - starts[owners] < self.k
+        lowest = np.full(len(candidates), np.inf)
+        np.minimum.at(lowest, owners[listed], (trackedScores - trackedSlack)[listed])
+        changedOwners = np.repeat(np.arange(len(candidates)), np.diff(changedIndptr))
+        hasDirect = np.bincount(owners, weights=np.isin(owners * self.trainset.n_items + trackedItems,
+                                                        changedOwners * self.trainset.n_items + changedItems),
+                                minlength=len(candidates)) > 0
+        settled = np.where(counts < self.k, floors == -np.inf, (floors == -np.inf) | (floors < lowest + self.tolerance))
+        keep &= unmoved | hasDirect | settled
+
+        for start in range(0, len(candidates), self.blockSize):
+            block = np.arange(start, min(start + self.blockSize, len(candidates)))
+            block = block[keep[block] & ~unmoved[block]]
+            (items, scores, slack, direct) = ({}, {}, {}, {})
+            for position in block:
+                (first, last) = (starts[position], starts[position + 1])
+                (items[position], scores[position], slack[position]) = (trackedItems[first:last], trackedScores[first:last],
+                                                                        trackedSlack[first:last])
+                self._sortTracked(items, scores, slack, position)
+                direct[position] = np.union1d(newItems, changedItems[changedIndptr[position]:changedIndptr[position + 1]])
+                if not hasDirect[position]:
+                    keep[position] = self._settlesMembership(scores[position], slack[position], floors[position])
+            block = block[keep[block]]
+
+            # Songs scored directly: a tracked one takes its new, exact score; the best of the others
+            # joins the bound on the songs outside the tracked ones
+            columns = np.unique(np.concatenate([direct[position] for position in block] + [newItems]))
+            if len(block) and len(columns):
+                directScores = self.recommender.scoreBlock(users[candidates[block]], columns)
+                for (local, position) in enumerate(block):
+                    isDirect = np.isin(columns, direct[position])
+                    isTracked = np.isin(columns, items[position])
+                    if (isDirect & ~isTracked).any():
+                        floors[position] = max(floors[position], directScores[local, isDirect & ~isTracked].max())
+                    if hasDirect[position]:
+                        trackedDirect = np.flatnonzero(np.isin(items[position], columns[isDirect]))
+                        columnOf = np.searchsorted(columns, items[position][trackedDirect])
+                        scores[position][trackedDirect] = directScores[local, columnOf]
+                        slack[position][trackedDirect] = 0.0
+                        self._sortTracked(items, scores, slack, position)
+                    keep[position] = self._settlesMembership(scores[position], slack[position], floors[position])
+            block = block[keep[block]]
+
+            # The songs of the list are settled, but not their order: the tracked songs are scored again
+            for position in block:
+                if not self._settlesOrder(scores[position], slack[position]):
+                    scores[position] = self.recommender.scoreBlock(users[candidates[[position]]], items[position])[0]
+                    slack[position] = np.zeros(len(items[position]))
+                    self._sortTracked(items, scores, slack, position)
+                row = candidates[position]
+                state['tracked'][row] = self.musicIDs[items[position]]
+                state['scores'][row] = scores[position]
+                state['slack'][row] = slack[position]
+
+        for position in np.flatnonzero(unmoved):
+            (first, last) = (starts[position], starts[position + 1])
+            row = candidates[position]
+            state['tracked'][row] = arrays['users.items'][positions[first:last]]
+            state['scores'][row] = trackedScores[first:last]
+            state['slack'][row] = trackedSlack[first:last]
+        kept = candidates[keep]
+        affected[kept] = False
+        state['floors'][kept] = floors[keep]
+        return affected
+
+    @staticmethod
+    def _sortTracked(items, scores, slack, position):
+        # By score, ties in trainset order like BatchRecommender.topItems
+        order = np.lexsort((items[position], -scores[position]))
+        (items[position], scores[position], slack[position]) = (items[position][order], scores[position][order],
+                                                                slack[position][order])
+
+    def _settlesMembership(self, scores, slack, floor):
+        """
+        Whether the first k of the tracked songs, sorted by their scores (each within its slack of
+        its current score), are the k best of all the songs, any other song scoring at most floor.
+        """
+        listed = min(self.k, len(scores))
+        # A list shorter than k takes any song from outside
+        if listed < self.k:
+            return floor == -np.inf
+        # floor only bounds the other songs, so a tie with it is not settled; exact scores of
+        # tracked songs tie as in a full recompute, which the sort already follows
+        lowest = (scores[:listed] - slack[:listed]).min()
+        below = scores[listed:] + slack[listed:]
+        exact = (slack[listed:] == 0) & (slack[:listed] == 0).all()
+        if not exact.all() and not below[~exact].max() < lowest + self.tolerance:
+            return False
+        return floor == -np.inf or floor < lowest + self.tolerance
+
+    def _settlesOrder(self, scores, slack):
+        """Whether no two of the first k tracked songs (sorted scores, each within its slack) can swap places."""
+        listed = min(self.k, len(scores))
+        (upper, lower) = (scores[:listed] + slack[:listed], scores[:listed] - slack[:listed])
+        exact = (slack[:listed][1:] == 0) & (slack[:listed][:-1] == 0)
+        return bool(np.all(exact | (upper[1:] < lower[:-1] + self.tolerance)))
+
+    def _differsFromPrevious(self, previous, listenerIDs, state):
+        """Which of the new lists differ from the lists of the previous run (new listeners included)."""
+        (_, arrays) = previous
+        oldRows = matchIDs(arrays['users.id'], listenerIDs)
+        offsets = arrays['users.offsets']
+        differs = np.ones(len(listenerIDs), dtype=bool)
+        for row in np.flatnonzero(oldRows >= 0):
+            oldList = arrays['users.items'][offsets[oldRows[row]]:offsets[oldRows[row] + 1]][:self.k]
+            differs[row] = not np.array_equal(oldList, state['tracked'][row][:self.k])
+        return differs
+
+    def _fingerprints(self, users):
+        """A 64-bit hash of each user's (raw music ID, score) rows, independent of their order."""
+        ratingArrays = self.recommender.ratingArrays
+        with np.errstate(over='ignore'):
+            hashes = self.musicIDs[ratingArrays.items].astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+            hashes ^= ratingArrays.ratings.view(np.uint64)
+            hashes ^= hashes >> np.uint64(31)
+            hashes *= np.uint64(0xBF58476D1CE4E5B9)
+            hashes ^= hashes >> np.uint64(29)
+            sums = np.zeros(len(hashes) + 1, dtype=np.uint64)
+            np.cumsum(hashes, out=sums[1:])
+            # Wrapping sums of the row hashes, plus the row count
+            counts = np.diff(ratingArrays.indptr).astype(np.uint64)
+            fingerprints = sums[ratingArrays.indptr[1:]] - sums[ratingArrays.indptr[:-1]] + counts * np.uint64(0x94D049BB133111EB)
+        return fingerprints[users]
+
+    def _loadState(self):
+        path = os.path.join(self.stateDir, 'state.json')
+        if not os.path.isfile(path):
+            print("No previous recommendation state in ", self.stateDir)
+            return None
+        with open(path) as f:
+            meta = json.load(f)
+        if meta['format'] != STATE_FORMAT:
+            print("Ignoring recommendation state ", self.stateDir, " in format ", meta['format'])
+            return None
+        arrays = {name: np.load(os.path.join(self.stateDir, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+        return meta, arrays
+
+    def saveState(self):
+        """Write the state of the last recommend() to stateDir, replacing the previous one."""
+        (listenerIDs, fingerprints, state) = self.newState
+        tracked = state['tracked']
+        offsets = np.zeros(len(tracked) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(items) for items in tracked])
+        arrays = {
+            'users.id': listenerIDs,
+            'users.fingerprint': fingerprints,
+            'users.offsets': offsets,
+            'users.items': np.concatenate(tracked).astype(np.int64) if tracked else np.zeros(0, dtype=np.int64),
+            'users.scores': np.concatenate(state['scores']).astype(np.float64) if tracked else np.zeros(0),
+            'users.slack': np.concatenate(state['slack']).astype(np.float64) if tracked else np.zeros(0),
+            'users.floor': state['floors'],
+            'items.id': self.musicIDs,
+        }
+        if hasattr(self.algorithm, 'scoreState'):
+            arrays.update({'model.' + key: value for (key, value) in self.algorithm.scoreState().items()})
+
+        tempPath = newVersion(self.stateDir)
+        for (name, array) in arrays.items():
+            np.save(os.path.join(tempPath, name + '.npy'), np.asarray(array))
+        with open(os.path.join(tempPath, 'state.json'), 'w') as f:
+            json.dump({'format': STATE_FORMAT, 'k': self.k, 'depth': self.depth,
+                       'globalMean': float(self.trainset.global_mean), 'ratingScale': list(self.trainset.rating_scale),
+                       'arrays': sorted(arrays)}, f)
+
+        publishVersion(tempPath, self.stateDir)
+
@@ -0,0 +1,71 @@
+import sys
+import numpy as np
+from FakeDatabase import FakeDatabase
+from MusicRecommendation import MusicRecommendation
+
+# Checks the streaming loader of MusicRecommendation against plain fetchall() reads of the same
+# FakeDatabase, without Postgres. Exits with status 1 on any mismatch.
+
+failures = []
+
+
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print("FAIL:", message)
+
+
+def sameColumn(a, b):
+    return len(a) == len(b) and np.array_equal(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64),
+                                               equal_nan=True)
+
+
+db = FakeDatabase.fromSynthetic(numUsers=300, numItems=600, ratingsPerUser=20, seed=1)
+# A few scores without a value, loaded as NaN
+for row in range(0, len(db.ratings), 97):
+    db.ratings[row] = db.ratings[row][:2] + (None,)
+
+expectedRatings = db.run("SELECT listener_id, music_id, score FROM listener_music_recommend_score")
+expectedColumns = [[value if value is not None else np.nan for value in column] for column in zip(*expectedRatings)]
+expectedMusics = {row[0]: row[1] for row in db.run("SELECT ... FROM mucis m GROUP BY m.id")}
+
+for itersize in (1, 7, 1000, 100000):
+    for readPartitions in (1, 3, 10, 16):
+        label = "itersize=" + str(itersize) + " readPartitions=" + str(readPartitions)
+        db.queries = []
+        db.largestFetch = 0
+        db.maxOpenConnections = 0
+        catalog = MusicRecommendation(db, itersize=itersize, readPartitions=readPartitions).loadCatalog(reload=True)
+
+        # Partitions come back in key order, so rows are only compared as a set beyond one partition
+        loaded = (catalog.listenerIDs, catalog.musicIDs, catalog.scores)
+        if readPartitions == 1:
+            check(all(sameColumn(column, expected) for (column, expected) in zip(loaded, expectedColumns)),
+                  label + ": ratings differ from fetchall()")
+        else:
+            order = np.lexsort((loaded[1], loaded[0]))
+            expectedOrder = np.lexsort((expectedColumns[1], expectedColumns[0]))
+            check(all(sameColumn(np.asarray(column)[order], np.asarray(expected)[expectedOrder])
+                      for (column, expected) in zip(loaded, expectedColumns)),
+                  label + ": ratings differ from fetchall()")
+        check(dict(catalog.musicID_to_name) == expectedMusics, label + ": catalog differs from fetchall()")
+
+        check(db.largestFetch <= itersize, label + ": fetched " + str(db.largestFetch) + " rows at once")
+        check(any(name == "sonata_ratings" for (name, _) in db.queries), label + ": ratings not read by a named cursor")
+        check(not any("COUNT(*)" in query for (_, query) in db.queries), label + ": rows counted before the scan")
+        check(db.maxOpenConnections <= db.maxConnections, label + ": more connections than the pool allows")
+        check(db.openConnections == 0, label + ": " + str(db.openConnections) + " connections not released")
+
+# _fetchColumns grows or trims its arrays when the row count changes during the read
+musicData = MusicRecommendation(db)
+rows = expectedRatings[:50]
+chunks = [rows[start:start + 8] for start in range(0, len(rows), 8)]
+for numRows in (0, 10, 50, 200):
+    columns = musicData._fetchColumns(iter(chunks), (np.int64, np.int64, np.float64), numRows)
+    check(len(columns[0]) == len(rows) and sameColumn(columns[0], [row[0] for row in rows]),
+          "_fetchColumns with numRows=" + str(numRows))
+
+if failures:
+    print(len(failures), "check(s) failed")
+    sys.exit(1)
+print("Streaming loader matches fetchall()")
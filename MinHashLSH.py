@@ -0,0 +1,177 @@
+import time
+import numpy as np
+from scipy import sparse
+from ContentSimilarity import ContentSimilarity, SET_ATTRIBUTES
+
+
+class MinHashLSH:
+    """
+    Approximate candidate neighbors for ContentSimilarity (see ContentSimilarity.useLSH).
+
+    Every multi-valued attribute family (genres, artists, categories, periods) gets its own MinHash
+    signature of numBands * rowsPerBand hashes per item. Two items become candidates when all the
+    rows of one band agree in at least one family, i.e. with probability 1 - (1 - J^r)^b for a
+    family Jaccard index J. The exact weighted similarity is then computed for candidates only.
+    """
+
+    # Mersenne prime used by the universal hash functions
+    PRIME = (1 << 31) - 1
+
+    def __init__(self, numBands=16, rowsPerBand=4, seed=0, maxBucketSize=500):
+        self.numBands = numBands
+        self.rowsPerBand = rowsPerBand
+        self.seed = seed
+        # Buckets bigger than this (e.g. every song tagged only "pop") are split into chunks of
+        # consecutive items in tie-rank order, so one popular value cannot bring back n^2 pairs
+        self.maxBucketSize = maxBucketSize
+
+    def __repr__(self):
+        return "MinHashLSH(numBands=%r, rowsPerBand=%r, seed=%r, maxBucketSize=%r)" % (
+            self.numBands, self.rowsPerBand, self.seed, self.maxBucketSize)
+
+    def signatures(self, incidence, valueHashes):
+        """
+        MinHash signatures of the rows of an item x value incidence matrix.
+
+        Returns:
+            (items, signatures): the items having at least one value, and their int64 signatures.
+        """
+        numHashes = self.numBands * self.rowsPerBand
+        rng = np.random.RandomState(self.seed)
+        a = rng.randint(1, self.PRIME, size=numHashes).astype(np.int64)
+        b = rng.randint(0, self.PRIME, size=numHashes).astype(np.int64)
+
+        hashed = ((valueHashes[:, None] % self.PRIME) * a[None, :] + b[None, :]) % self.PRIME
+        counts = np.diff(incidence.indptr)
+        items = np.flatnonzero(counts > 0)
+        if len(items) == 0:
+            return items, np.zeros((0, numHashes), dtype=np.int64)
+        return items, np.minimum.reduceat(hashed[incidence.indices], incidence.indptr[items], axis=0)
+
+    def candidates(self, engine):
+        """
+        Symmetric n_items x n_items boolean CSR matrix of the candidate pairs of an engine.
+        """
+        n_items = engine.n_items
+        # Pairs as sorted unique keys row * n_items + col
+        keys = np.zeros(0, dtype=np.int64)
+        for (name, _) in SET_ATTRIBUTES:
+            (items, signatures) = self.signatures(engine.incidence[name], engine.valueHashes[name])
+            if len(items) == 0:
+                continue
+
+            # Items with the same value set collide in every band: pair them up once, then band the
+            # distinct signatures only
+            (distinct, group) = np.unique(signatures, axis=0, return_inverse=True)
+            group = group.ravel()
+            (rows, cols) = self._bucketPairs(items, group, engine.tieRank)
+            familyKeys = [keys, rows * n_items + cols]
+
+            # Buckets holding several distinct sets, each distinct bucket once across all bands
+            buckets = set()
+            for band in range(self.numBands):
+                columns = distinct[:, band * self.rowsPerBand:(band + 1) * self.rowsPerBand]
+                (_, bucket) = np.unique(columns, axis=0, return_inverse=True)
+                bucket = bucket.ravel()
+                order = np.argsort(bucket, kind='stable')
+                bounds = np.flatnonzero(np.diff(bucket[order])) + 1
+                buckets.update(tuple(members) for members in np.split(order, bounds) if len(members) > 1)
+
+            if buckets:
+                (members, labels) = self._bucketMembers(sorted(buckets), items, group)
+                (rows, cols) = self._bucketPairs(members, labels, engine.tieRank)
+                familyKeys.append(rows * n_items + cols)
+            keys = np.sort(np.concatenate(familyKeys))
+            keys = keys[np.r_[True, keys[1:] != keys[:-1]]]
+
+        indptr = np.searchsorted(keys, np.arange(n_items + 1, dtype=np.int64) * n_items)
+        return sparse.csr_matrix((np.ones(len(keys), dtype=bool), (keys % n_items).astype(np.int32), indptr),
+                                 shape=(n_items, n_items))
+
+    @staticmethod
+    def _bucketMembers(buckets, items, group):
+        """Items of each bucket of distinct sets, as (items, bucket label) arrays."""
+        order = np.argsort(group, kind='stable')
+        groupStarts = np.searchsorted(group[order], np.arange(group.max() + 2))
+        bucketGroups = np.concatenate([np.asarray(bucket) for bucket in buckets])
+        bucketLabels = np.repeat(np.arange(len(buckets)), [len(bucket) for bucket in buckets])
+
+        sizes = groupStarts[bucketGroups + 1] - groupStarts[bucketGroups]
+        offsets = np.repeat(np.cumsum(sizes) - sizes, sizes)
+        positions = np.repeat(groupStarts[bucketGroups], sizes) + (np.arange(sizes.sum()) - offsets)
+        return items[order[positions]], np.repeat(bucketLabels, sizes)
+
+    def _bucketPairs(self, items, buckets, tieRank):
+        """All ordered pairs (i, j), i != j, of items sharing a bucket (or a chunk of an oversized one)."""
+        order = np.lexsort((tieRank[items], buckets))
+        (items, buckets) = (items[order], buckets[order])
+
+        # Group id of every item: its bucket, further split into chunks of maxBucketSize
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        position = np.arange(len(items)) - np.repeat(starts, np.diff(np.r_[starts, len(items)]))
+        chunk = position // self.maxBucketSize if self.maxBucketSize else np.zeros(len(items), dtype=np.int64)
+        group = np.cumsum(np.r_[True, (buckets[1:] != buckets[:-1]) | (chunk[1:] != chunk[:-1])]) - 1
+
+        groupStarts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+        groupSizes = np.diff(np.r_[groupStarts, len(items)])
+        size = groupSizes[group]
+        start = groupStarts[group]
+
+        # Pair every item with every member of its group
+        left = np.repeat(np.arange(len(items)), size)
+        offsets = np.repeat(np.cumsum(size) - size, size)
+        right = np.repeat(start, size) + (np.arange(len(left)) - offsets)
+        keep = left != right
+        return items[left[keep]], items[right[keep]]
+
+
+def recallReport(musicID_to_details, musicIDs, settings, numNeighbors=50, sampleSize=500, seed=0):
+    """
+    So sánh chế độ LSH với kết quả chính xác trên một mẫu bài hát, để chọn số band và số hàng mỗi band.
+
+    Args:
+        settings (list): Danh sách (numBands, rowsPerBand) cần thử.
+        numNeighbors (int): Số láng giềng giữ lại cho mỗi bài hát (M).
+        sampleSize (int): Số bài hát được lấy mẫu để đo recall.
+
+    Returns:
+        list: Mỗi phần tử là dict gồm recall@M, số cặp ứng viên và thời gian tương ứng.
+    """
+    exactEngine = ContentSimilarity(musicID_to_details, musicIDs)
+    rng = np.random.RandomState(seed)
+    sample = np.sort(rng.choice(exactEngine.n_items, size=min(sampleSize, exactEngine.n_items), replace=False))
+    exact = exactEngine.neighborRows(sample, numNeighbors)
+    exactPairs = len(exactEngine._candidatePairs(sample)[1]) / max(len(sample), 1)
+    print("Exact inverted index: {:.1f} candidate pairs/item".format(exactPairs))
+
+    print("{:<8} {:<8} {:<12} {:<14} {:<10}".format("Bands", "Rows", "Recall@M", "Pairs/item", "Seconds"))
+    report = []
+    for (numBands, rowsPerBand) in settings:
+        started = time.time()
+        engine = ContentSimilarity(musicID_to_details, musicIDs)
+        engine.useLSH(MinHashLSH(numBands, rowsPerBand, seed=seed))
+        approximate = engine.neighborRows(sample, numNeighbors)
+        seconds = time.time() - started
+
+        found = total = 0
+        for ((exactIndices, _), (approximateIndices, _)) in zip(exact, approximate):
+            found += len(np.intersect1d(exactIndices, approximateIndices))
+            total += len(exactIndices)
+        row = {
+            'numBands': numBands,
+            'rowsPerBand': rowsPerBand,
+            'recall': found / total if total else 1.0,
+            'pairsPerItem': engine.lshCandidates.nnz / max(engine.n_items, 1),
+            'seconds': seconds
+        }
+        print("{:<8} {:<8} {:<12.4f} {:<14.1f} {:<10.2f}".format(
+            numBands, rowsPerBand, row['recall'], row['pairsPerItem'], seconds))
+        report.append(row)
+    return report
+
+
+if __name__ == "__main__":
+    from SyntheticData import makeCatalog
+
+    details = makeCatalog(numItems=5000, seed=2, numArtists=1500, numGenres=60)
+    recallReport(details, list(details.keys()), [(8, 2), (16, 2), (16, 4), (32, 4), (32, 8)])
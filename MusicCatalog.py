@@ -0,0 +1,177 @@
+from types import MappingProxyType
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from surprise import Dataset, Reader
+
+
+class MusicCatalog:
+    """
+    Read-only snapshot of one load of the catalog (names and details of every song) and of the
+    listener ratings, shared by all the algorithms of a run instead of each one querying Postgres.
+
+    The ratings are kept as columns (listener, music, score) of every row of the ratings table,
+    scores without a value included as NaN, so that the rating data set, the popularity ranks and
+    the listener list all come from a single scan of the table.
+
+    The mappings are exposed as MappingProxyType views and the details lists as tuples, so no
+    algorithm can modify what the others see. The snapshot pickles as plain dicts and arrays,
+    which makes it cheap to hand to worker processes (forked workers simply share it). A catalog
+    opened from an on-disk snapshot (see CatalogSnapshot) pickles as the snapshot's path.
+
+    watermark ({'column', 'value'} or None) is the highest value of the ratings table's watermark
+    column when the ratings were read; MusicRecommendation.refreshSnapshot only reads rows past it.
+    """
+
+    snapshotPath = None
+
+    def __init__(self, musicID_to_name, musicID_to_details, listenerIDs, musicIDs, scores, watermark=None):
+        self.watermark = watermark
+        self._names = dict(musicID_to_name)
+        self._details = {musicID: {key: tuple(value) if isinstance(value, list) else value
+                                   for (key, value) in details.items()}
+                         for (musicID, details) in musicID_to_details.items()}
+        self._ratings = (np.asarray(listenerIDs), np.asarray(musicIDs), np.asarray(scores, dtype=np.float64))
+        self._freeze()
+
+    @classmethod
+    def fromMappings(cls, musicID_to_name, musicID_to_details, ratings, snapshotPath=None, watermark=None):
+        """
+        Wrap read-only mappings and rating columns as they are, without copying them (the lazy
+        columnar views of CatalogSnapshot.loadSnapshot).
+        """
+        catalog = cls.__new__(cls)
+        catalog.snapshotPath = snapshotPath
+        catalog.watermark = watermark
+        catalog._ratings = tuple(ratings)
+        catalog._nameIndex = None
+        catalog.musicID_to_name = musicID_to_name
+        catalog.musicID_to_details = musicID_to_details
+        return catalog
+
+    def _freeze(self):
+        for array in self._ratings:
+            array.flags.writeable = False
+        self._nameIndex = None
+        self.musicID_to_name = MappingProxyType(self._names)
+        self.musicID_to_details = MappingProxyType({musicID: MappingProxyType(details)
+                                                   for (musicID, details) in self._details.items()})
+
+    @property
+    def name_to_musicID(self):
+        # Built on first use: only getMusicID needs it
+        if self._nameIndex is None:
+            self._nameIndex = MappingProxyType({name: musicID for (musicID, name) in self.musicID_to_name.items()})
+        return self._nameIndex
+
+    def __getstate__(self):
+        if self.snapshotPath is not None:
+            return {'snapshot': self.snapshotPath}
+        # The views cannot be pickled; they are rebuilt from the plain data on the other side
+        return {'names': self._names, 'details': self._details, 'ratings': self._ratings,
+                'watermark': self.watermark}
+
+    def __setstate__(self, state):
+        if 'snapshot' in state:
+            from CatalogSnapshot import loadSnapshot
+            self.__dict__.update(loadSnapshot(state['snapshot']).__dict__)
+            return
+        self._names = state['names']
+        self._details = state['details']
+        self._ratings = tuple(state['ratings'])
+        self.watermark = state.get('watermark')
+        self._freeze()
+
+    @property
+    def listenerIDs(self):
+        return self._ratings[0]
+
+    @property
+    def musicIDs(self):
+        return self._ratings[1]
+
+    @property
+    def scores(self):
+        return self._ratings[2]
+
+    def ratingsDataset(self):
+        """
+        A new surprise Dataset of the ratings that have a score, sorted by (listener_id, music_id):
+        the inner IDs, and everything trained on them, do not depend on the order the rows were read in.
+        """
+        rated = np.flatnonzero(~np.isnan(self.scores))
+        rated = rated[np.lexsort((self.musicIDs[rated], self.listenerIDs[rated]))]
+        ratings = pd.DataFrame({'listener_id': self.listenerIDs[rated], 'music_id': self.musicIDs[rated],
+                                'score': self.scores[rated]})
+        reader = Reader(line_format='user item rating', sep=',')
+        return Dataset.load_from_df(ratings[['listener_id', 'music_id', 'score']], reader)
+
+    def popularityRanks(self):
+        """
+        Rank of every song by its number of rows (1 = most listened), ties in order of first
+        appearance in the table, as a defaultdict(int) like MusicRecommendation always returned.
+        """
+        (musicIDs, firstRows, inverse) = np.unique(self.musicIDs, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), minlength=len(musicIDs))
+        order = np.lexsort((firstRows, -counts))
+        return defaultdict(int, zip(musicIDs[order].tolist(), range(1, len(order) + 1)))
+
+    def listeners(self):
+        """Every listener ID of the ratings table, sorted."""
+        return np.unique(self.listenerIDs).tolist()
+
+    def getMusicName(self, musicID): return self.musicID_to_name.get(musicID, "")
+    def getMusicID(self, musicName): return self.name_to_musicID.get(musicName, 0)
+    def getNationality(self, musicID): return self.musicID_to_details.get(musicID, {}).get('nationality', "")
+    def getContributorID(self, musicID): return self.musicID_to_details.get(musicID, {}).get('contributor_id', "")
+    def getArtistIDs(self, musicID): return self.musicID_to_details.get(musicID, {}).get('artist_ids', ())
+    def getCategoryIDs(self, musicID): return self.musicID_to_details.get(musicID, {}).get('category_ids', ())
+    def getGenreIDs(self, musicID): return self.musicID_to_details.get(musicID, {}).get('genre_ids', ())
+    def getPeriodIDs(self, musicID): return self.musicID_to_details.get(musicID, {}).get('period_ids', ())
+
+
+def mergeRatings(ratings, changes):
+    """
+    Apply changed rows to rating columns (listener, music, score): a change to an existing
+    (listener, music) pair replaces its score in place, other changes are appended. Returns the
+    merged columns and the number of replaced rows. Pairs are assumed unique in both inputs.
+    """
+    (keys, changedKeys) = _ratingKeys(ratings, changes)
+    order = np.argsort(keys, kind='stable')
+    positions = np.searchsorted(keys[order], changedKeys)
+    positions[positions == len(keys)] = 0
+    rows = order[positions] if len(keys) else positions
+    existing = (keys[rows] == changedKeys) if len(keys) else np.zeros(len(changedKeys), dtype=bool)
+
+    scores = np.array(ratings[2], dtype=np.float64)
+    scores[rows[existing]] = np.asarray(changes[2], dtype=np.float64)[existing]
+    appended = ~existing
+    merged = (np.concatenate([ratings[0], np.asarray(changes[0])[appended]]).astype(np.int64),
+              np.concatenate([ratings[1], np.asarray(changes[1])[appended]]).astype(np.int64),
+              np.concatenate([scores, np.asarray(changes[2], dtype=np.float64)[appended]]))
+    return merged, int(existing.sum())
+
+
+def keepRatings(ratings, keys, listeners=None):
+    """
+    The rows of rating columns whose (listener, music) pair is in keys (listener and music ID
+    columns of the rows still in the table), and the number of rows dropped. With listeners,
+    keys only cover those listeners and the rows of every other listener are kept.
+    """
+    (ratingKeys, presentKeys) = _ratingKeys(ratings, keys)
+    kept = np.isin(ratingKeys, presentKeys)
+    if listeners is not None:
+        kept |= ~np.isin(ratings[0], listeners)
+    return tuple(np.asarray(column)[kept] for column in ratings), int(len(kept) - kept.sum())
+
+
+def _ratingKeys(ratings, others):
+    """One int64 key per (listener, music) pair of ratings and of others, comparable between the two."""
+    musicIDs = np.concatenate([np.asarray(ratings[1], dtype=np.int64), np.asarray(others[1], dtype=np.int64)])
+    listenerIDs = np.concatenate([np.asarray(ratings[0], dtype=np.int64), np.asarray(others[0], dtype=np.int64)])
+    if len(musicIDs) == 0:
+        return musicIDs, musicIDs
+    # Shift the music IDs to start at 0 so listener * span + music is unique per pair
+    lowest = musicIDs.min()
+    keys = listenerIDs * (musicIDs.max() - lowest + 1) + (musicIDs - lowest)
+    return keys[:len(ratings[1])], keys[len(ratings[1]):]
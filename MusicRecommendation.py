@@ -1,26 +1,32 @@
 from dotenv import load_dotenv
 load_dotenv()
 import psycopg2
-from surprise import Dataset, Reader
-from collections import defaultdict
-import pandas as pd
+import numpy as np
 import os
 from psycopg2 import pool
 import redis
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from MusicCatalog import MusicCatalog, mergeRatings, keepRatings
+from CatalogSnapshot import saveSnapshot, loadSnapshot
+from TrainsetArrays import matchIDs
 
 
 
+# Kiểu của các cột listener_id, music_id, score khi tải vào mảng
+RATING_DTYPES = (np.int64, np.int64, np.float64)
+
 # --- CÁC LỚP KẾT NỐI (DatabaseConnection, RedisConnection) KHÔNG THAY ĐỔI ---
 
-# Lớp DatabaseConnection không thay đổi
+# ThreadedConnectionPool: các luồng đọc song song của MusicRecommendation (readPartitions) dùng chung pool
 class DatabaseConnection:
     _instance = None
     _connection_pool = None
+    MAX_CONNECTIONS = 10
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(DatabaseConnection, cls).__new__(cls)
-            cls._connection_pool = pool.SimpleConnectionPool(1, 10, host=os.getenv('DB_HOST'), database=os.getenv('DB_NAME'), user=os.getenv('DB_USERNAME'), password=os.getenv('DB_PASSWORD'), port=os.getenv('DB_PORT'))
+            cls._connection_pool = pool.ThreadedConnectionPool(1, cls.MAX_CONNECTIONS, host=os.getenv('DB_HOST'), database=os.getenv('DB_NAME'), user=os.getenv('DB_USERNAME'), password=os.getenv('DB_PASSWORD'), port=os.getenv('DB_PORT'))
         return cls._instance
     def get_connection(self): return self._connection_pool.getconn()
     def release_connection(self, connection): self._connection_pool.putconn(connection)
@@ -31,9 +37,34 @@ class MusicRecommendation:
     musicID_to_name = {}
     name_to_musicID = {}
     musicID_to_details = {}  # Cấu trúc được mở rộng
+    # MusicCatalog đã tải, dùng chung cho mọi đối tượng trong tiến trình
+    _catalog = None
 
-    def __init__(self):
-        self.db_connection_manager = DatabaseConnection()
+    def __init__(self, db_connection_manager=None, redis_client=None, itersize=20000, readPartitions=1,
+                 snapshotPath=None, watermarkColumn=None):
+        """
+        Args:
+            db_connection_manager: Mặc định là DatabaseConnection (Postgres). Có thể truyền một đối tượng
+                khác có get_connection/release_connection, ví dụ FakeDatabase để chạy không cần Postgres;
+                khi đó Redis chỉ được dùng nếu redis_client được truyền vào.
+            itersize (int): Số dòng mỗi lần đọc từ cursor phía server khi tải dữ liệu.
+            readPartitions (int): Số khoảng khóa được đọc song song khi tải dữ liệu (1: đọc tuần tự).
+            snapshotPath (str): Thư mục snapshot (xem exportSnapshot) dùng thay cho Postgres; không mở
+                kết nối cơ sở dữ liệu nào.
+            watermarkColumn (str): Cột tăng dần mỗi khi một dòng điểm được thêm hoặc sửa (thời điểm cập
+                nhật hoặc id tăng dần), dùng bởi refreshSnapshot để chỉ đọc các dòng đã thay đổi.
+        """
+        self.itersize = itersize
+        self.readPartitions = readPartitions
+        self.watermarkColumn = watermarkColumn
+        if snapshotPath is not None:
+            self.importSnapshot(snapshotPath)
+        if db_connection_manager is not None:
+            self.db_connection_manager = db_connection_manager
+            self.redis_client = redis_client
+            return
+
+        self.db_connection_manager = DatabaseConnection() if snapshotPath is None else None
         # self.redis_connection = RedisConnection().get_connection()
         # Redis Connection
         REDIS_HOST_NAME = os.getenv("REDIS_HOST_NAME")
@@ -63,21 +94,204 @@ class MusicRecommendation:
         """
         Tải dữ liệu điểm nghe nhạc và thông tin chi tiết của bài hát,
         bao gồm nghệ sĩ, danh mục, thể loại và giai đoạn.
+        Dữ liệu lấy từ MusicCatalog dùng chung của tiến trình (xem loadCatalog).
         """
-        self.musicID_to_name = {}
-        self.name_to_musicID = {}
-        self.musicID_to_details = {}
+        catalog = self.loadCatalog()
+        self.musicID_to_name = catalog.musicID_to_name
+        self.name_to_musicID = catalog.name_to_musicID
+        self.musicID_to_details = catalog.musicID_to_details
+        return catalog.ratingsDataset()
 
-        connection = self._connect_db()
-        cursor = connection.cursor()
+    def loadCatalog(self, reload=False):
+        """
+        MusicCatalog (chỉ đọc) của tiến trình: truy vấn Postgres ở lần gọi đầu tiên (hoặc khi
+        reload=True), các lần gọi sau, kể cả từ đối tượng MusicRecommendation khác, dùng lại nó.
+        """
+        if MusicRecommendation._catalog is None or reload:
+            MusicRecommendation._catalog = self._queryCatalog()
+        return MusicRecommendation._catalog
 
-        # Tải dữ liệu điểm nghe nhạc (không thay đổi)
-        cursor.execute("SELECT listener_id, music_id, score FROM listener_music_recommend_score")
-        ratings = cursor.fetchall()
-        reader = Reader(line_format='user item rating', sep=',')
-        ratings_df = pd.DataFrame(ratings, columns=['listener_id', 'music_id', 'score'])
-        ratings_df.dropna(subset=['score'], inplace=True)
-        ratingsDataset = Dataset.load_from_df(ratings_df[['listener_id', 'music_id', 'score']], reader)
+    def exportSnapshot(self, directory):
+        """Ghi catalog và bảng điểm đã tải ra thư mục snapshot dạng cột (xem CatalogSnapshot)."""
+        saveSnapshot(self.loadCatalog(), directory)
+
+    def importSnapshot(self, directory):
+        """
+        Dùng snapshot đã export làm MusicCatalog của tiến trình: các mảng được mmap nên tải gần như
+        tức thì, và loadMusicData/getPopularityRanks/loadListeners không truy vấn Postgres nữa.
+        """
+        MusicRecommendation._catalog = loadSnapshot(directory)
+        return MusicRecommendation._catalog
+
+    def refreshSnapshot(self, directory):
+        """
+        Cập nhật snapshot trong directory bằng các dòng điểm đã thay đổi kể từ watermark lưu trong nó
+        (cột watermarkColumn, ví dụ thời điểm cập nhật), thay vì đọc lại toàn bộ bảng; catalog bài hát
+        vẫn được đọc lại đầy đủ. Nếu chưa có snapshot hoặc watermark thì tải đầy đủ. Sau đó snapshot
+        mới được dùng làm MusicCatalog của tiến trình.
+        """
+        base = None
+        if os.path.isfile(os.path.join(directory, 'snapshot.json')):
+            base = loadSnapshot(directory)
+        if (base is None or self.watermarkColumn is None or base.watermark is None
+                or base.watermark['column'] != self.watermarkColumn or base.watermark['value'] is None):
+            print("No usable watermark in ", directory, ", loading every rating")
+            catalog = self._queryCatalog()
+        else:
+            catalog = self._queryDelta(base)
+        saveSnapshot(catalog, directory)
+        return self.importSnapshot(directory)
+
+    def _queryCatalog(self):
+        # Watermark lấy trước khi đọc: dòng nào thay đổi trong lúc đọc sẽ được đọc lại ở lần cập nhật sau
+        watermark = self._currentWatermark()
+
+        # Với readPartitions > 1, bảng điểm được chia theo khoảng listener_id và catalog theo khoảng
+        # music_id; các khoảng được đọc song song trên các kết nối riêng của pool rồi nối lại theo thứ tự.
+        # Mọi khoảng được xác định trước khi đọc: khi các luồng đã giữ hết kết nối của pool, luồng chính
+        # không được lấy thêm kết nối nào nữa
+        ratingRanges = [None]
+        if self.readPartitions > 1:
+            ratingRanges = self._keyRanges("SELECT MIN(listener_id), MAX(listener_id) FROM listener_music_recommend_score")
+        musicRanges = self._musicRanges()
+        # Số dòng ước tính của mỗi khoảng, để cấp phát sẵn các mảng mà không phải đếm trước
+        capacity = self._estimatedRatingRows() // len(ratingRanges)
+
+        workers = min(self.readPartitions, DatabaseConnection.MAX_CONNECTIONS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            ratingParts = executor.map(lambda keyRange: self._readRatings(keyRange, capacity), ratingRanges)
+            (musicID_to_name, musicID_to_details) = self._queryMusics(executor, musicRanges)
+            ratingParts = list(ratingParts)
+
+        (listenerIDs, musicIDs, scores) = (np.concatenate(column) for column in zip(*ratingParts))
+        return MusicCatalog(musicID_to_name, musicID_to_details, listenerIDs, musicIDs, scores, watermark)
+
+    def _queryDelta(self, base):
+        """
+        MusicCatalog gồm các dòng điểm của base đã gộp với các dòng thay đổi sau watermark của base.
+
+        Bảng không ghi lại các dòng đã xóa, nên việc phát hiện xóa vẫn cần một lần quét: số dòng của
+        từng người nghe (GROUP BY listener_id, quét được chỉ trên chỉ mục) được so với kết quả gộp, và
+        chỉ các khóa của những người nghe bị lệch mới được đọc lại. Cả hai lần đọc chỉ lấy các dòng có
+        watermark không quá watermark mới, nên một dòng thêm vào trong lúc đọc không thể bù cho một dòng
+        bị xóa; dòng được cập nhật sau watermark mới chỉ làm người nghe của nó bị đọc lại thừa.
+        """
+        watermark = self._currentWatermark()
+        bounds = (base.watermark['value'], watermark['value'])
+        musicRanges = self._musicRanges()
+        workers = min(self.readPartitions, DatabaseConnection.MAX_CONNECTIONS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            changes = executor.submit(self._readRatingColumns, "listener_id, music_id, score", RATING_DTYPES,
+                                      " WHERE " + self.watermarkColumn + " > %s AND " + self.watermarkColumn +
+                                      " <= %s", bounds)
+            (musicID_to_name, musicID_to_details) = self._queryMusics(executor, musicRanges)
+            changes = changes.result()
+
+        (ratings, numUpdated) = mergeRatings((base.listenerIDs, base.musicIDs, base.scores), changes)
+        # Mọi dòng hiện có đều nằm trong kết quả gộp (hoặc trong base, hoặc thay đổi sau watermark), nên
+        # người nghe nào có ít dòng trong bảng hơn trong kết quả gộp là người có dòng đã bị xóa
+        (listenerIDs, mergedCounts) = np.unique(ratings[0], return_counts=True)
+        tableCounts = self._readRatingColumns("listener_id, COUNT(*)", (np.int64, np.int64),
+                                              " WHERE " + self.watermarkColumn + " <= %s GROUP BY listener_id",
+                                              (watermark['value'],), capacity=len(listenerIDs))
+        counts = np.zeros(len(listenerIDs), dtype=np.int64)
+        positions = matchIDs(tableCounts[0], listenerIDs)
+        counts[positions >= 0] = tableCounts[1][positions[positions >= 0]]
+        suspects = listenerIDs[counts != mergedCounts]
+        numDeleted = 0
+        if len(suspects):
+            keys = self._readRatingColumns("listener_id, music_id", RATING_DTYPES[:2],
+                                           " WHERE listener_id = ANY(%s)", (suspects.tolist(),))
+            (ratings, numDeleted) = keepRatings(ratings, keys, suspects)
+        print("Rating changes since ", base.watermark['value'], ": ", len(changes[0]) - numUpdated, " new, ",
+              numUpdated, " updated, ", numDeleted, " deleted")
+
+        return MusicCatalog(musicID_to_name, musicID_to_details, *ratings, watermark=watermark)
+
+    def _currentWatermark(self):
+        if self.watermarkColumn is None:
+            return None
+        value = self._fetchOne("SELECT MAX(" + self.watermarkColumn + ") FROM listener_music_recommend_score")[0]
+        # Thời điểm được lưu dạng ISO 8601 trong snapshot.json; Postgres tự chuyển lại khi so sánh
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        return {'column': self.watermarkColumn, 'value': value}
+
+    def _musicRanges(self):
+        if self.readPartitions > 1:
+            return self._keyRanges("SELECT MIN(id), MAX(id) FROM mucis")
+        return [None]
+
+    def _queryMusics(self, executor, musicRanges):
+        """Tên và thông tin chi tiết của mọi bài hát, đọc theo các khoảng music_id (xem _musicRanges) trên executor."""
+        musicID_to_name = {}
+        musicID_to_details = {}
+        for (names, details) in executor.map(self._readMusics, musicRanges):
+            musicID_to_name.update(names)
+            musicID_to_details.update(details)
+        return musicID_to_name, musicID_to_details
+
+    def _estimatedRatingRows(self):
+        """
+        Số dòng của bảng điểm theo thống kê của Postgres (pg_class.reltuples, cập nhật bởi ANALYZE và
+        VACUUM), không phải quét cả bảng như COUNT(*); 0 nếu bảng chưa từng được thống kê.
+        """
+        row = self._fetchOne("SELECT reltuples FROM pg_class WHERE relname = 'listener_music_recommend_score'")
+        if row is None or row[0] is None:
+            return 0
+        # reltuples là -1 với bảng chưa được thống kê (Postgres 14 trở đi)
+        return max(int(row[0]), 0)
+
+    def _fetchOne(self, query, params=None):
+        connection = self._connect_db()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+            cursor.close()
+        finally:
+            self._release_db_connection(connection)
+        return row
+
+    def _keyRanges(self, query):
+        """Chia khoảng [MIN, MAX] của khóa trả về bởi query thành readPartitions khoảng nửa mở [start, stop)."""
+        (lowest, highest) = self._fetchOne(query)
+        if lowest is None:
+            return [None]
+        bounds = np.unique(np.linspace(lowest, highest + 1, self.readPartitions + 1).astype(np.int64))
+        return [(int(start), int(stop)) for (start, stop) in zip(bounds[:-1], bounds[1:])]
+
+    def _readRatings(self, keyRange, capacity=0):
+        """
+        Các cột (listener_id, music_id, score) của bảng điểm nghe nhạc, hoặc chỉ của các dòng có
+        listener_id trong keyRange = (start, stop); capacity là số dòng ước tính.
+        """
+        # Quét bảng điểm nghe nhạc một lần duy nhất thành các mảng theo cột; độ phổ biến và danh sách
+        # người nghe cũng được tính từ các mảng này (xem MusicCatalog)
+        if keyRange is None:
+            return self._readRatingColumns("listener_id, music_id, score", RATING_DTYPES, capacity=capacity)
+        return self._readRatingColumns("listener_id, music_id, score", RATING_DTYPES,
+                                       " WHERE listener_id >= %s AND listener_id < %s", keyRange, capacity)
+
+    def _readRatingColumns(self, columns, dtypes, where="", params=None, capacity=0):
+        """
+        Các cột columns của những dòng thỏa where trong bảng điểm nghe nhạc, đọc từng khối itersize dòng
+        qua cursor phía server. Các mảng được cấp phát sẵn capacity dòng (số dòng ước tính, không đếm
+        bằng COUNT(*)) rồi nới rộng gấp đôi mỗi khi đầy.
+        """
+        connection = self._connect_db()
+        try:
+            chunks = self._streamRows(connection, "sonata_ratings",
+                                      "SELECT " + columns + " FROM listener_music_recommend_score" + where, params)
+            return self._fetchColumns(chunks, dtypes, capacity)
+        finally:
+            self._release_db_connection(connection)
+
+    def _readMusics(self, keyRange):
+        """Tên và thông tin chi tiết của mọi bài hát, hoặc chỉ của các bài có id trong keyRange = (start, stop)."""
+        where = ""
+        if keyRange is not None:
+            where = "WHERE m.id >= %s AND m.id < %s"
 
         # --- CẬP NHẬT TRUY VẤN SQL ĐỂ JOIN CÁC BẢNG ---
         # Sử dụng LEFT JOIN để đảm bảo tất cả các bài hát đều được lấy ra,
@@ -99,31 +313,68 @@ class MusicRecommendation:
         LEFT JOIN music_categories mc ON m.id = mc.music_id
         LEFT JOIN music_genres mg ON m.id = mg.music_id
         LEFT JOIN music_periods mp ON m.id = mp.music_id
+        """ + where + """
         GROUP BY
             m.id, m.name, m.nationality, m.uploaded_by_id
         """
-        cursor.execute(music_details_query)
-        musics = cursor.fetchall()
-
-        for row in musics:
-            musicID, musicName, nationality, contributor_id, artist_ids, category_ids, genre_ids, period_ids = row
-            
-            self.musicID_to_name[musicID] = musicName
-            self.name_to_musicID[musicName] = musicID
-            self.musicID_to_details[musicID] = {
-                'nationality': nationality,
-                'contributor_id': contributor_id,
-                # Chuyển đổi giá trị None (nếu có) thành danh sách rỗng
-                'artist_ids': artist_ids or [],
-                'category_ids': category_ids or [],
-                'genre_ids': genre_ids or [],
-                'period_ids': period_ids or []
-            }
+        musicID_to_name = {}
+        musicID_to_details = {}
 
-        cursor.close()
-        self._release_db_connection(connection)
-
-        return ratingsDataset
+        connection = self._connect_db()
+        try:
+            for musics in self._streamRows(connection, "sonata_musics", music_details_query, keyRange):
+                for row in musics:
+                    musicID, musicName, nationality, contributor_id, artist_ids, category_ids, genre_ids, period_ids = row
+
+                    musicID_to_name[musicID] = musicName
+                    musicID_to_details[musicID] = {
+                        'nationality': nationality,
+                        'contributor_id': contributor_id,
+                        # Chuyển đổi giá trị None (nếu có) thành danh sách rỗng
+                        'artist_ids': artist_ids or [],
+                        'category_ids': category_ids or [],
+                        'genre_ids': genre_ids or [],
+                        'period_ids': period_ids or []
+                    }
+        finally:
+            self._release_db_connection(connection)
+
+        return musicID_to_name, musicID_to_details
+
+    def _streamRows(self, connection, name, query, params=None):
+        """
+        Chạy query trên một cursor có tên (cursor phía server) và trả về từng khối itersize dòng,
+        thay vì để fetchall() kéo toàn bộ kết quả về thành tuple cùng một lúc.
+        """
+        cursor = connection.cursor(name=name)
+        cursor.itersize = self.itersize
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.itersize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def _fetchColumns(self, chunks, dtypes, numRows=0):
+        """
+        Ghi các khối dòng vào một mảng NumPy cấp phát sẵn cho mỗi cột, nên bộ nhớ lúc tải chỉ lớn
+        hơn các mảng kết quả một khối. Giá trị NULL trong cột float thành NaN.
+        numRows là số dòng dự kiến; mảng được nới rộng gấp đôi mỗi khi có nhiều dòng hơn.
+        """
+        columns = [np.empty(numRows, dtype=dtype) for dtype in dtypes]
+        filled = 0
+        for rows in chunks:
+            if filled + len(rows) > len(columns[0]):
+                capacity = max(filled + len(rows), 2 * len(columns[0]))
+                columns = [np.resize(column, capacity) for column in columns]
+            for (column, values) in zip(columns, zip(*rows)):
+                column[filled:filled + len(rows)] = values
+            filled += len(rows)
+        # Ít dòng hơn dự kiến: sao chép để không giữ phần dư của mảng cấp phát sẵn
+        return [column if filled == len(column) else column[:filled].copy() for column in columns]
 
     # --- CÁC PHƯƠNG THỨC GETTER CŨ VÀ MỚI ---
 
@@ -164,31 +415,12 @@ class MusicRecommendation:
         return userRatings
 
     def getPopularityRanks(self):
-        # ... không thay đổi ...
-        ratings = defaultdict(int)
-        rankings = defaultdict(int)
-        connection = self._connect_db()
-        cursor = connection.cursor()
-        cursor.execute("SELECT music_id FROM listener_music_recommend_score")
-        ratings_data = cursor.fetchall()
-        for row in ratings_data: ratings[row[0]] += 1
-        rank = 1
-        for musicID, ratingCount in sorted(ratings.items(), key=lambda x: x[1], reverse=True):
-            rankings[musicID] = rank
-            rank += 1
-        cursor.close()
-        self._release_db_connection(connection)
-        return rankings
+        # Tính từ lần quét bảng điểm của loadCatalog, không truy vấn lại
+        return self.loadCatalog().popularityRanks()
 
     def loadListeners(self):
-        # ... không thay đổi ...
-        connection = self._connect_db()
-        cursor = connection.cursor()
-        cursor.execute("SELECT DISTINCT listener_id FROM listener_music_recommend_score")
-        users = cursor.fetchall()
-        cursor.close()
-        self._release_db_connection(connection)
-        return [user[0] for user in users]
+        # Tính từ lần quét bảng điểm của loadCatalog, không truy vấn lại
+        return self.loadCatalog().listeners()
 
     def saveRecommendationsToRedis(self, listener_id, music_ids, ttl_seconds=86400):
         # ... không thay đổi ...
@@ -207,6 +439,23 @@ class MusicRecommendation:
                 pipe.set(key, value, ex=ttl_seconds)
             pipe.execute()
 
+    def refreshRecommendationsInRedis(self, all_recommendations, ttl_seconds=86400):
+        """
+        Gia hạn TTL cho danh sách gợi ý không đổi của các người dùng; danh sách nào đã hết hạn
+        (EXPIRE trả về False) thì được ghi lại.
+        """
+        if not self.redis_client: return
+        keys = [f"sonata_recommendations:listener:{listener_id}" for listener_id, _ in all_recommendations]
+        with self.redis_client.pipeline() as pipe:
+            for key in keys:
+                pipe.expire(key, ttl_seconds)
+            refreshed = pipe.execute()
+        with self.redis_client.pipeline() as pipe:
+            for key, (_, music_ids), exists in zip(keys, all_recommendations, refreshed):
+                if not exists:
+                    pipe.set(key, ",".join(map(str, music_ids)), ex=ttl_seconds)
+            pipe.execute()
+
 # Ví dụ về cách sử dụng
 if __name__ == "__main__":
     music_recommendation = MusicRecommendation()
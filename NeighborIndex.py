@@ -0,0 +1,229 @@
+import json
+import os
+import numpy as np
+from scipy import sparse
+
+
+class NeighborIndex:
+    """
+    Top-M most similar items of every item, stored CSR-style.
+
+    Row i holds the neighbors of item i sorted by inner item id, so a lookup is a binary search.
+    Only strictly positive similarities are kept: estimate() never uses the others.
+    Memory is n_items * M * 8 bytes (int32 id + float32 similarity) instead of n_items^2 * 8.
+    """
+
+    def __init__(self, indptr, indices, data, cappedValues=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_items = len(indptr) - 1
+        # The engine's cappedValues() when the index was built, None if unknown; see update()
+        self.cappedValues = cappedValues
+
+    @classmethod
+    def build(cls, engine, numNeighbors, blockSize=256):
+        """
+        Build the index from a similarity engine (see ContentSimilarity.neighborRows).
+
+        Ties at the M-th place are broken by the engine's tieRank (smaller first), so the kept
+        neighbors do not depend on the order in which items were numbered.
+        """
+        rowIndices = []
+        rowData = []
+        for start in range(0, engine.n_items, blockSize):
+            rows = np.arange(start, min(start + blockSize, engine.n_items))
+            for (indices, data) in engine.neighborRows(rows, numNeighbors):
+                rowIndices.append(indices)
+                rowData.append(data)
+        return cls.fromRows(rowIndices, rowData, engine.cappedValues())
+
+    @classmethod
+    def fromRows(cls, rowIndices, rowData, cappedValues=None):
+        indptr = np.zeros(len(rowIndices) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(indices) for indices in rowIndices])
+        if rowIndices:
+            indices = np.concatenate(rowIndices).astype(np.int32)
+            data = np.concatenate(rowData).astype(np.float32)
+        else:
+            indices = np.zeros(0, dtype=np.int32)
+            data = np.zeros(0, dtype=np.float32)
+        return cls(indptr, indices, data, cappedValues)
+
+    def update(self, oldMusicIDs, changedMusicIDs, engine, numNeighbors):
+        """
+        Bring the index up to date after some items were added, removed or re-tagged, touching only
+        the rows that can differ from a full rebuild. Returns a new index over engine.musicIDs (the
+        new inner item order); unchanged rows are carried over with their columns renumbered.
+
+        A row has to be recomputed when its item changed, when one of its neighbors changed or
+        disappeared, or when a changed item now ranks above its weakest neighbor. With a
+        maxPostingLength cap, a value whose posting list crossed the cap changes the similarity of
+        every pair sharing it, so the rows of all the items holding it are recomputed too; if the
+        capped values of the old index are unknown, the index is rebuilt.
+        """
+        cappedValues = engine.cappedValues()
+        if cappedValues is None or (engine.maxPostingLength is not None and self.cappedValues is None):
+            print("Capped attribute values of the neighbor index unknown, rebuilding it")
+            return NeighborIndex.build(engine, numNeighbors)
+
+        musicIDs = engine.musicIDs
+        tieRank = engine.tieRank
+        n_items = len(musicIDs)
+        newPosition = {musicID: row for (row, musicID) in enumerate(musicIDs)}
+        changed = set(changedMusicIDs) | (set(oldMusicIDs) ^ set(musicIDs))
+
+        # Old inner id -> new inner id, -1 for items that changed or are gone
+        remap = np.full(len(oldMusicIDs), -1, dtype=np.int64)
+        oldPosition = {}
+        for (row, musicID) in enumerate(oldMusicIDs):
+            oldPosition[musicID] = row
+            if musicID not in changed:
+                remap[row] = newPosition[musicID]
+
+        changedRows = np.array(sorted(newPosition[musicID] for musicID in changed if musicID in newPosition),
+                               dtype=np.int64)
+        dirty = np.zeros(n_items, dtype=bool)
+        dirty[changedRows] = True
+        dirty[engine.valueHolders(cappedValues ^ (self.cappedValues or set()))] = True
+
+        rowIndices = [None] * n_items
+        rowData = [None] * n_items
+        for (row, musicID) in enumerate(musicIDs):
+            if dirty[row]:
+                continue
+            (indices, data) = self.row(oldPosition[musicID])
+            mapped = remap[indices]
+            if (mapped < 0).any():
+                dirty[row] = True
+                continue
+            order = np.argsort(mapped)
+            rowIndices[row] = mapped[order].astype(np.int32)
+            rowData[row] = np.asarray(data[order], dtype=np.float32)
+
+        if len(changedRows):
+            # Similarities are symmetric: column x of the matrix is row x
+            changedSimilarities = engine.effectiveRows(changedRows)
+            clean = np.flatnonzero(~dirty)
+            isFull = np.array([numNeighbors is not None and len(rowIndices[row]) >= numNeighbors
+                               for row in clean], dtype=bool)
+
+            # A row that still has room takes any positively similar changed item
+            dirty[clean[~isFull]] = (changedSimilarities[:, clean[~isFull]] > 0).any(axis=0)
+
+            full = clean[isFull]
+            if len(full):
+                (worstSimilarity, worstRank) = self._weakestNeighbors(full, rowIndices, rowData, engine, tieRank)
+                candidate = changedSimilarities[:, full]
+                candidateRank = tieRank[changedRows][:, None]
+                beats = (candidate > worstSimilarity) | ((candidate == worstSimilarity) & (candidateRank < worstRank))
+                dirty[full] = beats.any(axis=0)
+
+        dirtyRows = np.flatnonzero(dirty)
+        print("Recomputing ", len(dirtyRows), " of ", n_items, " neighbor rows")
+        for start in range(0, len(dirtyRows), 256):
+            rows = dirtyRows[start:start + 256]
+            for (row, neighbors) in zip(rows, engine.neighborRows(rows, numNeighbors)):
+                (rowIndices[row], rowData[row]) = neighbors
+
+        return NeighborIndex.fromRows(rowIndices, rowData, cappedValues)
+
+    @staticmethod
+    def _weakestNeighbors(rows, rowIndices, rowData, engine, tieRank):
+        """
+        Exact (float64) similarity and tie rank of the weakest kept neighbor of each row.
+        Only the entries tied for the smallest float32 value need their float64 value recomputed.
+        """
+        pairRows = []
+        pairCols = []
+        for row in rows:
+            data = rowData[row]
+            weakest = rowIndices[row][data == data.min()]
+            pairRows.append(np.full(len(weakest), row, dtype=np.int64))
+            pairCols.append(weakest.astype(np.int64))
+        pairRows = np.concatenate(pairRows)
+        pairCols = np.concatenate(pairCols)
+        similarities = engine.effectivePairs(pairRows, pairCols)
+
+        # Weakest = smallest similarity, then largest tie rank; lexsort puts it first in each row
+        order = np.lexsort((-tieRank[pairCols], similarities, pairRows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = pairRows[order][1:] != pairRows[order][:-1]
+        weakest = order[first]
+        return similarities[weakest], tieRank[pairCols[weakest]]
+
+    def row(self, i):
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def lookup(self, i, items):
+        """Similarity of item i with each of the given items (0 where not a neighbor)."""
+        (indices, data) = self.row(i)
+        items = np.asarray(items)
+        if len(indices) == 0:
+            return np.zeros(len(items), dtype=np.float32)
+        positions = np.minimum(np.searchsorted(indices, items), len(indices) - 1)
+        return np.where(indices[positions] == items, data[positions], 0).astype(np.float32)
+
+    def toCSR(self):
+        return sparse.csr_matrix((self.data, self.indices, self.indptr), shape=(self.n_items, self.n_items))
+
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def save(self, directory):
+        """Write the arrays as .npy files, which load() can map straight back into memory."""
+        os.makedirs(directory, exist_ok=True)
+        for name in ('indptr', 'indices', 'data'):
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        if self.cappedValues is not None:
+            with open(os.path.join(directory, 'cappedValues.json'), 'w') as f:
+                json.dump(sorted(self.cappedValues), f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Open an index written by save(). With mmap the arrays are read-only views of the page
+        cache, so loading is instant and every process opening the same files shares the pages.
+        """
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode)
+                  for name in ('indptr', 'indices', 'data')]
+        cappedValues = None
+        cappedPath = os.path.join(directory, 'cappedValues.json')
+        if os.path.isfile(cappedPath):
+            with open(cappedPath) as f:
+                cappedValues = {tuple(value) for value in json.load(f)}
+        return cls(*arrays, cappedValues=cappedValues)
+
+
+def selectTopNeighbors(indices, similarities, numNeighbors, tieRank):
+    """
+    Keep the numNeighbors largest positive similarities among the scored items of one row
+    (all of them if None).
+
+    Returns:
+        (indices, similarities) of the kept neighbors, sorted by index.
+    """
+    positive = similarities > 0
+    indices = indices[positive]
+    similarities = similarities[positive]
+    if numNeighbors is not None and len(indices) > numNeighbors:
+        # Cheap pre-selection: everything strictly above the M-th value is in, ties decide the rest
+        threshold = -np.partition(-similarities, numNeighbors - 1)[numNeighbors - 1]
+        kept = similarities >= threshold
+        indices = indices[kept]
+        similarities = similarities[kept]
+        order = np.lexsort((tieRank[indices], -similarities))[:numNeighbors]
+        indices = indices[order]
+        similarities = similarities[order]
+    order = np.argsort(indices)
+    return indices[order].astype(np.int32), similarities[order]
+
+
+def rankOf(musicIDs):
+    """Rank of every raw music ID in sorted order, used to break similarity ties."""
+    order = sorted(range(len(musicIDs)), key=lambda i: musicIDs[i])
+    rank = np.empty(len(musicIDs), dtype=np.int64)
+    rank[order] = np.arange(len(musicIDs))
+    return rank
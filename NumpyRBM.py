@@ -0,0 +1,104 @@
+import numpy as np
+from scipy import sparse
+
+
+class NumpyRBM(object):
+    """
+    NumPy version of RBM: same constructor, Train() and GetRecommendations(), same CD-1 update
+    and masked per-item softmax reconstruction, without TensorFlow's import, session and graph.
+    The training matrix may be a scipy sparse matrix; only one mini-batch at a time is made dense.
+    All randomness (initial weights, hidden sampling, batch order) comes from one seeded RandomState.
+    """
+
+    def __init__(self, visibleDimensions, epochs=20, hiddenDimensions=50, ratingValues=10, learningRate=0.001, batchSize=100, seed=0):
+
+        self.visibleDimensions = visibleDimensions
+        self.epochs = epochs
+        self.hiddenDimensions = hiddenDimensions
+        self.ratingValues = ratingValues
+        self.learningRate = learningRate
+        self.batchSize = batchSize
+        self.seed = seed
+
+    def Train(self, X, initialParameters=None, earlyStopping=None):
+
+        self.random = np.random.RandomState(self.seed)
+
+        # Initialize weights randomly, biases at zero
+        maxWeight = 4.0 * np.sqrt(6.0 / (self.hiddenDimensions + self.visibleDimensions))
+        self.weights = self.random.uniform(-maxWeight, maxWeight,
+                                           [self.visibleDimensions, self.hiddenDimensions]).astype(np.float32)
+        self.hiddenBias = np.zeros(self.hiddenDimensions, dtype=np.float32)
+        self.visibleBias = np.zeros(self.visibleDimensions, dtype=np.float32)
+        if initialParameters is not None:
+            # Warm start (see RBMCheckpoint.initialParameters)
+            (self.weights, self.hiddenBias, self.visibleBias) = (np.array(p, dtype=np.float32) for p in initialParameters)
+
+        # Users held out for validation (see EarlyStopping) are left out of the epochs below
+        rows = np.arange(X.shape[0]) if earlyStopping is None else earlyStopping.trainingRows
+        for epoch in range(self.epochs):
+            # Visit the users in a random order without shuffling the caller's matrix
+            order = rows[self.random.permutation(len(rows))]
+            for i in range(0, len(order), self.batchSize):
+                self.Update(self._dense(X[order[i:i+self.batchSize]]))
+
+            print("Trained epoch ", epoch)
+            if earlyStopping is not None and earlyStopping.check(self, epoch):
+                break
+
+        if earlyStopping is not None:
+            # The held-out users only decide when to stop: train on them once so the model has seen everyone
+            heldOut = earlyStopping.validationRows
+            for i in range(0, len(heldOut), self.batchSize):
+                self.Update(self._dense(X[heldOut[i:i+self.batchSize]]))
+
+    def Update(self, batch):
+        """One contrastive divergence (k=1) step on a batch of visible vectors."""
+
+        # Forward pass: sample the hidden layer given the visible one
+        hProb0 = self._sigmoid(batch @ self.weights + self.hiddenBias)
+        hSample = (hProb0 > self.random.uniform(size=hProb0.shape)).astype(np.float32)
+        forward = batch.T @ hSample
+
+        # Backward pass: reconstruct the visible layer, softmax over the rating values of the rated items
+        vProb = self._reconstruct(hSample @ self.weights.T + self.visibleBias, batch)
+        hProb1 = self._sigmoid(vProb @ self.weights + self.hiddenBias)
+        backward = vProb.T @ hProb1
+
+        self.weights += self.learningRate * (forward - backward)
+        self.hiddenBias += self.learningRate * np.mean(hProb0 - hProb1, axis=0)
+        self.visibleBias += self.learningRate * np.mean(batch - vProb, axis=0)
+
+    def GetParameters(self):
+
+        return self.weights, self.hiddenBias, self.visibleBias
+
+    def GetRecommendations(self, inputUser):
+
+        return self.GetReconstructions(inputUser)[0]
+
+    def GetReconstructions(self, inputUsers):
+
+        inputUsers = self._dense(inputUsers)
+        hidden = self._sigmoid(inputUsers @ self.weights + self.hiddenBias)
+        return self._sigmoid(hidden @ self.weights.T + self.visibleBias)
+
+    def _reconstruct(self, v, batch):
+        # 1 for the items the user rated, 0 for the missing ones (their softmax becomes uniform)
+        v = v.reshape(len(v), -1, self.ratingValues)
+        mask = np.sign(batch).reshape(v.shape).max(axis=2, keepdims=True)
+        v = v * mask
+        v = np.exp(v - v.max(axis=2, keepdims=True))
+        return (v / v.sum(axis=2, keepdims=True)).reshape(len(batch), -1)
+
+    @staticmethod
+    def _dense(batch):
+        if sparse.issparse(batch):
+            return batch.toarray().astype(np.float32, copy=False)
+        return np.asarray(batch, dtype=np.float32)
+
+    @staticmethod
+    def _sigmoid(x):
+        # exp overflows to inf for very negative inputs, which correctly gives 0
+        with np.errstate(over='ignore'):
+            return 1.0 / (1.0 + np.exp(-x))
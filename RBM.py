@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 import tensorflow as tf
 from tensorflow.python.framework import ops
 
@@ -16,7 +17,7 @@ class RBM(object):
         self.batchSize = batchSize
         
                 
-    def Train(self, X):
+    def Train(self, X, initialParameters=None, earlyStopping=None):
 
         ops.reset_default_graph()
 
@@ -29,24 +30,50 @@ class RBM(object):
         self.sess = tf.compat.v1.Session()
         self.sess.run(init)
 
+        if initialParameters is not None:
+            # Warm start (see RBMCheckpoint.initialParameters), fed through placeholders so the
+            # values are not embedded in the graph
+            for (variable, value) in zip([self.weights, self.hiddenBias, self.visibleBias], initialParameters):
+                placeholder = tf.compat.v1.placeholder(tf.float32, value.shape)
+                self.sess.run(variable.assign(placeholder), feed_dict={placeholder: value})
+
+        # Users held out for validation (see EarlyStopping) are left out of the epochs below
+        rows = np.arange(X.shape[0]) if earlyStopping is None else earlyStopping.trainingRows
         for epoch in range(self.epochs):
-            np.random.shuffle(X)
-            
-            trX = np.array(X)
+            # Shuffle a copy: the caller still indexes X by user afterwards
+            trX = X[rows[np.random.permutation(len(rows))]]
             for i in range(0, trX.shape[0], self.batchSize):
-                self.sess.run(self.update, feed_dict={self.X: trX[i:i+self.batchSize]})
+                self.sess.run(self.update, feed_dict={self.X: self._dense(trX[i:i+self.batchSize])})
 
             print("Trained epoch ", epoch)
+            if earlyStopping is not None and earlyStopping.check(self, epoch):
+                break
+
+        if earlyStopping is not None:
+            # The held-out users only decide when to stop: train on them once so the model has seen everyone
+            heldOut = X[earlyStopping.validationRows]
+            for i in range(0, heldOut.shape[0], self.batchSize):
+                self.sess.run(self.update, feed_dict={self.X: self._dense(heldOut[i:i+self.batchSize])})
+
+
+    def GetParameters(self):
 
+        return tuple(self.sess.run([self.weights, self.hiddenBias, self.visibleBias]))
 
     def GetRecommendations(self, inputUser):
                  
-        hidden = tf.nn.sigmoid(tf.matmul(self.X, self.weights) + self.hiddenBias)
-        visible = tf.nn.sigmoid(tf.matmul(hidden, tf.transpose(self.weights)) + self.visibleBias)
+        return self.GetReconstructions(inputUser)[0]
+
+    def GetReconstructions(self, inputUsers):
+        # One run of the reconstruction op built in MakeGraph, for a whole batch of users
+        return self.sess.run(self.reconstruction, feed_dict={ self.X: self._dense(inputUsers)} )
 
-        feed = self.sess.run(hidden, feed_dict={ self.X: inputUser} )
-        rec = self.sess.run(visible, feed_dict={ hidden: feed} )
-        return rec[0]       
+    @staticmethod
+    def _dense(batch):
+        # X may be a scipy sparse matrix: only the current mini-batch is made dense
+        if sparse.issparse(batch):
+            return batch.toarray()
+        return batch
 
     def MakeGraph(self):
 
@@ -103,5 +130,10 @@ class RBM(object):
         visibleBiasUpdate = self.visibleBias.assign_add(self.learningRate * tf.reduce_mean(self.X - vProb, 0))
 
         self.update = [weightUpdate, hiddenBiasUpdate, visibleBiasUpdate]
+
+        # Inference: reconstruct the visible layer from the hidden probabilities, built once here
+        # instead of adding new ops to the graph on every GetRecommendations call
+        hidden = tf.nn.sigmoid(tf.matmul(self.X, self.weights) + self.hiddenBias)
+        self.reconstruction = tf.nn.sigmoid(tf.matmul(hidden, tf.transpose(self.weights)) + self.visibleBias)
         
     
\ No newline at end of file
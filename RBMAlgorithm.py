@@ -1,20 +1,37 @@
 from surprise import AlgoBase
 from surprise import PredictionImpossible
 import numpy as np
-from MusicRecommendation import MusicRecommendation
-from RBM import RBM
+from scipy import sparse
+from TrainsetArrays import TrainsetArrays, denseScoreDrift, matchIDs, rawItemIDs, rawUserIDs
+from RBMCheckpoint import RBMCheckpoint
+from EarlyStopping import EarlyStopping
 import pandas as pd
 
 class RBMAlgorithm(AlgoBase):
 
-    def __init__(self, epochs=20, hiddenDim=100, learningRate=0.001, batchSize=100, sim_options={}):
+    def __init__(self, epochs=20, hiddenDim=100, learningRate=0.001, batchSize=100, sim_options={}, backend="tensorflow",
+                 checkpointPath=None, warmStartEpochs=None, tolerance=None, validationInterval=2, musicCatalog=None):
         AlgoBase.__init__(self)
         self.epochs = epochs
         self.hiddenDim = hiddenDim
         self.learningRate = learningRate
         self.batchSize = batchSize
-        self.musicRecommendation = MusicRecommendation()
-        self.musicRecommendation.loadMusicData()
+        # "tensorflow" (RBM) hoặc "numpy" (NumpyRBM, không cần nạp TensorFlow)
+        self.backend = backend
+        # File .npz lưu trọng số sau mỗi lần fit; nếu đã có, lần fit sau khởi động ấm từ đó
+        self.checkpointPath = checkpointPath
+        # Số epoch khi khởi động ấm (None: dùng epochs)
+        self.warmStartEpochs = warmStartEpochs
+        # Dừng sớm khi sai số tái tạo của nhóm người dùng kiểm định giảm ít hơn tolerance
+        # sau mỗi validationInterval epoch (None: luôn chạy đủ số epoch, khi đó epochs là mức trần)
+        self.tolerance = tolerance
+        self.validationInterval = validationInterval
+        # MusicCatalog dùng chung (xem MusicRecommendation.loadCatalog); nếu không truyền vào thì
+        # lấy catalog đã tải của tiến trình thay vì truy vấn lại Postgres
+        if musicCatalog is None:
+            from MusicRecommendation import MusicRecommendation
+            musicCatalog = MusicRecommendation().loadCatalog()
+        self.musicCatalog = musicCatalog
         self.stoplist = ["sex", "drugs", "rock n roll"]
 
     def buildStoplist(self, trainset):
@@ -22,7 +39,7 @@ class RBMAlgorithm(AlgoBase):
         for iid in trainset.all_items():
             self.stoplistLookup[iid] = False
             musicID = trainset.to_raw_iid(iid)
-            musicName = self.musicRecommendation.getMusicName(musicID)
+            musicName = self.musicCatalog.getMusicName(musicID)
             if musicName:
                 musicName = musicName.lower()
                 for term in self.stoplist:
@@ -30,6 +47,19 @@ class RBMAlgorithm(AlgoBase):
                         print("Blocked ", musicName)
                         self.stoplistLookup[iid] = True
 
+    def makeRBM(self, visibleDimensions, epochs=None):
+        """
+        Tạo RBM theo backend đã chọn. TensorFlow chỉ được import khi thực sự dùng đến.
+        """
+        epochs = self.epochs if epochs is None else epochs
+        if self.backend == "numpy":
+            from NumpyRBM import NumpyRBM
+            return NumpyRBM(visibleDimensions, hiddenDimensions=self.hiddenDim, learningRate=self.learningRate, batchSize=self.batchSize, epochs=epochs)
+        if self.backend == "tensorflow":
+            from RBM import RBM
+            return RBM(visibleDimensions, hiddenDimensions=self.hiddenDim, learningRate=self.learningRate, batchSize=self.batchSize, epochs=epochs)
+        raise ValueError("Unknown RBM backend: " + str(self.backend))
+
     def softmax(self, x):
         return np.exp(x) / np.sum(np.exp(x), axis=0)
     
@@ -69,42 +99,74 @@ class RBMAlgorithm(AlgoBase):
         
         self.buildStoplist(trainset)
 
-        self._calculate_quantile_thresholds(trainset, num_levels=10)
-
         numUsers = trainset.n_users
         numItems = trainset.n_items
+        musicIDs = [trainset.to_raw_iid(iid) for iid in range(numItems)]
+
+        # Khởi động ấm: giữ ngưỡng cấp độ của checkpoint để các đơn vị hiển thị giữ nguyên ý nghĩa
+        initialParameters = None
+        checkpoint = RBMCheckpoint.load(self.checkpointPath) if self.checkpointPath else None
+        if checkpoint is not None:
+            initialParameters = checkpoint.initialParameters(musicIDs, self.hiddenDim)
+        if initialParameters is not None:
+            print("Warm-starting RBM from ", self.checkpointPath)
+            self.rating_thresholds = checkpoint.thresholds
+            epochs = self.epochs if self.warmStartEpochs is None else self.warmStartEpochs
+        else:
+            self._calculate_quantile_thresholds(trainset, num_levels=10)
+            epochs = self.epochs
         
-        trainingMatrix = np.zeros([numUsers, numItems, 10], dtype=np.float32)
-        
-        for (uid, iid, rating) in trainset.all_ratings():
-            # if not self.stoplistLookup[iid]: # Bỏ qua stoplist để ví dụ đơn giản
-                # Chuẩn hóa rating thành một số từ 0-9
-                normalized_level = self._normalize_rating(rating)
-                
-                # Gán vào ma trận training
-                trainingMatrix[int(uid), int(iid), normalized_level] = 1
-        
-        # Flatten to a 2D array, with nodes for each possible rating type on each possible item, for every user.
-        trainingMatrix = np.reshape(trainingMatrix, [trainingMatrix.shape[0], -1])
+        trainingMatrix = self.buildTrainingMatrix(trainset)
         
         # Create an RBM with (num items * rating values) visible nodes
-        rbm = RBM(trainingMatrix.shape[1], hiddenDimensions=self.hiddenDim, learningRate=self.learningRate, batchSize=self.batchSize, epochs=self.epochs)
-        rbm.Train(trainingMatrix)
+        rbm = self.makeRBM(trainingMatrix.shape[1], epochs)
+        earlyStopping = None
+        if self.tolerance is not None:
+            earlyStopping = EarlyStopping(trainingMatrix, self.tolerance, self.validationInterval)
+        rbm.Train(trainingMatrix, initialParameters, earlyStopping)
+        self.epochsTrained = earlyStopping.report(epochs)[0] if earlyStopping else epochs
+
+        if self.checkpointPath:
+            (weights, hiddenBias, visibleBias) = rbm.GetParameters()
+            RBMCheckpoint(weights, hiddenBias, visibleBias, self.rating_thresholds, musicIDs).save(self.checkpointPath)
 
         self.predictedRatings = np.zeros([numUsers, numItems], dtype=np.float32)
-        for uiid in range(trainset.n_users):
-            if (uiid % 50 == 0):
-                print("Processing user ", uiid)
-            recs = rbm.GetRecommendations([trainingMatrix[uiid]])
-            recs = np.reshape(recs, [numItems, 10])
-            
-            for itemID, rec in enumerate(recs):
-                normalized = self.softmax(rec)
-                rating = np.average(np.arange(10), weights=normalized)
-                self.predictedRatings[uiid, itemID] = (rating + 1) * 0.5
+        for start in range(0, numUsers, self.batchSize):
+            print("Processing users ", start, " to ", min(start + self.batchSize, numUsers) - 1)
+            recs = rbm.GetReconstructions(trainingMatrix[start:start + self.batchSize])
+            recs = np.reshape(recs, [-1, numItems, 10])
+            self.predictedRatings[start:start + self.batchSize] = self.expectedRatings(recs)
         
         return self
 
+    def buildTrainingMatrix(self, trainset):
+        """
+        Ma trận huấn luyện thưa (CSR) numUsers x (numItems * 10): cột iid * 10 + cấp độ bằng 1
+        với mỗi rating. Tương đương ma trận dày numUsers x numItems x 10 đã làm phẳng, nhưng chỉ
+        tốn bộ nhớ theo số rating; RBM chỉ chuyển từng mini-batch sang dạng dày.
+        """
+        # if not self.stoplistLookup[iid]: # Bỏ qua stoplist để ví dụ đơn giản
+        ratingArrays = TrainsetArrays(trainset)
+
+        # Chuẩn hóa tất cả rating thành cấp độ 0-9 trong một lần gọi searchsorted
+        levels = self._normalize_rating(ratingArrays.ratings)
+        columns = ratingArrays.items * 10 + levels
+        data = np.ones(len(columns), dtype=np.float32)
+        trainingMatrix = sparse.csr_matrix((data, columns, ratingArrays.indptr),
+                                           shape=(trainset.n_users, trainset.n_items * 10))
+        trainingMatrix.sort_indices()
+        return trainingMatrix
+
+    def expectedRatings(self, recs):
+        """
+        Giải mã tái tạo của RBM thành điểm dự đoán cho cả khối người dùng x bài hát x 10 cấp độ:
+        softmax trên 10 cấp độ rồi lấy trung bình có trọng số của cấp độ, như softmax() và
+        np.average() cho từng bài hát.
+        """
+        normalized = np.exp(recs) / np.sum(np.exp(recs), axis=2, keepdims=True)
+        rating = np.sum(normalized * np.arange(10), axis=2, dtype=np.float64) / np.sum(normalized, axis=2, dtype=np.float64)
+        return (rating + 1) * 0.5
+
     def estimate(self, u, i):
         if not (self.trainset.knows_user(u) and self.trainset.knows_item(i)):
             raise PredictionImpossible('User and/or item is unknown.')
@@ -114,4 +176,35 @@ class RBMAlgorithm(AlgoBase):
         if (rating < 0.001):
             raise PredictionImpossible('No valid prediction exists.')
             
-        return rating
+        # Python float, so that blending arithmetic is float64 whatever the NumPy casting rules
+        return float(rating)
+
+    def estimateBlock(self, users, items=None):
+        """
+        Lấy dự đoán cho một khối người dùng x bài hát (inner ID) trực tiếp từ predictedRatings.
+        Ô nào estimate() sẽ ném PredictionImpossible thì có giá trị NaN.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.arange(self.trainset.n_items) if items is None else np.asarray(items, dtype=np.int64)
+        knownUsers = (users >= 0) & (users < self.trainset.n_users)
+        knownItems = (items >= 0) & (items < self.trainset.n_items)
+
+        estimates = np.full((len(users), len(items)), np.nan)
+        block = self.predictedRatings[users[knownUsers]][:, items[knownItems]].astype(np.float64)
+        block[block < 0.001] = np.nan
+        estimates[np.ix_(knownUsers, knownItems)] = block
+        return estimates
+
+    def scoreState(self):
+        """Dự đoán của lần huấn luyện này theo ID gốc, để lần chạy sau đo độ lệch (xem IncrementalRecommender)."""
+        return {'listenerIDs': rawUserIDs(self.trainset), 'musicIDs': rawItemIDs(self.trainset),
+                'predictedRatings': self.predictedRatings}
+
+    def scoreDrift(self, state, users):
+        """Chênh lệch lớn nhất giữa dự đoán mới và dự đoán trong state, theo từng người dùng."""
+        users = np.asarray(users, dtype=np.int64)
+        oldUsers = matchIDs(state['listenerIDs'], rawUserIDs(self.trainset)[users])
+        oldItems = matchIDs(state['musicIDs'], rawItemIDs(self.trainset))
+        return denseScoreDrift(lambda rows, items: self.predictedRatings[users[rows]][:, items].astype(np.float64),
+                               lambda rows, items: state['predictedRatings'][rows][:, items].astype(np.float64),
+                               oldUsers, oldItems)
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+
+
+class RBMCheckpoint:
+    """
+    Trained RBM parameters plus what is needed to reuse them on a later catalog: the rating level
+    thresholds and the raw music ID of every block of ratingValues visible units.
+
+    The RBM has no per-user parameters (users are only rows of the training matrix), so a warm
+    start only has to realign the item rows of the weights and the visible bias.
+    """
+
+    # Version of the .npz layout
+    FORMAT = 1
+
+    def __init__(self, weights, hiddenBias, visibleBias, thresholds, musicIDs, ratingValues=10):
+        self.weights = weights
+        self.hiddenBias = hiddenBias
+        self.visibleBias = visibleBias
+        self.thresholds = list(thresholds)
+        self.musicIDs = list(musicIDs)
+        self.ratingValues = ratingValues
+
+    def save(self, path):
+        """Write the checkpoint to path (.npz), through a temporary file so readers never see half of it."""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tempPath = path + ".tmp"
+        with open(tempPath, "wb") as f:
+            np.savez(f, format=self.FORMAT, weights=self.weights, hiddenBias=self.hiddenBias,
+                     visibleBias=self.visibleBias, thresholds=np.asarray(self.thresholds),
+                     musicIDs=np.asarray(self.musicIDs), ratingValues=self.ratingValues)
+        os.replace(tempPath, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a checkpoint written by save(), or None if there is none (or it has another format)."""
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as arrays:
+            if int(arrays['format']) != cls.FORMAT:
+                print("Ignoring RBM checkpoint ", path, " with format ", int(arrays['format']))
+                return None
+            return cls(arrays['weights'], arrays['hiddenBias'], arrays['visibleBias'],
+                       arrays['thresholds'].tolist(), arrays['musicIDs'].tolist(), int(arrays['ratingValues']))
+
+    def initialParameters(self, musicIDs, hiddenDimensions, seed=0):
+        """
+        Starting (weights, hiddenBias, visibleBias) for an RBM over musicIDs: the checkpoint's rows
+        for known songs, fresh random rows (the usual initialisation) and zero bias for new ones.
+
+        Returns:
+            tuple or None: None when the checkpoint does not fit (different hidden layer size).
+        """
+        if self.weights.shape[1] != hiddenDimensions:
+            print("RBM checkpoint has ", self.weights.shape[1], " hidden units, ", hiddenDimensions, " requested")
+            return None
+
+        visibleDimensions = len(musicIDs) * self.ratingValues
+        maxWeight = 4.0 * np.sqrt(6.0 / (hiddenDimensions + visibleDimensions))
+        weights = np.random.RandomState(seed).uniform(-maxWeight, maxWeight,
+                                                      [visibleDimensions, hiddenDimensions]).astype(np.float32)
+        visibleBias = np.zeros(visibleDimensions, dtype=np.float32)
+
+        oldPosition = {musicID: index for (index, musicID) in enumerate(self.musicIDs)}
+        pairs = [(index, oldPosition[musicID]) for (index, musicID) in enumerate(musicIDs) if musicID in oldPosition]
+        if pairs:
+            (newItems, oldItems) = (np.array(p, dtype=np.int64) for p in zip(*pairs))
+            offsets = np.arange(self.ratingValues)
+            newRows = (newItems[:, None] * self.ratingValues + offsets).ravel()
+            oldRows = (oldItems[:, None] * self.ratingValues + offsets).ravel()
+            weights[newRows] = self.weights[oldRows]
+            visibleBias[newRows] = self.visibleBias[oldRows]
+        print("Warm start: ", len(pairs), " of ", len(musicIDs), " songs taken from the checkpoint")
+
+        return weights, np.array(self.hiddenBias, dtype=np.float32), visibleBias
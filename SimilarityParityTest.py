@@ -0,0 +1,52 @@
+import sys
+import tempfile
+import numpy as np
+from CatalogSnapshot import loadSnapshot, saveSnapshot
+from ContentKNNAlgorithm import ContentKNNAlgorithm
+from ContentSimilarity import ContentSimilarity, catalogFingerprint
+from MusicCatalog import MusicCatalog
+from SyntheticData import makeCatalog
+
+# Checks the vectorized similarity matrix of ContentSimilarity against the scalar path,
+# ContentKNNAlgorithm.computeSimilarity, for every pair of songs. Exits with status 1 on any mismatch.
+
+
+class _Catalog:
+    musicID_to_details = makeCatalog(numItems=400, seed=1)
+
+
+def countMismatches(algorithm, musicIDs, similarities):
+    """Number of pairs (i, j) whose matrix value differs from computeSimilarity."""
+    mismatches = 0
+    for i in range(len(musicIDs)):
+        for j in range(i + 1, len(musicIDs)):
+            expected = algorithm.computeSimilarity(musicIDs[i], musicIDs[j])
+            if similarities[i, j] != expected or similarities[j, i] != expected:
+                mismatches += 1
+    return mismatches
+
+
+algo = ContentKNNAlgorithm(10, {}, _Catalog())
+musicIDs = list(_Catalog.musicID_to_details.keys()) + [10 ** 6]  # one item without details
+engine = ContentSimilarity(_Catalog.musicID_to_details, musicIDs)
+
+failed = False
+for blockSize in (1, 64, 1000):
+    mismatches = countMismatches(algo, musicIDs, engine.computeMatrix(blockSize=blockSize))
+    print("blockSize", blockSize, "mismatched pairs:", mismatches)
+    failed = failed or mismatches > 0
+
+# The columnar details of a snapshot take a fast path that must encode the same matrices
+with tempfile.TemporaryDirectory() as directory:
+    saveSnapshot(MusicCatalog({}, _Catalog.musicID_to_details, [], [], []), directory + "/snapshot")
+    columnar = loadSnapshot(directory + "/snapshot").musicID_to_details
+    columnarEngine = ContentSimilarity(columnar, musicIDs)
+    sameMatrix = np.array_equal(columnarEngine.computeMatrix(), engine.computeMatrix())
+    sameFingerprint = (catalogFingerprint(columnar, musicIDs, "extra") ==
+                       catalogFingerprint(_Catalog.musicID_to_details, musicIDs, "extra"))
+print("snapshot details: same matrix", sameMatrix, "same fingerprint", sameFingerprint)
+failed = failed or not (sameMatrix and sameFingerprint)
+
+if failed:
+    sys.exit(1)
+print("Vectorized similarities match computeSimilarity")
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def makeCatalog(numItems=500, seed=0, numGenres=20, numArtists=150, numCategories=8, numPeriods=6,
+                nationalities=("VN", "US", "KR", "JP", None), numContributors=30):
+    """
+    Sinh một catalog giả có cùng cấu trúc với MusicRecommendation.musicID_to_details
+    để chạy các kiểm tra và benchmark mà không cần Postgres.
+    """
+    rng = np.random.RandomState(seed)
+
+    def pick(upper, maxCount):
+        count = rng.randint(0, maxCount + 1)
+        return sorted(set(int(x) for x in rng.randint(1, upper + 1, size=count)))
+
+    details = {}
+    for musicID in range(1, numItems + 1):
+        nationality = nationalities[rng.randint(len(nationalities))]
+        contributor = int(rng.randint(0, numContributors + 1)) or None
+        details[musicID] = {
+            'nationality': nationality,
+            'contributor_id': contributor,
+            'artist_ids': pick(numArtists, 2),
+            'category_ids': pick(numCategories, 2),
+            'genre_ids': pick(numGenres, 3),
+            'period_ids': pick(numPeriods, 1)
+        }
+    return details
+
+
+def makeRatings(numUsers=200, numItems=500, ratingsPerUser=30, seed=0):
+    """
+    Sinh dữ liệu điểm nghe nhạc giả dạng cột (listener_id, music_id, score).
+    """
+    rng = np.random.RandomState(seed)
+    popularity = rng.zipf(1.5, size=numItems).astype(np.float64)
+    popularity /= popularity.sum()
+
+    listenerIDs = []
+    musicIDs = []
+    for listenerID in range(1, numUsers + 1):
+        count = min(numItems, max(1, rng.poisson(ratingsPerUser)))
+        items = rng.choice(numItems, size=count, replace=False, p=popularity) + 1
+        listenerIDs.append(np.full(count, listenerID, dtype=np.int64))
+        musicIDs.append(items.astype(np.int64))
+
+    listenerIDs = np.concatenate(listenerIDs)
+    musicIDs = np.concatenate(musicIDs)
+    scores = np.round(rng.gamma(2.0, 1.5, size=len(listenerIDs)), 2)
+    return listenerIDs, musicIDs, scores
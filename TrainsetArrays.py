@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class TrainsetArrays:
+    """
+    Ratings of a surprise Trainset as flat arrays, CSR-style by inner user id.
+
+    The items of user u are items[indptr[u]:indptr[u + 1]], in the order of trainset.ur[u], so
+    batch code that walks them reproduces the per-item loops (and their float sums) exactly.
+    """
+
+    def __init__(self, trainset):
+        self.n_users = trainset.n_users
+        self.n_items = trainset.n_items
+        counts = np.fromiter((len(trainset.ur[u]) for u in range(self.n_users)), dtype=np.int64, count=self.n_users)
+        self.indptr = np.zeros(self.n_users + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(counts)
+        total = int(self.indptr[-1])
+        self.items = np.fromiter((j for u in range(self.n_users) for (j, _) in trainset.ur[u]),
+                                 dtype=np.int64, count=total)
+        self.ratings = np.fromiter((r for u in range(self.n_users) for (_, r) in trainset.ur[u]),
+                                   dtype=np.float64, count=total)
+
+    def userItems(self, u):
+        return self.items[self.indptr[u]:self.indptr[u + 1]]
+
+    def userRatings(self, u):
+        return self.ratings[self.indptr[u]:self.indptr[u + 1]]
+
+    def ratedMask(self, users):
+        """Boolean len(users) x n_items matrix, True where the user rated the item."""
+        users = np.asarray(users, dtype=np.int64)
+        mask = np.zeros((len(users), self.n_items), dtype=bool)
+        counts = self.indptr[users + 1] - self.indptr[users]
+        rows = np.repeat(np.arange(len(users)), counts)
+        positions = np.repeat(self.indptr[users] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        mask[rows, self.items[positions]] = True
+        return mask
+
+
+def rawItemIDs(trainset):
+    return np.array([trainset.to_raw_iid(i) for i in range(trainset.n_items)], dtype=np.int64)
+
+
+def rawUserIDs(trainset):
+    return np.array([trainset.to_raw_uid(u) for u in range(trainset.n_users)], dtype=np.int64)
+
+
+def matchIDs(oldIDs, newIDs):
+    """Position in oldIDs of every entry of newIDs, -1 where it is absent."""
+    oldIDs = np.asarray(oldIDs)
+    newIDs = np.asarray(newIDs)
+    if len(oldIDs) == 0:
+        return np.full(len(newIDs), -1, dtype=np.int64)
+    order = np.argsort(oldIDs, kind='stable')
+    positions = np.minimum(np.searchsorted(oldIDs[order], newIDs), len(oldIDs) - 1)
+    return np.where(oldIDs[order][positions] == newIDs, order[positions], -1)
+
+
+def rowPositions(indptr, rows):
+    """Positions in a CSR-style values array of the entries of the given rows, and each row's length."""
+    rows = np.asarray(rows, dtype=np.int64)
+    counts = indptr[rows + 1] - indptr[rows]
+    starts = np.repeat(indptr[rows] - np.cumsum(counts) + counts, counts)
+    return starts + np.arange(counts.sum(), dtype=np.int64), counts
+
+
+def denseScoreDrift(newScores, oldScores, oldUsers, oldItems, blockSize=256):
+    """
+    Largest |new - old| score of each user over the items known to both runs, for models that can
+    score a block of (rows, items) of either run: newScores(rows, items) with current inner IDs,
+    oldScores(oldRows, oldItems) with the rows and columns of the previous run. oldUsers and oldItems give the previous position of each user and
+    current item (-1 if new); new users get inf.
+    """
+    drift = np.full(len(oldUsers), np.inf)
+    items = np.flatnonzero(oldItems >= 0)
+    users = np.flatnonzero(oldUsers >= 0)
+    for start in range(0, len(users), blockSize):
+        block = users[start:start + blockSize]
+        change = newScores(block, items) - oldScores(oldUsers[block], oldItems[items])
+        drift[block] = np.abs(change).max(axis=1) if len(items) else 0.0
+    return drift
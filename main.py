@@ -1,43 +1,79 @@
 from MusicRecommendation import MusicRecommendation
 from RBMAlgorithm import RBMAlgorithm
+from ImplicitALSAlgorithm import ImplicitALSAlgorithm
 from ContentKNNAlgorithm import ContentKNNAlgorithm
 from HybridAlgorithm import HybridAlgorithm
 from Evaluator import Evaluator
+import argparse
+import os
 import random
 import numpy as np
 
 
-def LoadMusicsData():
-    musicData = MusicRecommendation()
+def LoadMusicsData(snapshotPath=None, updateSnapshotPath=None):
+    # DB_READ_PARTITIONS > 1 reads key ranges of the ratings table and the catalog concurrently
+    musicData = MusicRecommendation(readPartitions=int(os.getenv("DB_READ_PARTITIONS") or 1),
+                                    snapshotPath=snapshotPath,
+                                    watermarkColumn=os.getenv("RATINGS_WATERMARK_COLUMN") or None)
+    if updateSnapshotPath:
+        # Only the ratings changed since the snapshot's watermark are read from Postgres
+        musicData.refreshSnapshot(updateSnapshotPath)
     data = musicData.loadMusicData()
     rankings = musicData.getPopularityRanks()
     users = musicData.loadListeners()
-    return (musicData, data, rankings, users)
+    # Loaded once by loadMusicData above and shared (read-only) by all the algorithms
+    catalog = musicData.loadCatalog()
+    return (musicData, catalog, data, rankings, users)
     
 
+parser = argparse.ArgumentParser(description="Compute recommendations for every listener and save them to Redis")
+# Running from a snapshot leaves no database to export from or update with, so one option at most
+snapshotOptions = parser.add_mutually_exclusive_group()
+snapshotOptions.add_argument("--snapshot", help="run from a catalog snapshot directory instead of Postgres")
+snapshotOptions.add_argument("--export-snapshot", help="write the loaded catalog and ratings to this snapshot directory")
+snapshotOptions.add_argument("--update-snapshot",
+                             help="bring this snapshot directory up to date with the rating changes since it was written, "
+                                  "then run from it")
+args = parser.parse_args()
+
 np.random.seed(0)
 random.seed(0)
 
 # Load up common data set for the recommender algorithms
-(musicData, evaluationData, rankings, users) = LoadMusicsData()
+(musicData, catalog, evaluationData, rankings, users) = LoadMusicsData(args.snapshot, args.update_snapshot)
+if args.export_snapshot:
+    musicData.exportSnapshot(args.export_snapshot)
 
-# Construct an Evaluator to, you know, evaluate them
-evaluator = Evaluator(evaluationData, rankings)
+# Construct an Evaluator to, you know, evaluate them; this job only recommends, so the
+# evaluation sets (anti-test sets, splits, similarity model) are never built
+evaluator = Evaluator(evaluationData, rankings, servingOnly=True)
 
-#Simple RBM
-SimpleRBM = RBMAlgorithm(epochs=40)
+#Collaborative: Simple RBM, or implicit ALS with COLLABORATIVE_MODEL=als
+if os.getenv("COLLABORATIVE_MODEL") == "als":
+    Collaborative = ImplicitALSAlgorithm()
+else:
+    # epochs is a ceiling: training stops once the validation error improves by less than tolerance.
+    # A warm start from RBM_CHECKPOINT_PATH keeps the same ceiling: fewer warm epochs only pay off once
+    # Benchmark.py rbm-warm --epochs 40 --warm-epochs 10 shows them matching a cold run
+    Collaborative = RBMAlgorithm(epochs=40, checkpointPath=os.getenv("RBM_CHECKPOINT_PATH"),
+                                 tolerance=0.001, musicCatalog=catalog)
 #Content
-ContentKNN = ContentKNNAlgorithm(10, {}, musicData)
+ContentKNN = ContentKNNAlgorithm(10, {}, catalog, cacheDir=os.getenv("SIMILARITY_CACHE_DIR"))
 
 #Combine
-Hybrid = HybridAlgorithm([SimpleRBM, ContentKNN], [0.2, 0.8])
+Hybrid = HybridAlgorithm([Collaborative, ContentKNN], [0.2, 0.8])
 
 
 evaluator.AddAlgorithm(Hybrid, "Hybrid")
 
 
-recommendForEveryUser = evaluator.RecommendForEachUser(musicData, users)
-
+if os.getenv("RECOMMEND_STATE_DIR"):
+    # Incremental: only listeners whose lists may have changed since the last run are recomputed and saved
+    evaluator.RecommendForChangedUsers(musicData, users, os.getenv("RECOMMEND_STATE_DIR"),
+                                       processes=int(os.getenv("RECOMMEND_PROCESSES") or 1))
+else:
+    recommendForEveryUser = evaluator.RecommendForEachUser(musicData, users,
+                                                           processes=int(os.getenv("RECOMMEND_PROCESSES") or 1))
 
-# Save recommend course ids to course_recommendations table
-musicData.saveAllRecommendationsToRedis(recommendForEveryUser)
+    # Save recommend course ids to course_recommendations table
+    musicData.saveAllRecommendationsToRedis(recommendForEveryUser)